@@ -0,0 +1,34 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+import threading
+import unittest.mock as mock
+
+from django.test import TestCase
+
+from IspToolboxApp.util import s3
+
+
+class TestStreamS3Objects(TestCase):
+    def test_backpressure(self):
+        produced = []
+        uploaded = []
+        lock = threading.Lock()
+
+        def objects():
+            for i in range(50):
+                # Never more than max_pending objects ahead of the finished uploads
+                with lock:
+                    self.assertLessEqual(len(produced) - len(uploaded), 4)
+                produced.append(i)
+                yield f'key/{i}', b'data'
+
+        def upload(client, key, data, bucket_name):
+            with lock:
+                uploaded.append(key)
+            if key == 'key/7':
+                raise RuntimeError('upload failed')
+
+        with mock.patch.object(s3, 'writeBytesHelper', upload):
+            results = dict(s3.streamS3Objects(objects(), 'bucket', max_pending=4))
+        self.assertEqual(len(results), 50)
+        self.assertFalse(results.pop('key/7'))
+        self.assertTrue(all(results.values()))
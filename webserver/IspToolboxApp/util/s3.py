@@ -5,9 +5,12 @@ import botocore
 from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 import concurrent.futures
+import shutil
 from functools import lru_cache
 
 max_workers = 32
+# Most keys a DeleteObjects request accepts
+MAX_DELETE_KEYS = 1000
 config = TransferConfig(max_concurrency=250)
 
 bucket_name = 'isptoolbox-export-file'
@@ -98,6 +101,10 @@ def readMultipleS3Objects(keys, filenames, bucket_name=bucket_name):
 
 
 def writeMultipleS3Objects(keys, filenames, bucket_name=bucket_name):
+    """
+    Upload the files concurrently, returns the keys that failed to upload
+    """
+    failed = []
     with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
         future_to_url = {
             executor.submit(writeMultipleHelper, s3_client, key, filename, bucket_name): key
@@ -106,8 +113,64 @@ def writeMultipleS3Objects(keys, filenames, bucket_name=bucket_name):
         for future in concurrent.futures.as_completed(future_to_url):
             try:
                 future.result()
-            except Exception:
-                pass
+            except Exception as e:
+                logging.error(e)
+                failed.append(future_to_url[future])
+    return failed
+
+
+def deleteMultipleS3Objects(keys, bucket_name=bucket_name):
+    """
+    Delete the objects with one request per 1000 keys, returns the keys that failed to delete
+    """
+    keys = list(keys)
+    failed = []
+    for i in range(0, len(keys), MAX_DELETE_KEYS):
+        batch = keys[i:i + MAX_DELETE_KEYS]
+        try:
+            response = s3_client.delete_objects(
+                Bucket=bucket_name, Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+        except Exception as e:
+            logging.error(e)
+            failed.extend(batch)
+            continue
+        for error in response.get('Errors', []):
+            logging.error(f"{error.get('Key')}: {error.get('Message')}")
+            failed.append(error.get('Key'))
+    return failed
+
+
+def writeBytesHelper(client, s3key, data, bucket_name=bucket_name):
+    return client.put_object(Bucket=bucket_name, Key=s3key, Body=data)
+
+
+def streamS3Objects(objects, bucket_name=bucket_name, max_pending=4 * max_workers):
+    """
+    Upload (key, bytes) pairs while they are produced, yields (key, uploaded) as uploads complete
+
+    At most `max_pending` uploads wait in the queue, `objects` is not advanced while it is full
+    """
+    pending = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        for key, data in objects:
+            # Blocks until an upload completes when the queue is full
+            timeout = None if len(pending) >= max_pending else 0
+            yield from _completedUploads(pending, concurrent.futures.FIRST_COMPLETED, timeout)
+            pending[executor.submit(writeBytesHelper, s3_client, key, data, bucket_name)] = key
+        yield from _completedUploads(pending, concurrent.futures.ALL_COMPLETED)
+
+
+def _completedUploads(pending, return_when, timeout=None):
+    done, _ = concurrent.futures.wait(pending, timeout=timeout, return_when=return_when)
+    for future in done:
+        key = pending.pop(future)
+        try:
+            future.result()
+        except Exception as e:
+            logging.error(e)
+            yield key, False
+        else:
+            yield key, True
 
 
 def readS3Object(object_name, fp, bucket_name=bucket_name):
@@ -138,6 +201,16 @@ def findPointCloudPrefix(prefix: str, name: str):
     return ''
 
 
+def listObjects(prefix: str, bucket_name=bucket_name):
+    """
+    Yields (key, size) of every object under the prefix
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj['Key'], obj.get('Size', 0)
+
+
 def getObjectSize(object_name, bucket_name=bucket_name):
     try:
         return s3_client.head_object(
@@ -146,6 +219,23 @@ def getObjectSize(object_name, bucket_name=bucket_name):
         return None
 
 
+def getObjectETag(object_name, bucket_name=bucket_name):
+    try:
+        return s3_client.head_object(
+            Bucket=bucket_name, Key=object_name).get('ETag')
+    except Exception:
+        return None
+
+
+def readS3ObjectWithETag(object_name, fp, bucket_name=bucket_name):
+    """
+    Download the object into fp, returns the ETag of the version that was read
+    """
+    response = s3_client.get_object(Bucket=bucket_name, Key=object_name)
+    shutil.copyfileobj(response['Body'], fp)
+    return response['ETag']
+
+
 def checkObjectExists(object_name, bucket_name=bucket_name):
     try:
         s3_resource.Object(bucket_name, object_name).load()
@@ -2,6 +2,7 @@
 import os
 from celery import Celery
 from celery.schedules import crontab
+from celery.signals import worker_process_init
 from django.conf import settings
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'webserver.settings')
@@ -22,6 +23,33 @@ celery_app.conf.task_routes = {
 }
 
 
+@worker_process_init.connect
+def warm_up_pdal(**kwargs):
+    # Pay for the pdal / numpy / scipy imports at boot instead of on the first LiDAR request
+    from mmwave.lidar_utils.pdal_service import pdal_service
+    try:
+        pdal_service.warmUp()
+    except ImportError:
+        pass
+
+
+@worker_process_init.connect
+def warm_up_boundary_index(**kwargs):
+    import logging
+    from mmwave.lidar_utils.boundary_index import point_cloud_boundary_index
+    try:
+        point_cloud_boundary_index.warmUp()
+    except Exception:
+        logging.exception('failed to load point cloud boundary index')
+
+
+@worker_process_init.connect
+def schedule_progressive_lidar_cleanup(**kwargs):
+    # The scratch store is local to the host, every worker process schedules the cleanup
+    from mmwave.lidar_utils.progressive_lidar import progressive_point_store
+    progressive_point_store.scheduleCleanup()
+
+
 # These are all the tasks we want to run periodically
 @celery_app.on_after_finalize.connect
 def setup_periodic(sender, **kwargs):
@@ -42,6 +42,16 @@ admin.site.register(models.EPTLidarPointCloud, EPTLidarPointCloudAdmin)
 admin.site.register(models.USGSLidarMetaDataModel)
 
 
+@admin.register(models.DSMTilingJob)
+class DSMTilingJobAdmin(admin.ModelAdmin):
+    list_display = [
+        'cld', 'status', 'demand', 'last_requested', 'blocks_total', 'blocks_dispatched', 'blocks_done', 'blocks_failed',
+        'tiles_created', 'attempts', 'started', 'finished',
+    ]
+    list_filter = ['status']
+    raw_id_fields = ['cld']
+
+
 class LidarDatasets(models.EPTLidarPointCloud):
     class Meta:
         proxy = True
@@ -0,0 +1,455 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+"""
+Offline benchmarks of the LiDAR and viewshed engines
+
+Runs the engines against a synthetic point cloud and its DSM tiles (see `synthetic`), served
+from local stand-ins for S3 and the EPT buckets (see `local_s3`). Every database row created
+by a run is rolled back.
+
+Stages
+------
+profile     LidarEngine link profile, per link length, resolution and profile source
+dsm_tile    DSMEngine rendering the zoom 17 DSM tile at the center from the point cloud
+dsm_mosaic  DSMTileEngine virtual mosaic and materialized GeoTIFF of a circle, per radius
+viewshed    Viewshed.calculateViewshed of a sector, per radius (includes the mosaic and tiling)
+tiling      the tiling and tile upload part of the viewshed
+coverage    calculateSectorCoverage of the synthetic buildings inside the sector
+tile_encoding  encode and decode time per DSM tile and bytes per tile of every DSM_TILE_ENCODINGS
+
+The EPT chunk cache starts empty, the first runs of a stage include the chunk downloads.
+"""
+import contextlib
+import datetime
+import json
+import logging
+import math
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import uuid
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.gis.geos import GEOSGeometry, LineString, Point, Polygon
+from django.db import transaction
+
+from celery_async import celery_app
+from mmwave.benchmarks.local_s3 import LocalEPTServer, LocalS3
+from mmwave.benchmarks.synthetic import DEFAULT_DENSITY, DEFAULT_SEED, getSyntheticDataset
+from mmwave.lidar_utils import SlippyTiles
+from mmwave.lidar_utils.boundary_index import point_cloud_boundary_index
+from mmwave.lidar_utils.DSMEngine import DSMEngine
+from mmwave.lidar_utils.DSMTileEngine import DSMTileEngine, USE_OLD_TILES
+from mmwave.lidar_utils.dsm_profile import createDSMProfileSource
+from mmwave.lidar_utils.dsm_tile_cache import dsm_tile_cache
+from mmwave.lidar_utils.dsm_encoding import DSM_NODATA, DSM_TILE_ENCODINGS, readDSMBand, writeDSMTile
+from mmwave.lidar_utils.ept_cache import ept_chunk_cache
+from mmwave.lidar_utils.LidarEngine import LidarEngine, LidarResolution, LIDAR_RESOLUTION_DEFAULTS
+from mmwave.lidar_utils.progressive_lidar import createProgressiveProfileSource
+from mmwave.models import EPTLidarPointCloud, LidarDSMTileModel
+from mmwave.tasks.link_tasks import DSM_PROFILE_RESOLUTIONS, MAXIMUM_NUM_POINTS_RETURNED
+from workspace import models as workspace_models
+from workspace.tasks import sector_tasks
+from workspace.utils.geojson_circle import createGeoJSONCircle
+
+# Bump when the layout of the results changes
+RESULTS_FORMAT_VERSION = 1
+STAGES = ('profile', 'dsm_tile', 'dsm_mosaic', 'viewshed', 'tiling', 'coverage', 'tile_encoding')
+PROFILE_RESOLUTIONS = (LidarResolution.LOW, LidarResolution.MEDIUM, LidarResolution.HIGH)
+DEFAULT_LINK_LENGTHS_M = (100, 500, 2000)
+DEFAULT_RADII_M = (250, 500, 1000)
+DEFAULT_REPEAT = 3
+DEFAULT_BUILDINGS = 200
+# A stage is reported as a regression when its median is this many times the baseline's
+DEFAULT_REGRESSION_THRESHOLD = 1.2
+# Synthetic data extends this far past the longest link and the largest sector
+FIXTURE_MARGIN_M = 200
+BENCHMARK_CLOUD_NAME = 'ISPToolbox_Benchmark_2021'
+BENCHMARK_EPT_URL = 'https://benchmarks.isptoolbox.local/{}/ept.json'
+AP_HEIGHT_M = 30.
+SECTOR_HEADING = 45.
+SECTOR_AZIMUTH = 120.
+
+
+class BenchmarkRunner:
+    """
+    Times the engines on a synthetic dataset
+
+    Attributes
+    ----------
+    data_directory : str
+        directory the synthetic fixtures are generated into and reused from
+    link_lengths : tuple
+        link lengths (meters) of the profile stage
+    radii : tuple
+        radii (meters) of the mosaic, viewshed, tiling and coverage stages
+    repeat : int
+        number of runs of every measurement
+    """
+
+    def __init__(
+        self, data_directory: str, stages: tuple = STAGES, link_lengths: tuple = DEFAULT_LINK_LENGTHS_M,
+        radii: tuple = DEFAULT_RADII_M, repeat: int = DEFAULT_REPEAT, density: float = DEFAULT_DENSITY,
+        seed: int = DEFAULT_SEED, buildings: int = DEFAULT_BUILDINGS
+    ):
+        self.data_directory = data_directory
+        self.stages = stages
+        self.link_lengths = link_lengths
+        self.radii = radii
+        self.repeat = repeat
+        self.density = density
+        self.seed = seed
+        self.buildings = buildings
+        self.results = []
+
+    def run(self) -> dict:
+        """
+        Run the selected stages and return the report, see `createReport`
+        """
+        half_width = max(max(self.radii, default=0), max(self.link_lengths, default=0) / 2.) + FIXTURE_MARGIN_M
+        start = time.time()
+        dataset = getSyntheticDataset(self.data_directory, half_width, density=self.density, seed=self.seed)
+        logging.info(f'benchmark fixture ready in {time.time() - start:.3f}s: {dataset.directory}')
+
+        self.results = []
+        with contextlib.ExitStack() as stack:
+            tmp_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            local_s3 = stack.enter_context(LocalS3(os.path.join(tmp_dir, 's3')))
+            ept_server = stack.enter_context(LocalEPTServer(ept_chunk_cache, os.path.join(tmp_dir, 'lidar_cache')))
+            stack.enter_context(mock.patch.object(dsm_tile_cache, 'directory', os.path.join(tmp_dir, 'lidar_cache')))
+            stack.enter_context(self._offline(dataset))
+            with transaction.atomic():
+                try:
+                    cloud = self._createCloud(dataset, local_s3, ept_server)
+                    self._runStages(dataset, cloud)
+                finally:
+                    transaction.set_rollback(True)
+                    point_cloud_boundary_index.invalidate()
+        return createReport(self.results, {
+            'stages': list(self.stages),
+            'link_lengths_m': list(self.link_lengths),
+            'radii_m': list(self.radii),
+            'repeat': self.repeat,
+            'buildings': self.buildings,
+        }, dataset.params)
+
+    def _runStages(self, dataset, cloud):
+        if 'profile' in self.stages:
+            self._benchmarkProfile(dataset)
+        if 'dsm_tile' in self.stages:
+            self._benchmarkDSMTile(dataset, cloud)
+        if 'dsm_mosaic' in self.stages:
+            self._benchmarkDSMMosaic(dataset)
+        if any(stage in self.stages for stage in ('viewshed', 'tiling', 'coverage')):
+            self._benchmarkViewshed(dataset)
+        if 'tile_encoding' in self.stages:
+            self._benchmarkTileEncoding(dataset)
+
+    @contextlib.contextmanager
+    def _offline(self, dataset):
+        """
+        Replace the calls to external services on the benchmarked paths
+        """
+        def getDTMPoint(pt):
+            pt_T = Point(pt.x, pt.y, srid=pt.srid or 4326).transform(3857, clone=True)
+            return float(dataset.surface.ground(pt_T.x, pt_T.y))
+
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(mock.patch.object(workspace_models.viewshed_models, 'getDTMPoint', getDTMPoint))
+            stack.enter_context(mock.patch.object(workspace_models.network_models, 'getDTMPoint', getDTMPoint))
+            # Saving access points and sectors queues celery tasks and websocket messages
+            stack.enter_context(mock.patch.object(celery_app, 'send_task'))
+            stack.enter_context(mock.patch.object(sector_tasks, 'sendMessageToChannel'))
+            yield
+
+    def _createCloud(self, dataset, local_s3, ept_server):
+        """
+        Create the point cloud of the dataset and publish its DSM tiles
+        """
+        fixture_id = os.path.basename(dataset.directory)
+        cloud = EPTLidarPointCloud(
+            name=BENCHMARK_CLOUD_NAME,
+            count=dataset.points,
+            url=BENCHMARK_EPT_URL.format(fixture_id),
+            srs=3857,
+            boundary=dataset.boundary,
+        )
+        cloud.save()
+        ept_server.register(cloud.url, dataset.ept_directory)
+        point_cloud_boundary_index.invalidate()
+
+        zoom = SlippyTiles.DEFAULT_OUTPUT_ZOOM
+        # Same prefix in production and in local environments (see `findPointCloudPrefix`)
+        os.makedirs(local_s3.path(f'dsm/tiles/{cloud.pk}-{cloud.name}'), exist_ok=True)
+        tiles = []
+        for x, y in dataset.tiles:
+            key = cloud.get_s3_key_tile(x, y, zoom, old_path=USE_OLD_TILES)
+            local_s3.put(key, dataset.tilePath(x, y))
+            tiles.append(LidarDSMTileModel(cld=cloud, zoom=zoom, x=x, y=y, tile=key))
+        LidarDSMTileModel.objects.bulk_create(tiles)
+        return cloud
+
+    def _benchmarkProfile(self, dataset):
+        for length in self.link_lengths:
+            link = self._createLink(dataset, length)
+            for resolution in PROFILE_RESOLUTIONS:
+                sources = ['ept'] + (['dsm'] if resolution in DSM_PROFILE_RESOLUTIONS else [])
+                for source in sources:
+                    def profile():
+                        profile_source = createProgressiveProfileSource(LIDAR_RESOLUTION_DEFAULTS[resolution])
+                        if source == 'dsm':
+                            profile_source = createDSMProfileSource(profile_source)
+                        LidarEngine(
+                            link=link.clone(),
+                            resolution=LIDAR_RESOLUTION_DEFAULTS[resolution],
+                            num_samples=MAXIMUM_NUM_POINTS_RETURNED,
+                            profile_source=profile_source
+                        )
+                    self._measure('profile', {
+                        'link_length_m': length,
+                        'resolution': resolution.name,
+                        'source': source,
+                    }, profile)
+
+    def _benchmarkDSMTile(self, dataset, cloud):
+        zoom = SlippyTiles.DEFAULT_OUTPUT_ZOOM
+        x, y = SlippyTiles.deg2num(dataset.center.y, dataset.center.x, zoom)
+        boundary = SlippyTiles.getBoundaryofTile(x, y, zoom)
+
+        def render():
+            with tempfile.NamedTemporaryFile(suffix='.tif') as tmp_tif:
+                DSMEngine(boundary, [cloud]).getDSM(1.0, tmp_tif.name)
+        self._measure('dsm_tile', {'zoom': zoom}, render)
+
+    def _benchmarkDSMMosaic(self, dataset):
+        for radius in self.radii:
+            aoi = GEOSGeometry(json.dumps(createGeoJSONCircle(dataset.center, radius / 1000.)))
+
+            def mosaic():
+                with DSMTileEngine(aoi, EPTLidarPointCloud.query_intersect_aoi(aoi)).mosaic():
+                    pass
+
+            def materialized():
+                with tempfile.NamedTemporaryFile(suffix='.tif') as tmp_tif:
+                    DSMTileEngine(aoi, EPTLidarPointCloud.query_intersect_aoi(aoi)).getDSM(tmp_tif.name)
+            self._measure('dsm_mosaic', {'radius_m': radius, 'output': 'vrt'}, mosaic)
+            self._measure('dsm_mosaic', {'radius_m': radius, 'output': 'geotiff'}, materialized)
+
+    def _benchmarkTileEncoding(self, dataset):
+        """
+        Re-encode the fixture's DSM tiles in every encoding, runs are per tile
+        """
+        # Lazy Import To Improve Start Time
+        import numpy as np
+        import rasterio
+
+        tiles = []
+        for x, y in dataset.tiles:
+            with rasterio.open(dataset.tilePath(x, y)) as src:
+                tiles.append((readDSMBand(src), src.transform, src.crs))
+        if len(tiles) == 0:
+            return
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for encoding in DSM_TILE_ENCODINGS:
+                filenames = [os.path.join(tmp_dir, f'{encoding}-{i}.tif') for i in range(len(tiles))]
+
+                def encode():
+                    for filename, (band, transform, crs) in zip(filenames, tiles):
+                        writeDSMTile(filename, band, transform, crs, encoding=encoding)
+
+                def decode():
+                    for filename in filenames:
+                        with rasterio.open(filename) as src:
+                            readDSMBand(src)
+
+                params = {'encoding': encoding, 'tiles': len(tiles)}
+                self._measure('tile_encoding', dict(params, operation='encode'), encode, per=len(tiles))
+                self._measure('tile_encoding', dict(params, operation='decode'), decode, per=len(tiles))
+                max_error = 0.
+                for filename, (band, _, _) in zip(filenames, tiles):
+                    with rasterio.open(filename) as src:
+                        valid = band > DSM_NODATA
+                        max_error = max(max_error, float(np.abs(readDSMBand(src)[valid] - band[valid]).max(initial=0.)))
+                self.results[-1].update({
+                    'bytes_per_tile': statistics.mean(os.path.getsize(filename) for filename in filenames),
+                    'max_error_m': max_error,
+                })
+
+    def _benchmarkViewshed(self, dataset):
+        user = get_user_model().objects.create_user(
+            email=f'benchmark-{uuid.uuid4()}@isptoolbox.io', password=None,
+            first_name='benchmark', last_name='benchmark'
+        )
+        session = workspace_models.WorkspaceMapSession(owner=user, name=f'benchmark-{uuid.uuid4()}')
+        session.save()
+        for radius in self.radii:
+            sector = self._createSector(dataset, user, session, radius)
+            viewshed = sector.viewshed
+            params = {'radius_m': radius}
+
+            tiling = []
+            with _timedMethod(workspace_models.Viewshed, '_Viewshed__createTileset', tiling):
+                if 'viewshed' in self.stages or 'tiling' in self.stages:
+                    self._measure('viewshed', params, viewshed.calculateViewshed, setup=viewshed.delete_tiles)
+                else:
+                    # Coverage reads the viewshed
+                    viewshed.calculateViewshed()
+            if 'tiling' in self.stages:
+                self._record('tiling', params, tiling)
+            if 'coverage' in self.stages:
+                self._benchmarkCoverage(dataset, sector, params)
+
+    def _benchmarkCoverage(self, dataset, sector, params):
+        coverage = sector.building_coverage
+        area = sector.geojson
+        buildings = []
+        for bounds, _ in dataset.surface.footprints():
+            footprint = Polygon.from_bbox(bounds)
+            footprint.srid = 3857
+            footprint = footprint.transform(4326, clone=True)
+            if area.intersects(footprint):
+                buildings.append(workspace_models.BuildingCoverage(coverage=coverage, geog=footprint))
+            if len(buildings) >= self.buildings:
+                break
+        workspace_models.BuildingCoverage.objects.bulk_create(buildings)
+        self._measure(
+            'coverage', dict(params, buildings=len(buildings)),
+            lambda: sector_tasks.calculateSectorCoverage(sector, coverage)
+        )
+
+    def _createSector(self, dataset, user, session, radius):
+        ap = workspace_models.AccessPointLocation(
+            owner=user, map_session=session, geojson=dataset.center, height=AP_HEIGHT_M, max_radius=radius / 1000.
+        )
+        ap.save()
+        sector = workspace_models.AccessPointSector(
+            owner=user, map_session=session, ap=ap, height=AP_HEIGHT_M,
+            heading=SECTOR_HEADING, azimuth=SECTOR_AZIMUTH, radius=radius / 1000.
+        )
+        # Creates the viewshed and the building coverage
+        sector.save()
+        sector.refresh_from_db()
+        return sector
+
+    @staticmethod
+    def _createLink(dataset, length):
+        """
+        Link of `length` ground meters through the center of the dataset
+        """
+        center = dataset.center.transform(3857, clone=True)
+        # EPSG:3857 units stretch with latitude
+        half = length / 2. / math.cos(math.radians(dataset.center.y)) / math.sqrt(2.)
+        link = LineString([(center.x - half, center.y - half), (center.x + half, center.y + half)], srid=3857)
+        return link.transform(4326, clone=True)
+
+    def _measure(self, stage, params, fn, setup=None, per=1):
+        """
+        Time `repeat` runs of `fn`, stops at the first error
+
+        per - number of items a run processes, runs are recorded per item
+        """
+        runs = []
+        error = None
+        for _ in range(self.repeat):
+            try:
+                # A failed run must not abort the outer transaction
+                with transaction.atomic():
+                    if setup is not None:
+                        setup()
+                    start = time.perf_counter()
+                    fn()
+                    runs.append((time.perf_counter() - start) / per)
+            except Exception as e:
+                logging.exception(f'benchmark {stage} {params} failed')
+                error = repr(e)
+                break
+        self._record(stage, params, runs, error)
+
+    def _record(self, stage, params, runs, error=None):
+        result = {
+            'stage': stage,
+            'params': params,
+            'runs': runs,
+            'min': min(runs) if runs else None,
+            'median': statistics.median(runs) if runs else None,
+            'mean': statistics.mean(runs) if runs else None,
+            'error': error,
+        }
+        logging.info(f'benchmark {stage} {params}: {result["median"]}s')
+        self.results.append(result)
+
+
+@contextlib.contextmanager
+def _timedMethod(cls, name, durations):
+    """
+    Append the duration of every call of the method to `durations`
+    """
+    original = getattr(cls, name)
+
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            durations.append(time.perf_counter() - start)
+
+    with mock.patch.object(cls, name, timed):
+        yield
+
+
+def _gitCommit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, encoding='UTF-8', stderr=subprocess.DEVNULL
+        ).strip()
+    except Exception:
+        return None
+
+
+def createReport(results: list, config: dict, fixture: dict) -> dict:
+    """
+    Machine readable report of a run, compare reports of two commits with `compareReports`
+    """
+    return {
+        'format': RESULTS_FORMAT_VERSION,
+        'commit': _gitCommit(),
+        'created': datetime.datetime.utcnow().isoformat(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'config': config,
+        'fixture': {k: v for k, v in fixture.items() if k != 'tiles'},
+        'results': results,
+    }
+
+
+def compareReports(baseline: dict, current: dict, threshold: float = DEFAULT_REGRESSION_THRESHOLD) -> list:
+    """
+    Compare the median of every measurement in both reports
+
+    Returns:
+        [{stage, params, baseline, current, ratio, regression}], ratio is current / baseline
+    """
+    def key(result):
+        return result['stage'], json.dumps(result['params'], sort_keys=True)
+
+    baseline_results = {key(result): result for result in baseline.get('results', [])}
+    comparison = []
+    for result in current.get('results', []):
+        previous = baseline_results.get(key(result))
+        if previous is None or not previous['median'] or result['median'] is None:
+            continue
+        ratio = result['median'] / previous['median']
+        comparison.append({
+            'stage': result['stage'],
+            'params': result['params'],
+            'baseline': previous['median'],
+            'current': result['median'],
+            'ratio': ratio,
+            'regression': ratio > threshold,
+        })
+    return comparison
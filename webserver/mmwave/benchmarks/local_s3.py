@@ -0,0 +1,207 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+"""
+File-based stand-ins for S3 and the remote EPT buckets, used to run the benchmarks offline
+"""
+import contextlib
+import hashlib
+import importlib
+import os
+import shutil
+from unittest import mock
+
+from IspToolboxApp.util import s3
+
+# Modules that import the s3 helpers by name
+S3_CLIENT_MODULES = (
+    'IspToolboxApp.util.s3',
+    'mmwave.lidar_utils.DSMTileEngine',
+    'mmwave.lidar_utils.dsm_profile',
+    'workspace.models.viewshed_models',
+)
+S3_HELPERS = (
+    'readMultipleS3Objects',
+    'writeMultipleS3Objects',
+    'streamS3Objects',
+    'readS3Object',
+    'readFromS3',
+    'writeS3Object',
+    'deleteS3Object',
+    'deleteMultipleS3Objects',
+    'getObjectSize',
+    'checkObjectExists',
+    'findPointCloudPrefix',
+    'listObjects',
+    'getObjectETag',
+    'readS3ObjectWithETag',
+)
+
+
+class LocalS3:
+    """
+    Serves the S3 helpers of `IspToolboxApp.util.s3` from a local directory
+
+    Objects live at <directory>/<bucket>/<key>. While the context is active the helpers are
+    replaced by methods with the same signatures, in `s3` and in every module of
+    S3_CLIENT_MODULES that imported them.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._patches = None
+
+    def path(self, key: str, bucket_name: str = s3.bucket_name) -> str:
+        return os.path.join(self.directory, bucket_name, key)
+
+    def put(self, key: str, filename: str, bucket_name: str = s3.bucket_name):
+        """
+        Publish a local file under `key`, linked instead of copied when possible
+        """
+        path = self.path(key, bucket_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.lexists(path):
+            os.remove(path)
+        try:
+            os.symlink(os.path.abspath(filename), path)
+        except OSError:
+            shutil.copyfile(filename, path)
+
+    def __enter__(self):
+        self._patches = contextlib.ExitStack()
+        for name in S3_CLIENT_MODULES:
+            module = importlib.import_module(name)
+            for helper in S3_HELPERS:
+                if hasattr(module, helper):
+                    self._patches.enter_context(mock.patch.object(module, helper, getattr(self, helper)))
+        return self
+
+    def __exit__(self, *exc):
+        self._patches.close()
+        self._patches = None
+
+    def readMultipleS3Objects(self, keys, filenames, bucket_name=s3.bucket_name):
+        # Like the s3 helper, objects that fail to download are skipped
+        for key, filename in zip(keys, filenames):
+            try:
+                shutil.copyfile(self.path(key, bucket_name), filename)
+            except OSError:
+                pass
+
+    def writeMultipleS3Objects(self, keys, filenames, bucket_name=s3.bucket_name):
+        failed = []
+        for key, filename in zip(keys, filenames):
+            try:
+                path = self.path(key, bucket_name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                shutil.copyfile(filename, path)
+            except OSError:
+                failed.append(key)
+        return failed
+
+    def streamS3Objects(self, objects, bucket_name=s3.bucket_name, max_pending=None):
+        for key, data in objects:
+            yield key, self.writeS3Object(key, data, bucket_name)
+
+    def readS3Object(self, object_name, fp, bucket_name=s3.bucket_name):
+        with open(self.path(object_name, bucket_name), 'rb') as f:
+            shutil.copyfileobj(f, fp)
+        fp.flush()
+
+    def readFromS3(self, object_name, fp, bucket_name=s3.bucket_name):
+        self.readS3Object(object_name, fp, bucket_name)
+
+    def writeS3Object(self, object_name, data, bucket_name=s3.bucket_name):
+        path = self.path(object_name, bucket_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            if isinstance(data, (bytes, bytearray)):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f)
+        return True
+
+    def deleteS3Object(self, key, bucket_name=s3.bucket_name):
+        try:
+            os.remove(self.path(key, bucket_name))
+        except OSError:
+            return False
+        return True
+
+    def deleteMultipleS3Objects(self, keys, bucket_name=s3.bucket_name):
+        # Like DeleteObjects, missing keys are not errors
+        for key in keys:
+            self.deleteS3Object(key, bucket_name)
+        return []
+
+    def getObjectSize(self, object_name, bucket_name=s3.bucket_name):
+        try:
+            return os.path.getsize(self.path(object_name, bucket_name))
+        except OSError:
+            return None
+
+    def checkObjectExists(self, object_name, bucket_name=s3.bucket_name):
+        return os.path.exists(self.path(object_name, bucket_name))
+
+    def listObjects(self, prefix: str, bucket_name=s3.bucket_name):
+        root = os.path.join(self.directory, bucket_name)
+        for directory, _, files in os.walk(self.path(prefix.rsplit('/', 1)[0], bucket_name)):
+            for name in sorted(files):
+                key = os.path.relpath(os.path.join(directory, name), root)
+                if key.startswith(prefix):
+                    yield key, os.path.getsize(os.path.join(directory, name))
+
+    def getObjectETag(self, object_name, bucket_name=s3.bucket_name):
+        try:
+            with open(self.path(object_name, bucket_name), 'rb') as f:
+                return f'"{hashlib.md5(f.read()).hexdigest()}"'
+        except OSError:
+            return None
+
+    def readS3ObjectWithETag(self, object_name, fp, bucket_name=s3.bucket_name):
+        etag = self.getObjectETag(object_name, bucket_name)
+        if etag is None:
+            raise FileNotFoundError(object_name)
+        self.readS3Object(object_name, fp, bucket_name)
+        return etag
+
+    def findPointCloudPrefix(self, prefix: str, name: str):
+        directory = self.path(prefix)
+        if os.path.isdir(directory):
+            for entry in sorted(os.listdir(directory)):
+                if name in entry:
+                    return f'{prefix}{entry}/'
+        return ''
+
+
+class LocalEPTServer:
+    """
+    Serves EPT datasets from local directories in place of their remote urls
+
+    While active, the EPT chunk cache downloads `<base url>/<path>` from `<directory>/<path>`
+    of the registered dataset and keeps its chunks in `cache_directory`.
+    """
+
+    def __init__(self, cache, cache_directory: str):
+        self.cache = cache
+        self.cache_directory = cache_directory
+        self.datasets = {}
+        self._patches = None
+
+    def register(self, url: str, directory: str):
+        self.datasets[url.rsplit('/', 1)[0] + '/'] = directory
+
+    def __enter__(self):
+        self._patches = contextlib.ExitStack()
+        self._patches.enter_context(mock.patch.object(self.cache, 'directory', self.cache_directory))
+        self._patches.enter_context(mock.patch.object(self.cache, '_download', self._download))
+        return self
+
+    def __exit__(self, *exc):
+        self._patches.close()
+        self._patches = None
+
+    def _download(self, url: str) -> bytes:
+        for base_url, directory in self.datasets.items():
+            if url.startswith(base_url):
+                with open(os.path.join(directory, url[len(base_url):]), 'rb') as f:
+                    return f.read()
+        raise FileNotFoundError(url)
@@ -0,0 +1,360 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+"""
+Deterministic synthetic LiDAR fixtures for the benchmarks
+
+A square of rolling terrain with box buildings on a regular grid, rendered both as an EPT
+point cloud (the layout readers.ept and EPTChunkCache read) and as the zoom 17 DSM GeoTIFF
+tiles `convertPtCloudToDSMTiled` produces. A fixture is generated once per parameter set into
+the data directory and reused by later runs, the same parameters always produce the same data.
+
+layout: <data directory>/<fixture id>/{fixture.json,ept/,tiles/<x>/<y>.tif}
+"""
+import hashlib
+import json
+import math
+import os
+import shutil
+
+from django.contrib.gis.geos import Point, Polygon
+
+from mmwave.lidar_utils import SlippyTiles
+from mmwave.lidar_utils.ept_cache import EPTChunkCache
+
+# Bump when the generated data changes, fixtures of older versions are regenerated
+FIXTURE_VERSION = 1
+# Same area as the viewshed tests: (lon, lat)
+DEFAULT_CENTER = (-90.53717, 33.54512)
+DEFAULT_SEED = 1
+DEFAULT_DENSITY = 1.0  # points per square meter of EPSG:3857
+EPT_SPAN = 256
+# Finest readers.ept resolution the octree is built for (LidarResolution.HIGH)
+EPT_FINEST_RESOLUTION = 1.0
+EPT_SCALE = 0.01
+BUILDING_GRID_M = 40.
+BUILDING_SIZE_M = 18.
+BUILDING_PROBABILITY = 0.35
+# Real DSM tiles are rendered over the tile boundary plus SlippyTiles.BUFFER_TILE (~5m)
+TILE_PADDING_M = 5.
+DSM_RESOLUTION_M = 1.
+# writers.gdal default nodata value
+DSM_NODATA = -9999
+LAS_CLASSIFICATION_GROUND = 2
+LAS_CLASSIFICATION_BUILDING = 6
+
+
+class SyntheticSurface:
+    """
+    Rolling terrain with box buildings on a regular grid, heights in meters
+
+    Attributes
+    ----------
+    bounds : tuple
+        (xmin, ymin, xmax, ymax) in EPSG:3857
+    seed : int
+        seed of the building heights
+    """
+
+    def __init__(self, bounds: tuple, seed: int = DEFAULT_SEED):
+        # Lazy Import To Improve Start Time
+        import numpy as np
+
+        self.bounds = bounds
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        columns = int(math.ceil((bounds[2] - bounds[0]) / BUILDING_GRID_M))
+        rows = int(math.ceil((bounds[3] - bounds[1]) / BUILDING_GRID_M))
+        heights = rng.uniform(4., 20., (rows, columns))
+        self.building_heights = np.where(rng.random((rows, columns)) < BUILDING_PROBABILITY, heights, 0.)
+
+    def ground(self, xs, ys):
+        # Lazy Import To Improve Start Time
+        import numpy as np
+
+        xs = np.asarray(xs, dtype=np.float64) - self.bounds[0]
+        ys = np.asarray(ys, dtype=np.float64) - self.bounds[1]
+        return 60. + 12. * np.sin(xs / 450.) * np.cos(ys / 650.)
+
+    def buildings(self, xs, ys):
+        """
+        Height of the building above the ground at each point, 0 outside of buildings
+        """
+        # Lazy Import To Improve Start Time
+        import numpy as np
+
+        gx = (np.asarray(xs, dtype=np.float64) - self.bounds[0]) / BUILDING_GRID_M
+        gy = (np.asarray(ys, dtype=np.float64) - self.bounds[1]) / BUILDING_GRID_M
+        rows, columns = self.building_heights.shape
+        column = np.clip(np.floor(gx).astype(np.int64), 0, columns - 1)
+        row = np.clip(np.floor(gy).astype(np.int64), 0, rows - 1)
+        inside = (
+            ((gx - np.floor(gx)) * BUILDING_GRID_M < BUILDING_SIZE_M) &
+            ((gy - np.floor(gy)) * BUILDING_GRID_M < BUILDING_SIZE_M)
+        )
+        return np.where(inside, self.building_heights[row, column], 0.)
+
+    def height(self, xs, ys):
+        return self.ground(xs, ys) + self.buildings(xs, ys)
+
+    def footprints(self):
+        """
+        Returns [(footprint bounds in EPSG:3857, height)] of every building
+        """
+        footprints = []
+        for row, column in zip(*self.building_heights.nonzero()):
+            xmin = self.bounds[0] + column * BUILDING_GRID_M
+            ymin = self.bounds[1] + row * BUILDING_GRID_M
+            footprints.append((
+                (xmin, ymin, xmin + BUILDING_SIZE_M, ymin + BUILDING_SIZE_M),
+                float(self.building_heights[row, column])
+            ))
+        return footprints
+
+
+class SyntheticDataset:
+    """
+    A generated fixture: the surface, its EPT dataset and its DSM tiles
+    """
+
+    def __init__(self, directory: str, params: dict):
+        self.directory = directory
+        self.params = params
+        self.center = Point(*params['center'], srid=4326)
+        self.bounds = tuple(params['bounds'])
+        self.surface = SyntheticSurface(self.bounds, params['seed'])
+        self.ept_directory = os.path.join(directory, 'ept')
+        self.tiles_directory = os.path.join(directory, 'tiles')
+        self.tiles = [tuple(tile) for tile in params.get('tiles', [])]
+        self.points = params.get('points', 0)
+
+    @property
+    def boundary(self) -> Polygon:
+        boundary = Polygon.from_bbox(self.bounds)
+        boundary.srid = 3857
+        return boundary.transform(4326, clone=True)
+
+    def tilePath(self, x: int, y: int) -> str:
+        return os.path.join(self.tiles_directory, str(x), f'{y}.tif')
+
+
+def getSyntheticDataset(
+    data_directory: str, half_width_m: float, center: tuple = DEFAULT_CENTER,
+    density: float = DEFAULT_DENSITY, seed: int = DEFAULT_SEED
+) -> SyntheticDataset:
+    """
+    Returns the fixture for the parameters, generating it on first use
+
+    Args:
+        data_directory: directory the fixtures are kept in
+        half_width_m: half the side of the square area around `center`, in ground meters
+        center: (lon, lat) of the area
+        density: points per square meter of the point cloud
+        seed: seed of the random parts of the data
+    """
+    center_T = Point(*center, srid=4326).transform(3857, clone=True)
+    # EPSG:3857 units stretch with latitude
+    half_width = half_width_m / math.cos(math.radians(center[1]))
+    params = {
+        'version': FIXTURE_VERSION,
+        'center': list(center),
+        'bounds': [center_T.x - half_width, center_T.y - half_width, center_T.x + half_width, center_T.y + half_width],
+        'density': density,
+        'seed': seed,
+    }
+    fixture_id = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    directory = os.path.join(data_directory, fixture_id)
+    manifest = os.path.join(directory, 'fixture.json')
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            return SyntheticDataset(directory, json.load(f))
+
+    # A previous generation might have been interrupted
+    shutil.rmtree(directory, ignore_errors=True)
+    dataset = SyntheticDataset(directory, params)
+    params['points'] = writeSyntheticEPT(dataset.ept_directory, dataset.surface, density)
+    params['tiles'] = writeSyntheticDSMTiles(dataset.tiles_directory, dataset.surface)
+    with open(manifest, 'w') as f:
+        json.dump(params, f)
+    return SyntheticDataset(directory, params)
+
+
+def writeSyntheticEPT(directory: str, surface: SyntheticSurface, density: float) -> int:
+    """
+    Write an EPT dataset sampling `surface` with `density` points per square meter
+
+    Like entwine, deeper octree nodes hold proportionally more points so coarser readers.ept
+    resolutions read fewer points. Returns the number of points written
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+    from rasterio.crs import CRS
+
+    rng = np.random.default_rng(surface.seed)
+    xmin, ymin, xmax, ymax = surface.bounds
+    count = int(density * (xmax - xmin) * (ymax - ymin))
+    xs = rng.uniform(xmin, xmax, count)
+    ys = rng.uniform(ymin, ymax, count)
+    buildings = surface.buildings(xs, ys)
+    zs = surface.ground(xs, ys) + buildings + rng.normal(0., 0.05, count)
+    classification = np.where(buildings > 0, LAS_CLASSIFICATION_BUILDING, LAS_CLASSIFICATION_GROUND)
+
+    width = max(xmax - xmin, ymax - ymin)
+    cube = [xmin, ymin, 0., xmin + width, ymin + width, width]
+    depth_end = EPTChunkCache._depthEnd({'bounds': cube, 'span': EPT_SPAN}, EPT_FINEST_RESOLUTION)
+    weights = 4. ** np.arange(depth_end)
+    depths = rng.choice(depth_end, count, p=weights / weights.sum())
+    nodes = _nodeKeys(cube, depths, xs, ys, zs)
+    # readers.ept walks the hierarchy from the root, every ancestor of a node has to exist
+    xs, ys, zs, classification, nodes = _addMissingAncestors(cube, surface, nodes, xs, ys, zs, classification)
+
+    data_directory = os.path.join(directory, 'ept-data')
+    os.makedirs(data_directory, exist_ok=True)
+    os.makedirs(os.path.join(directory, 'ept-hierarchy'), exist_ok=True)
+    offset = [(cube[0] + cube[3]) / 2., (cube[1] + cube[4]) / 2., (cube[2] + cube[5]) / 2.]
+    keys, inverse = np.unique(nodes, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind='stable')
+    splits = np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1]
+    hierarchy = {}
+    for key, indices in zip(keys, np.split(order, splits)):
+        name = '-'.join(str(int(v)) for v in key)
+        _writeLaz(
+            os.path.join(data_directory, f'{name}.laz'),
+            xs[indices], ys[indices], zs[indices], classification[indices], offset
+        )
+        hierarchy[name] = int(len(indices))
+    with open(os.path.join(directory, 'ept-hierarchy', '0-0-0-0.json'), 'w') as f:
+        json.dump(hierarchy, f)
+
+    schema = [
+        {'name': axis, 'type': 'signed', 'size': 4, 'scale': EPT_SCALE, 'offset': value}
+        for axis, value in zip(('X', 'Y', 'Z'), offset)
+    ] + [{'name': 'Classification', 'type': 'unsigned', 'size': 1}]
+    info = {
+        'bounds': cube,
+        'boundsConforming': [xmin, ymin, float(zs.min()), xmax, ymax, float(zs.max())],
+        'dataType': 'laszip',
+        'hierarchyType': 'json',
+        'points': int(len(xs)),
+        'schema': schema,
+        'span': EPT_SPAN,
+        'srs': {'authority': 'EPSG', 'horizontal': '3857', 'wkt': CRS.from_epsg(3857).to_wkt()},
+        'version': '1.0.0',
+    }
+    with open(os.path.join(directory, 'ept.json'), 'w') as f:
+        json.dump(info, f)
+    return int(len(xs))
+
+
+def _nodeKeys(cube, depths, xs, ys, zs):
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    width = cube[3] - cube[0]
+    last = 2 ** depths - 1
+    size = width / 2. ** depths
+    return np.stack([
+        depths,
+        np.clip(((xs - cube[0]) / size).astype(np.int64), 0, last),
+        np.clip(((ys - cube[1]) / size).astype(np.int64), 0, last),
+        np.clip(((zs - cube[2]) / size).astype(np.int64), 0, last),
+    ], axis=1)
+
+
+def _addMissingAncestors(cube, surface, nodes, xs, ys, zs, classification):
+    """
+    Add one point at the center of every missing ancestor node
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    existing = set(map(tuple, np.unique(nodes, axis=0).tolist()))
+    missing = set()
+    for d, x, y, z in existing:
+        while d > 0:
+            d, x, y, z = d - 1, x // 2, y // 2, z // 2
+            if (d, x, y, z) not in existing:
+                missing.add((d, x, y, z))
+    if len(missing) == 0:
+        return xs, ys, zs, classification, nodes
+
+    width = cube[3] - cube[0]
+    extra = np.array(sorted(missing), dtype=np.int64)
+    size = width / 2. ** extra[:, 0]
+    extra_xs = cube[0] + (extra[:, 1] + 0.5) * size
+    extra_ys = cube[1] + (extra[:, 2] + 0.5) * size
+    # The point has to fall inside of the node, use the ground height clamped to the node
+    node_zmin = cube[2] + extra[:, 3] * size
+    extra_zs = np.clip(surface.ground(extra_xs, extra_ys), node_zmin, node_zmin + size - EPT_SCALE)
+    return (
+        np.concatenate([xs, extra_xs]),
+        np.concatenate([ys, extra_ys]),
+        np.concatenate([zs, extra_zs]),
+        np.concatenate([classification, np.full(len(extra), LAS_CLASSIFICATION_GROUND)]),
+        np.concatenate([nodes, extra]),
+    )
+
+
+def _writeLaz(filename, xs, ys, zs, classification, offset):
+    # Lazy Import To Improve Start Time
+    import numpy as np
+    import pdal
+
+    points = np.zeros(len(xs), dtype=[('X', '<f8'), ('Y', '<f8'), ('Z', '<f8'), ('Classification', 'u1')])
+    points['X'] = xs
+    points['Y'] = ys
+    points['Z'] = zs
+    points['Classification'] = classification
+    writer = {
+        'type': 'writers.las',
+        'filename': filename,
+        'compression': 'laszip',
+        'a_srs': 'EPSG:3857',
+        'scale_x': EPT_SCALE, 'scale_y': EPT_SCALE, 'scale_z': EPT_SCALE,
+        'offset_x': offset[0], 'offset_y': offset[1], 'offset_z': offset[2],
+    }
+    pdal.Pipeline(json.dumps([writer]), arrays=[points]).execute()
+
+
+def writeSyntheticDSMTiles(directory: str, surface: SyntheticSurface, zoom: int = SlippyTiles.DEFAULT_OUTPUT_ZOOM) -> list:
+    """
+    Write a DSM GeoTIFF for every tile of `zoom` that overlaps the surface, returns the tiles
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+    import rasterio
+    from rasterio.transform import from_origin
+
+    boundary = Polygon.from_bbox(surface.bounds)
+    boundary.srid = 3857
+    tiles = SlippyTiles.getTiles(boundary.transform(4326, clone=True), zoom)
+    for x, y in tiles:
+        tile_bounds = SlippyTiles.getBoundaryofTile(x, y, zoom).transform(3857, clone=True).extent
+        left, bottom = tile_bounds[0] - TILE_PADDING_M, tile_bounds[1] - TILE_PADDING_M
+        right, top = tile_bounds[2] + TILE_PADDING_M, tile_bounds[3] + TILE_PADDING_M
+        width = int(math.ceil((right - left) / DSM_RESOLUTION_M))
+        height = int(math.ceil((top - bottom) / DSM_RESOLUTION_M))
+        xs, ys = np.meshgrid(
+            left + (np.arange(width) + 0.5) * DSM_RESOLUTION_M,
+            top - (np.arange(height) + 0.5) * DSM_RESOLUTION_M,
+        )
+        band = surface.height(xs, ys)
+        outside = (
+            (xs < surface.bounds[0]) | (xs > surface.bounds[2]) | (ys < surface.bounds[1]) | (ys > surface.bounds[3])
+        )
+        band[outside] = DSM_NODATA
+
+        filename = os.path.join(directory, str(x), f'{y}.tif')
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        profile = {
+            'driver': 'GTiff',
+            'dtype': 'float32',
+            'count': 1,
+            'width': width,
+            'height': height,
+            'crs': 'EPSG:3857',
+            'transform': from_origin(left, top, DSM_RESOLUTION_M, DSM_RESOLUTION_M),
+            'nodata': DSM_NODATA,
+        }
+        with rasterio.open(filename, 'w', **profile) as dst:
+            dst.write(band.astype(np.float32), 1)
+    return [list(tile) for tile in tiles]
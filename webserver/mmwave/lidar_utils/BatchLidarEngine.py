@@ -0,0 +1,138 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+from mmwave.models import EPTLidarPointCloud
+from mmwave.lidar_utils.LidarEngine import (
+    LidarEngine, LidarEngineException, segmentLinkByPointClouds, DEFAULT_BB_BUFFER
+)
+from mmwave.lidar_utils.pdal_templates import (
+    queryLidarPoints, assignPointsToLinks, calculateProfileFromPoints
+)
+from django.contrib.gis.geos import MultiLineString, LineString
+from geopy.distance import distance as geopy_distance
+from geopy.distance import lonlat
+
+import logging
+
+
+class BatchLidarEngine:
+    """
+    Computes LiDAR profiles for many links at once
+
+    Links are grouped by the point clouds they intersect, each point cloud is read with a single
+    PDAL query over the union of the buffered link corridors and the points are then split back
+    out per link. Profiles match running a LidarEngine per link (up to the polygonal approximation
+    of the corridor buffer), but overlapping reads are only paid for once.
+
+    Attributes
+    ----------
+    links : List[LineString]
+        GEOS LineStrings (EPSG:4326) to compute profiles for
+    """
+
+    def __init__(self, links, resolution, num_samples, link_buffer=DEFAULT_BB_BUFFER):
+        self.links = links
+        for link in self.links:
+            link.srid = 4326
+        self.resolution = resolution
+        self.num_samples = num_samples
+        self.link_buffer = link_buffer
+        self.segments = self.__getRelevantPointClouds()
+        self.__segment_points = {}
+        self.__readPointClouds()
+        self.engines = self.__createEngines()
+
+    def getEngines(self):
+        """
+        Returns a LidarEngine for every link, None where no LiDAR data is available or the engine
+        of the link failed
+        """
+        return self.engines
+
+    def getProfiles(self):
+        """
+        Returns the LiDAR profile for every link, None where no LiDAR data is available or the
+        profile of the link failed
+        """
+        profiles = []
+        for link, le in zip(self.links, self.engines):
+            profile = None
+            if le is not None:
+                try:
+                    profile = le.getProfile()
+                except Exception:
+                    logging.exception(f'failed to calculate lidar profile {link.wkt}')
+            profiles.append(profile)
+        return profiles
+
+    def __getRelevantPointClouds(self):
+        """
+        Query the point clouds for all links at once, then split each link into segments
+        """
+        pt_clouds = list(EPTLidarPointCloud.query_intersect_aoi(MultiLineString(self.links, srid=4326)))
+        segments = []
+        for link in self.links:
+            link_clouds = [cloud for cloud in pt_clouds if self.__intersects(cloud, link)]
+            segments.append(segmentLinkByPointClouds(link, link_clouds))
+        return segments
+
+    @staticmethod
+    def __intersects(cloud, link):
+        boundary = getattr(cloud, 'prepared_boundary', None)
+        if boundary is None:
+            boundary = cloud.high_resolution_boundary if cloud.high_resolution_boundary is not None else cloud.boundary
+        return boundary.intersects(link)
+
+    def __readPointClouds(self):
+        """
+        Run one PDAL query per point cloud over all the link segments it covers
+        """
+        corridors = {}
+        for link_segments in self.segments:
+            for geometry, cloud in link_segments:
+                if cloud is None:
+                    continue
+                lines = list(geometry) if isinstance(geometry, MultiLineString) else [geometry]
+                corridors.setdefault(cloud.pk, (cloud, []))[1].extend(
+                    line for line in lines if isinstance(line, LineString) and not line.empty
+                )
+
+        for cloud, lines in corridors.values():
+            if len(lines) == 0:
+                continue
+            lines_T = [line.transform(cloud.srs, clone=True) for line in lines]
+            try:
+                arr, _ = queryLidarPoints(
+                    cloud.url, [line_T.buffer(self.link_buffer) for line_T in lines_T],
+                    cloud.srs, self.resolution, use_outlier_filter=cloud.noisy_data
+                )
+            except Exception:
+                logging.exception(f'failed to read point cloud {cloud.name} for {len(lines)} links')
+                continue
+            assignment = assignPointsToLinks(arr['X'], arr['Y'], lines_T, self.link_buffer)
+            for line, line_T, mask in zip(lines, lines_T, assignment):
+                self.__segment_points[(cloud.pk, line.wkt)] = (line_T, arr[mask])
+
+    def __getSegmentProfile(self, link, cloud, num_samples):
+        if cloud is None or (cloud.pk, link.wkt) not in self.__segment_points:
+            raise Exception('No LiDAR Points Found')
+        link_T, pts = self.__segment_points[(cloud.pk, link.wkt)]
+        if pts.shape[0] < 2:
+            raise Exception('No LiDAR Points Found')
+        link_length = geopy_distance(
+            lonlat(link[0][0], link[0][1]), lonlat(link[1][0], link[1][1])).meters
+        return calculateProfileFromPoints(
+            pts['X'], pts['Y'], pts['Z'], link_T, link_length, num_samples).tolist()
+
+    def __createEngines(self):
+        engines = []
+        for link, link_segments in zip(self.links, self.segments):
+            try:
+                engines.append(LidarEngine(
+                    link, self.resolution, self.num_samples,
+                    segments=link_segments, profile_source=self.__getSegmentProfile
+                ))
+            except LidarEngineException:
+                engines.append(None)
+            except Exception:
+                logging.exception(f'failed to create lidar engine {link.wkt}')
+                engines.append(None)
+        return engines
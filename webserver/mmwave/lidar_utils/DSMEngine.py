@@ -1,13 +1,23 @@
 # (c) Meta Platforms, Inc. and affiliates. Copyright
-import subprocess
-import shlex
+import concurrent.futures
+import logging
+import os
 import shutil
-import tempfile
+import time
 from typing import Iterator
 
 from django.contrib.gis.geos.geometry import GEOSGeometry
 from mmwave.lidar_utils.SlippyTiles import addBufferToPolygon
+from mmwave.lidar_utils.ept_cache import getCachedEPTPath
+from mmwave.lidar_utils.pdal_service import pdal_service, getPipelineTemplate, getFilterSet, PDALScratchDirectory
 from mmwave.models import EPTLidarPointCloud
+from workspace.utils.process_utils import celery_task_subprocess_check_output_wrapper
+
+# DSM exports can cover large areas, allow much more time than link profiles
+DSM_PIPELINE_TIMEOUT_S = 30 * 60
+DSM_OUTPUT_GDALOPTS = 'COMPRESS=DEFLATE,ZLEVEL=9'
+# Rasters of the individual clouds are only read once by the merge, compress them quickly
+DSM_INTERMEDIATE_GDALOPTS = 'COMPRESS=DEFLATE,ZLEVEL=1'
 
 
 class DSMEngine:
@@ -24,98 +34,116 @@ class DSMEngine:
         self.transformed_polygon = polygon.transform(projection, clone=True)
         self.clouds = clouds
 
-    def getDSM(self, resolution, filepath, filter_outliers=False):
+    def getDSM(self, resolution, filepath, filter_outliers=False, gdalopts=DSM_OUTPUT_GDALOPTS, fixed_extent=False):
         """
         Get DSM for polygon of interest and put it in the filepath as a geotiff
 
+        Clouds are rasterized concurrently on the pdal execution service, a failed or timed out
+        cloud is logged and left out of the DSM
+
         Args:
             resolution: float - resolution of output raster (meters)
             filepath: file-like object to put geotiff (e.g. tempfile)
+            gdalopts: GeoTIFF creation options of the output
+            fixed_extent: write the extent of the polygon instead of the extent of the points, a
+                polygon without points gives a nodata raster instead of failing
+
         Returns:
-            a process handle of the pdal request
+            number of points rasterized
 
         Raises:
-            not sure lol
+            Exception if no point cloud could be rasterized
         """
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            files = []
-            # Iterate over all clouds
-            for cloud in self.clouds:
-                with tempfile.NamedTemporaryFile(suffix=".tif", delete=False, dir=tmp_dir) as tmp_tif:
-                    files.append(tmp_tif.name)
-                    query_json = self.__createQueryPipeline(
-                        resolution, tmp_tif.name, cloud, filter_outliers)
-                    command = shlex.split(
-                        'pdal pipeline --stdin'
+        clouds = list(self.clouds)
+        scratch = PDALScratchDirectory()
+        with scratch as tmp_dir:
+            # A single cloud is written as the final output, otherwise the merge compresses the DSM
+            cloud_gdalopts = gdalopts if len(clouds) == 1 else DSM_INTERMEDIATE_GDALOPTS
+            jobs = [(cloud, os.path.join(tmp_dir, f'{i}.tif')) for i, cloud in enumerate(clouds)]
+            start = time.time()
+            with concurrent.futures.ThreadPoolExecutor(max(1, min(len(jobs), pdal_service.max_workers))) as executor:
+                futures = [
+                    executor.submit(
+                        self.__rasterizeCloud,
+                        resolution, tif, cloud, filter_outliers, cloud_gdalopts, scratch, fixed_extent
                     )
-                    process = subprocess.Popen(command, stdin=subprocess.PIPE)
-                    process.stdin.write(query_json.encode())
-                    process.stdin.close()
-                    process.wait()
-            if len(files) == 1:
+                    for cloud, tif in jobs
+                ]
+            files = []
+            errors = {}
+            points = 0
+            # Keep the order of the clouds, later clouds are drawn over earlier ones
+            for (cloud, tif), future in zip(jobs, futures):
+                try:
+                    points += future.result()
+                    files.append(tif)
+                except Exception as e:
+                    logging.error(f'failed to create dsm for cloud {cloud.name}: {e!r}', exc_info=e)
+                    errors[cloud.name] = repr(e)
+            logging.info(f'rasterized {len(files)}/{len(jobs)} clouds in {time.time() - start:.3f}s')
+            if len(files) == 0:
+                raise Exception(f'Failed to create DSM for all point clouds: {errors}')
+            elif len(clouds) == 1:
                 shutil.copy(files[0], filepath)
             else:
                 # Combine clouds together
-                process = self.__combineTifs(files, filepath)
-                process.wait()
-            return process
+                self.__combineTifs(files, filepath, tmp_dir, gdalopts)
+        return points
+
+    def __rasterizeCloud(self, resolution, tif, cloud, filter_outliers, gdalopts, scratch, fixed_extent):
+        query_json = self.__createQueryPipeline(resolution, tif, cloud, filter_outliers, gdalopts, fixed_extent)
+        _, count = pdal_service.execute(query_json, timeout=DSM_PIPELINE_TIMEOUT_S, arrays=False, scratch=scratch)
+        return count
 
-    def __combineTifs(self, files, output_filepath):
-        cmd = shlex.split(f"""
-            gdal_merge.py -o {output_filepath} -of GTiff -co COMPRESS=DEFLATE -co ZLEVEL=9
-        """ + " ".join(files))
-        process = subprocess.Popen(cmd)
-        return process
+    def __combineTifs(self, files, output_filepath, tmp_dir, gdalopts):
+        vrt_filepath = os.path.join(tmp_dir, 'dsm.vrt')
+        celery_task_subprocess_check_output_wrapper(['gdalbuildvrt', vrt_filepath] + files)
+        cmd = ['gdal_translate', '-of', 'GTiff']
+        for option in gdalopts.split(','):
+            cmd += ['-co', option]
+        celery_task_subprocess_check_output_wrapper(cmd + [vrt_filepath, output_filepath])
 
-    def __createQueryPipeline(self, resolution: float, outputfilepath: str, cloud: EPTLidarPointCloud, filter_outliers: bool):
+    def __createQueryPipeline(
+        self, resolution: float, outputfilepath: str, cloud: EPTLidarPointCloud, filter_outliers: bool,
+        gdalopts: str = None, fixed_extent: bool = False
+    ):
         """
         Creates the json string that pdal uses as a pipeline
         pdal docs: https://pdal.io/project/docs.html
 
         (has a statistical filter for outlier points )
         """
-        source = cloud.url
-
         # If we are going to filter outlilers we should load data a little outside the boundary
         source_bounding_box = self.transformed_polygon
         if filter_outliers:
             source_bounding_box = addBufferToPolygon(self.transformed_polygon)
-        outlier_filter = f"""
-        {{
-            "class": 18,
-            "type": "filters.outlier",
-            "method": "statistical",
-            "mean_k": 12,
-            "multiplier": 2.2
-        }},
-        {{
-            "type": "filters.range",
-            "limits": "Classification![18:18]"
-        }},
-        """
-        query_json = f"""{{
-        "pipeline": [
-            {{
-                "type":"readers.ept",
-                "filename": "{source}",
-                "bounds": "{
+        source = getCachedEPTPath(cloud.url, source_bounding_box.extent, resolution)
+        template = getPipelineTemplate('readers.ept', getFilterSet(filter_outliers))
+        writer = {
+            "type": "writers.gdal",
+            "filename": outputfilepath,
+            "dimension": "Z",
+            "data_type": "float",
+            "output_type": "max",
+            "gdalopts": gdalopts or DSM_OUTPUT_GDALOPTS,
+            "resolution": resolution
+        }
+        if fixed_extent:
+            xmin, ymin, xmax, ymax = self.transformed_polygon.extent
+            writer["bounds"] = str(([xmin, xmax], [ymin, ymax]))
+        return template.render(
+            {
+                "filename": source,
+                "bounds": str((
                     [source_bounding_box.extent[0], source_bounding_box.extent[2]],
-                    [source_bounding_box.extent[1], source_bounding_box.extent[3]]}",
-                "resolution" : {resolution}
-            }},
-            {outlier_filter if filter_outliers else ''}
-            {{
-                "type":"filters.crop",
-                "polygon":"{self.transformed_polygon.wkt}"
-            }},
-            {{
-                "type":"writers.gdal",
-                "filename":"{outputfilepath}",
-                "dimension":"Z",
-                "data_type":"float",
-                "output_type":"max",
-                "gdalopts":"COMPRESS=DEFLATE,ZLEVEL=9",
-                "resolution": {resolution}
-            }}
-        ]}}"""
-        return query_json
+                    [source_bounding_box.extent[1], source_bounding_box.extent[3]])),
+                "resolution": resolution,
+            },
+            [
+                {
+                    "type": "filters.crop",
+                    "polygon": self.transformed_polygon.wkt
+                },
+                writer,
+            ]
+        )
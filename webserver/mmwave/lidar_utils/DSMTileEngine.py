@@ -2,13 +2,17 @@
 from celery.utils.log import get_task_logger
 from mmwave.models import EPTLidarPointCloud
 from typing import Iterable
-from django.contrib.gis.geos import GEOSGeometry, Point
+from contextlib import contextmanager
+from django.contrib.gis.geos import GEOSGeometry, MultiPoint, Point
 from mmwave.lidar_utils import SlippyTiles
 import tempfile
-import shlex
 import os
 import time
-from IspToolboxApp.util.s3 import readMultipleS3Objects
+from mmwave.lidar_utils.dsm_tile_cache import dsm_tile_cache
+from mmwave.lidar_utils.dsm_profile import tileIndices
+from mmwave.lidar_utils.dsm_overviews import selectTileZoom
+from mmwave.lidar_utils.tile_index import dsm_tile_index, packTiles
+from mmwave.lidar_utils.dsm_encoding import readDSMBand, unscaledTilePath
 import rasterio
 
 from workspace.utils.process_utils import celery_task_subprocess_check_output_wrapper
@@ -19,63 +23,203 @@ TASK_LOGGER = get_task_logger(__name__)
 
 
 class DSMTileEngine:
-    def __init__(self, polygon: GEOSGeometry, clouds: Iterable[EPTLidarPointCloud]):
+    """
+    DSM mosaics and surface heights from the pre-rendered DSM tiles
+
+    resolution - coarsest pixel size (meters) the consumer accepts, the mosaic is built from
+        the overview tiles of that resolution when they cover the polygon, see `dsm_overviews`
+    clip_tiles - only use the tiles that intersect the polygon instead of every tile of its bounding box
+    """
+
+    def __init__(
+        self, polygon: GEOSGeometry, clouds: Iterable[EPTLidarPointCloud], resolution: float = None,
+        clip_tiles: bool = False
+    ):
         self.polygon = polygon
+        self.clip_tiles = clip_tiles
         # Sort by collection start date to make sure latest data is shown first
         self.clouds = sorted(
             clouds, key=lambda cld: cld.collection_start_date, reverse=True)
+        self.resolution = resolution
 
-    def getDSM(self, output_filepath):
-        start = time.time()
-        tiles = SlippyTiles.getTiles(
-            self.polygon, SlippyTiles.DEFAULT_OUTPUT_ZOOM)
+    def tileZoom(self) -> int:
+        """
+        Zoom of the tiles the mosaic is built from
+        """
+        zoom = selectTileZoom(self.resolution)
+        if zoom == SlippyTiles.DEFAULT_OUTPUT_ZOOM:
+            return zoom
+        try:
+            if self.__overviewsCover(zoom):
+                return zoom
+        except Exception:
+            TASK_LOGGER.exception('failed to check for overview tiles')
+        return SlippyTiles.DEFAULT_OUTPUT_ZOOM
+
+    def __overviewsCover(self, zoom: int) -> bool:
+        """
+        Whether every full resolution tile of the polygon has its overview tile at `zoom`, in each cloud
+        """
+        # Lazy Import To Improve Start Time
+        import numpy as np
+
+        tiles = self.__polygonTiles(SlippyTiles.DEFAULT_OUTPUT_ZOOM)
+        if len(tiles) == 0:
+            return True
+        tiles = packTiles([x for x, _ in tiles], [y for _, y in tiles])
+        shift = SlippyTiles.DEFAULT_OUTPUT_ZOOM - zoom
+        for cloud in self.clouds:
+            present = tiles[np.isin(tiles, dsm_tile_index.getTiles(cloud, SlippyTiles.DEFAULT_OUTPUT_ZOOM))]
+            if len(present) == 0:
+                continue
+            parents = packTiles((present >> 32) >> shift, (present & 0xFFFFFFFF) >> shift)
+            if not np.all(np.isin(parents, dsm_tile_index.getTiles(cloud, zoom))):
+                return False
+        return True
+
+    def __polygonTiles(self, zoom: int) -> list:
+        tiles = SlippyTiles.getTiles(self.polygon, zoom)
+        if self.clip_tiles:
+            polygon = self.polygon.prepared
+            tiles = [tile for tile in tiles if polygon.intersects(SlippyTiles.getBoundaryofTile(*tile, zoom))]
+        return tiles
+
+    def getDSM(self, output_filepath, window=True):
+        """
+        Materialize the DSM mosaic into a GeoTIFF at `output_filepath`
+
+        window - only write the extent of the polygon instead of every tile it touches
+
+        Consumers that can read a VRT should use `mosaic` instead, it does not copy the tiles
+        """
+        with self.mosaic() as vrt_filepath:
+            start = time.time()
+            cmd = ['gdal_translate', '-of', 'GTiff']
+            projwin = self.__projectionWindow(vrt_filepath) if window else None
+            if projwin is not None:
+                cmd += ['-projwin'] + [str(v) for v in projwin]
+            celery_task_subprocess_check_output_wrapper(cmd + [vrt_filepath, output_filepath])
+            TASK_LOGGER.info(f'Materialized mosaic: {time.time() - start}')
+
+    @contextmanager
+    def mosaic(self):
+        """
+        Virtual mosaic of the DSM tiles covering the polygon, yields the path of a GDAL VRT
+
+        The tiles the VRT references are removed when the context exits
+        """
         with tempfile.TemporaryDirectory() as tmp_dir:
-            jobs = []
-            tifs = []
-            for tile in tiles:
-                x, y = tile
-                for cloud in self.clouds:
-                    # Check for overlapping tiles
-                    if cloud.existsTile(x, y, SlippyTiles.DEFAULT_OUTPUT_ZOOM):
-                        tmp_tif_name = os.path.join(tmp_dir, f"{cloud.pk},{x},{y},{SlippyTiles.DEFAULT_OUTPUT_ZOOM}.tif")
-                        jobs.append(cloud.get_s3_key_tile(
-                            x, y, SlippyTiles.DEFAULT_OUTPUT_ZOOM, old_path=USE_OLD_TILES))
-                        tifs.append(tmp_tif_name)
-                        break
-            TASK_LOGGER.info(
-                f'Time to generate jobs: {time.time() - start} jobs:{ len(jobs)}')
-            readMultipleS3Objects(jobs, tifs)
-            TASK_LOGGER.info(f'Finished: {time.time() - start} ')
-            cmd = shlex.split(
-                f'gdal_merge.py -o {output_filepath} -of GTiff {" ".join(tifs)}')
-            celery_task_subprocess_check_output_wrapper(cmd)
+            yield self.buildVRT(tmp_dir)
 
-    def getSurfaceHeight(self, pt: Point) -> float:
-        # get tile coordinates x,y,z
-        tile_x, tile_y = SlippyTiles.deg2num(
-            pt[1], pt[0], SlippyTiles.DEFAULT_OUTPUT_ZOOM)
-        # read the tile from s3
-        with tempfile.NamedTemporaryFile(suffix='.tif') as tmp_tif:
-            found_tif = False
+    def buildVRT(self, directory):
+        """
+        Download the DSM tiles covering the polygon into `directory` and build a GDAL VRT over them
+
+        Returns:
+            path of the VRT, valid as long as `directory` exists
+        """
+        tifs = self.__downloadTiles(directory)
+        if len(tifs) == 0:
+            raise Exception('No DSM tiles available')
+        start = time.time()
+        # Later tiles are drawn over earlier ones where the tile buffers overlap, like gdal_merge.py
+        file_list = os.path.join(directory, 'tiles.txt')
+        with open(file_list, 'w') as f:
+            # gdalbuildvrt ignores the scale of int16 tiles and keeps the nodata of each tile, int16
+            # and float16 tiles are mosaicked through float32 VRTs with DSM_NODATA
+            f.write('\n'.join(unscaledTilePath(tif) for tif in tifs))
+        vrt_filepath = os.path.join(directory, 'dsm.vrt')
+        celery_task_subprocess_check_output_wrapper(
+            ['gdalbuildvrt', '-input_file_list', file_list, vrt_filepath])
+        TASK_LOGGER.info(f'Built mosaic: {time.time() - start}')
+        return vrt_filepath
+
+    def __downloadTiles(self, directory):
+        start = time.time()
+        zoom = self.tileZoom()
+        tiles = self.__polygonTiles(zoom)
+        jobs = []
+        tifs = []
+        for tile in tiles:
+            x, y = tile
             for cloud in self.clouds:
-                if cloud.existsTile(tile_x, tile_y, SlippyTiles.DEFAULT_OUTPUT_ZOOM, old_path=USE_OLD_TILES):
-                    cloud.getTile(
-                        tile_x, tile_y, SlippyTiles.DEFAULT_OUTPUT_ZOOM, tmp_tif, old_path=USE_OLD_TILES)
-                    found_tif = True
-                    transformed_pt = pt.transform(cloud.srs, clone=True)
+                # Check for overlapping tiles
+                if cloud.existsTile(x, y, zoom):
+                    tmp_tif_name = os.path.join(directory, f"{cloud.pk},{x},{y},{zoom}.tif")
+                    jobs.append(cloud.get_s3_key_tile(
+                        x, y, zoom, old_path=USE_OLD_TILES))
+                    tifs.append(tmp_tif_name)
                     break
-            # get the value at that point using rasterio
-            if found_tif:
-                try:
-                    with rasterio.open(tmp_tif.name) as dataset:
-                        py, px = dataset.index(transformed_pt.x, transformed_pt.y)
-                        return dataset.read(1)[py, px]
-                except Exception:
-                    TASK_LOGGER.error(
-                        f"failed to read tif file - id:{cloud.id} " +
-                        f"x,y,z:{tile_x},{tile_y},{SlippyTiles.DEFAULT_OUTPUT_ZOOM}"
-                    )
-                    raise
-            else:
-                return 0
-        return 0
+        TASK_LOGGER.info(
+            f'Time to generate jobs: {time.time() - start} jobs:{ len(jobs)} zoom:{zoom}')
+        dsm_tile_cache.readMultiple(jobs, tifs)
+        TASK_LOGGER.info(f'Finished: {time.time() - start} {dsm_tile_cache.stats()}')
+        # Tiles that failed to download are left out of the mosaic
+        return [tif for tif in tifs if os.path.exists(tif) and os.path.getsize(tif) > 0]
+
+    def __projectionWindow(self, vrt_filepath):
+        """
+        gdal_translate -projwin (ulx uly lrx lry) of the polygon, clipped to the mosaic
+        """
+        with rasterio.open(vrt_filepath) as dataset:
+            bounds = dataset.bounds
+            srid = dataset.crs.to_epsg() if dataset.crs is not None else None
+        if srid is None:
+            return None
+        polygon = self.polygon
+        if polygon.srid is None:
+            polygon = polygon.clone()
+            polygon.srid = 4326
+        xmin, ymin, xmax, ymax = polygon.transform(srid, clone=True).extent
+        ulx, uly = max(xmin, bounds.left), min(ymax, bounds.top)
+        lrx, lry = min(xmax, bounds.right), max(ymin, bounds.bottom)
+        if ulx >= lrx or lry >= uly:
+            return None
+        return ulx, uly, lrx, lry
+
+    def getSurfaceHeight(self, pt: Point) -> float:
+        return float(self.getSurfaceHeights([pt])[0])
+
+    def getSurfaceHeights(self, points: Iterable[Point]):
+        """
+        Surface height at each point, 0 where there is no DSM tile
+
+        Points are grouped by tile; every tile is read once, from the local tile cache, and only
+        the window spanning its points
+
+        Returns:
+            numpy array of heights in the order of `points`
+        """
+        # Lazy Import To Improve Start Time
+        import numpy as np
+        from rasterio.transform import rowcol
+        from rasterio.windows import Window
+
+        zoom = SlippyTiles.DEFAULT_OUTPUT_ZOOM
+        points = list(points)
+        heights = np.zeros(len(points))
+        if len(points) == 0:
+            return heights
+        tile_x, tile_y = tileIndices([pt.x for pt in points], [pt.y for pt in points], zoom)
+        for x, y in sorted(set(zip(tile_x.tolist(), tile_y.tolist()))):
+            cloud = next((cld for cld in self.clouds if cld.existsTile(x, y, zoom)), None)
+            if cloud is None:
+                continue
+            in_tile = np.flatnonzero((tile_x == x) & (tile_y == y))
+            transformed = MultiPoint(
+                *[points[i] for i in in_tile], srid=points[in_tile[0]].srid or 4326
+            ).transform(cloud.srs, clone=True)
+            try:
+                path = dsm_tile_cache.getLocalPath(cloud.get_s3_key_tile(x, y, zoom, old_path=USE_OLD_TILES))
+                with rasterio.open(path) as dataset:
+                    rows, cols = rowcol(dataset.transform, [pt.x for pt in transformed], [pt.y for pt in transformed])
+                    rows = np.clip(np.asarray(rows), 0, dataset.height - 1)
+                    cols = np.clip(np.asarray(cols), 0, dataset.width - 1)
+                    row_off, col_off = int(rows.min()), int(cols.min())
+                    band = readDSMBand(dataset, window=Window(
+                        col_off, row_off, int(cols.max()) - col_off + 1, int(rows.max()) - row_off + 1))
+                    heights[in_tile] = band[rows - row_off, cols - col_off]
+            except Exception:
+                TASK_LOGGER.error(f"failed to read tif file - id:{cloud.id} x,y,z:{x},{y},{zoom}")
+                raise
+        return heights
@@ -62,13 +62,19 @@ class LidarEngine:
     TODO: write documentation lol
     """
 
-    def __init__(self, link, resolution, num_samples):
+    def __init__(self, link, resolution, num_samples, segments=None, profile_source=None):
+        """
+        segments - optional precomputed [(geometry, cloud)] split of the link, see `segmentLinkByPointClouds`
+        profile_source - optional callable (link, cloud, num_samples) -> profile, used instead of
+            querying PDAL for every segment (e.g. BatchLidarEngine)
+        """
         self.link = link
         self.link.srid = 4326
         self.resolution = resolution
         self.num_samples = num_samples
+        self.profile_source = profile_source
         # TODO: all clouds must have same SRS
-        self.segments = self.__getRelevantPointClouds()
+        self.segments = segments if segments is not None else self.__getRelevantPointClouds()
         self.link_T = self.link.transform(self.getProjection(), clone=True)
         self.lidar_profile = self.__calculateLidarProfileMultiPointCloud()
 
@@ -248,6 +254,8 @@ class LidarEngine:
             num_samples = self.num_samples
         if link.empty:
             return []
+        if self.profile_source is not None:
+            return self.profile_source(link, cloud, num_samples)
         lidar_profile, _, _, _ = getLidarPointsAroundLink(
             cloud.url, link, cloud.srs,
             resolution=self.resolution,
@@ -284,48 +292,57 @@ class LidarEngine:
             self.link, cloud, self.num_samples)
         return profile
 
-    def __pointCloudNameSortingFunction(self, cloud):
-        pattern_year = re.compile(r'2[0-9][0-9][0-9]')
-        years = [int(yr) for yr in pattern_year.findall(cloud.url)]
-        return max(years) if len(years) > 0 else 0
-
     def __getRelevantPointClouds(self):
         """
         Use the LineString between tx and rx to determine which point clouds to compose the link of
         """
-        query = (
-            EPTLidarPointCloud.objects.filter(
-                high_resolution_boundary__isnull=True,
-                boundary__intersects=self.link
-            ) |
-            EPTLidarPointCloud.objects.filter(
-                high_resolution_boundary__isnull=False,
-                high_resolution_boundary__intersects=self.link
-            )
-        )
-        pt_clouds = query.all()
-        sorted_pt_clouds = sorted(
-            pt_clouds, key=self.__pointCloudNameSortingFunction, reverse=True)
-
-        segments = []
-
-        remaining_segments = [self.link]
-        for cloud in sorted_pt_clouds:
-            segment = remaining_segments.pop()
-            boundary = cloud.high_resolution_boundary
-            if boundary is None:
-                boundary = cloud.boundary
-            geometry = segment.intersection(boundary)
-            if geometry.dims > 0:
-                if isinstance(geometry, MultiLineString):
-                    for s in geometry:
-                        segments.append((s, cloud))
-                else:
-                    segments.append((geometry, cloud))
-            remaining_segments.append(segment.difference(boundary))
-
-        # These segments did not have an associated point cloud:
-        for segment in remaining_segments:
-            segments.append((segment, None))
-
-        return segments
+        return segmentLinkByPointClouds(self.link, EPTLidarPointCloud.query_intersect_aoi(self.link))
+
+
+def _pointCloudNameSortingFunction(cloud):
+    pattern_year = re.compile(r'2[0-9][0-9][0-9]')
+    years = [int(yr) for yr in pattern_year.findall(cloud.url)]
+    return max(years) if len(years) > 0 else 0
+
+
+def segmentLinkByPointClouds(link, pt_clouds):
+    """
+    Split the link into segments covered by each point cloud, most recent point clouds take priority
+
+    pt_clouds - point clouds whose boundaries intersect the link
+
+    returns list of (geometry, cloud) tuples, cloud is None for segments without lidar coverage
+    """
+    sorted_pt_clouds = sorted(
+        pt_clouds, key=_pointCloudNameSortingFunction, reverse=True)
+
+    segments = []
+
+    remaining_segments = [link]
+    for cloud in sorted_pt_clouds:
+        segment = remaining_segments.pop()
+        boundary = cloud.high_resolution_boundary
+        if boundary is None:
+            boundary = cloud.boundary
+        # Clouds from the boundary index carry a prepared boundary, skip the overlay for the common cases
+        prepared = getattr(cloud, 'prepared_boundary', None)
+        if prepared is not None and prepared.disjoint(segment):
+            remaining_segments.append(segment)
+            continue
+        if prepared is not None and prepared.contains(segment):
+            geometry, remainder = segment, segment.difference(segment)
+        else:
+            geometry, remainder = segment.intersection(boundary), segment.difference(boundary)
+        if geometry.dims > 0:
+            if isinstance(geometry, MultiLineString):
+                for s in geometry:
+                    segments.append((s, cloud))
+            else:
+                segments.append((geometry, cloud))
+        remaining_segments.append(remainder)
+
+    # These segments did not have an associated point cloud:
+    for segment in remaining_segments:
+        segments.append((segment, None))
+
+    return segments
@@ -0,0 +1,150 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+"""
+Process-local spatial index of point cloud boundaries
+
+Resolving which point clouds cover a link used to be an OR'd PostGIS `intersects` query on
+every request. The index keeps the (valid) point clouds in memory with an STRtree over the
+boundary envelopes and prepared geometries for the exact test.
+
+Boundaries change when new clouds are loaded from entwine or when high resolution boundaries
+are computed; those jobs bump a version stamp in the shared cache and every process reloads
+its index when it notices the stamp changed.
+"""
+import copy
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+BOUNDARY_INDEX_VERSION_KEY = 'lidar_boundary_index_version'
+BOUNDARY_INDEX_CACHE_NAME = 'los'
+
+
+def bumpBoundaryIndexVersion():
+    """
+    Invalidate the boundary index of every process, call after point cloud boundaries change
+    """
+    point_cloud_boundary_index.invalidate()
+    try:
+        caches[BOUNDARY_INDEX_CACHE_NAME].set(BOUNDARY_INDEX_VERSION_KEY, time.time(), timeout=None)
+    except Exception:
+        logging.exception('failed to bump point cloud boundary index version')
+
+
+def _getBoundaryIndexVersion():
+    try:
+        return caches[BOUNDARY_INDEX_CACHE_NAME].get(BOUNDARY_INDEX_VERSION_KEY)
+    except Exception:
+        logging.exception('failed to read point cloud boundary index version')
+        return None
+
+
+class PointCloudBoundaryIndex:
+    """
+    STRtree of the valid point clouds' boundaries (high resolution boundary when available)
+
+    Attributes
+    ----------
+    check_interval : float
+        seconds between checks of the shared version stamp
+    """
+
+    def __init__(self, check_interval: float):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._version = None
+        self._last_check = 0
+        # (clouds, prepared boundaries, tree, envelopes), swapped as a whole on reload
+        self._state = ([], [], None, [])
+
+    def warmUp(self):
+        start = time.time()
+        self._ensureLoaded()
+        logging.info(f'point cloud boundary index loaded {len(self._state[0])} clouds in {time.time() - start:.3f}s')
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = False
+
+    def query(self, aoi):
+        """
+        Returns the point clouds whose boundary intersects `aoi`
+
+        Each call returns copies of the indexed point clouds, callers are free to modify them
+        """
+        if not settings.LIDAR_BOUNDARY_INDEX_ENABLED:
+            return self._queryDatabase(aoi)
+        try:
+            self._ensureLoaded()
+            if aoi.srid is not None and aoi.srid != 4326:
+                aoi = aoi.transform(4326, clone=True)
+            clouds, prepared, tree, envelopes = self._state
+            result = []
+            for i in self._queryTree(tree, envelopes, aoi.extent):
+                if prepared[i].intersects(aoi):
+                    cloud = copy.copy(clouds[i])
+                    cloud.prepared_boundary = prepared[i]
+                    result.append(cloud)
+            return result
+        except Exception:
+            logging.exception('point cloud boundary index query failed, querying database')
+            return self._queryDatabase(aoi)
+
+    @staticmethod
+    def _queryDatabase(aoi):
+        from mmwave.models import EPTLidarPointCloud
+        return list(EPTLidarPointCloud.query_intersect_aoi_db(aoi))
+
+    @staticmethod
+    def _queryTree(tree, envelopes, extent):
+        # Lazy Import To Improve Start Time
+        from shapely.geometry import box
+
+        if tree is None:
+            return []
+        result = tree.query(box(*extent))
+        if len(result) > 0 and hasattr(result[0], 'geom_type'):
+            # shapely < 2.0 returns the geometries instead of their indices
+            index = {id(envelope): i for i, envelope in enumerate(envelopes)}
+            return sorted(index[id(geometry)] for geometry in result)
+        return sorted(int(i) for i in result)
+
+    def _ensureLoaded(self):
+        now = time.time()
+        if self._loaded and now - self._last_check < self.check_interval:
+            return
+        with self._lock:
+            self._last_check = now
+            version = _getBoundaryIndexVersion()
+            if self._loaded and version == self._version:
+                return
+            self._load()
+            self._version = version
+            self._loaded = True
+
+    def _load(self):
+        # Lazy Import To Improve Start Time
+        from shapely.geometry import box
+        from shapely.strtree import STRtree
+        from mmwave.models import EPTLidarPointCloud
+
+        clouds = []
+        prepared = []
+        envelopes = []
+        for cloud in EPTLidarPointCloud.objects.all().iterator():
+            boundary = cloud.high_resolution_boundary
+            if boundary is None:
+                boundary = cloud.boundary
+            if boundary is None or boundary.empty:
+                continue
+            clouds.append(cloud)
+            prepared.append(boundary.prepared)
+            envelopes.append(box(*boundary.extent))
+        tree = STRtree(envelopes) if len(envelopes) > 0 else None
+        self._state = (clouds, prepared, tree, envelopes)
+
+
+point_cloud_boundary_index = PointCloudBoundaryIndex(settings.LIDAR_BOUNDARY_INDEX_CHECK_INTERVAL_S)
@@ -1,5 +1,9 @@
 # (c) Meta Platforms, Inc. and affiliates. Copyright
 from django.core.cache import caches
+import logging
+import struct
+import threading
+import zlib
 
 _CACHE_NAME = 'los'
 _POINT_PRECISION = 7
@@ -8,10 +12,63 @@ _AOI_PRECISION = 3
 # Store for a week
 _DURATION = 7 * 24 * 60 * 60
 
+# Cached LiDAR responses are stored as:
+#   <format version: u8> <compression: u8> compressed(msgpack metadata + float32 profile bytes)
+# Bump the format version when changing the layout, values in other formats are treated as misses.
+# The version is also part of the key so workers running older code never read the new values
+_FORMAT_VERSION = 1
+_KEY_TYPE = f'lidar.v{_FORMAT_VERSION}'
+_HEADER = struct.Struct('<BB')
+_COMPRESSION_ZLIB = 1
+_COMPRESSION_ZSTD = 2
+_ZLIB_LEVEL = 6
+_ZSTD_LEVEL = 3
+_PROFILE_KEY = 'lidar_profile'
+
 
 cache = caches[_CACHE_NAME]
 
 
+class _CacheStats:
+    """
+    Per-process counters for the LOS cache, logged on every write
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.bytes_stored = 0
+
+    def record_get(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def record_set(self, size):
+        with self._lock:
+            self.writes += 1
+            self.bytes_stored += size
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total > 0 else 0.,
+                'writes': self.writes,
+                'bytes_stored': self.bytes_stored,
+                'bytes_per_key': self.bytes_stored / self.writes if self.writes > 0 else 0.,
+            }
+
+
+cache_stats = _CacheStats()
+
+
 def _to_fixed(num, precision):
     return format(num, f'.{precision}f')
 
@@ -27,9 +84,68 @@ def _get_key(type, tx, rx, aoi,):
     return ':'.join([type, tx_x, tx_y, rx_x, rx_y, aoi_0, aoi_1])
 
 
+def _compress(payload):
+    try:
+        import zstandard
+        return _COMPRESSION_ZSTD, zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compress(payload)
+    except ImportError:
+        return _COMPRESSION_ZLIB, zlib.compress(payload, _ZLIB_LEVEL)
+
+
+def _decompress(compression, payload):
+    if compression == _COMPRESSION_ZSTD:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(payload)
+    elif compression == _COMPRESSION_ZLIB:
+        return zlib.decompress(payload)
+    raise ValueError(f'unknown compression {compression}')
+
+
+def encode_lidar_response(resp):
+    """
+    Pack a LiDAR response for the cache: profile as float32 bytes, everything else as msgpack
+    """
+    # Lazy Import To Improve Start Time
+    import msgpack
+    import numpy as np
+
+    metadata = {k: v for k, v in resp.items() if k != _PROFILE_KEY}
+    profile = np.asarray(resp.get(_PROFILE_KEY, []), dtype='<f4').tobytes()
+    payload = msgpack.packb([metadata, profile], use_bin_type=True)
+    compression, compressed = _compress(payload)
+    return _HEADER.pack(_FORMAT_VERSION, compression) + compressed
+
+
+def decode_lidar_response(value):
+    """
+    Unpack a cached LiDAR response, returns None for values in an unknown format
+    """
+    # Lazy Import To Improve Start Time
+    import msgpack
+    import numpy as np
+
+    if not isinstance(value, (bytes, bytearray)) or len(value) < _HEADER.size:
+        return None
+    version, compression = _HEADER.unpack_from(value)
+    if version != _FORMAT_VERSION:
+        return None
+    metadata, profile = msgpack.unpackb(_decompress(compression, value[_HEADER.size:]), raw=False)
+    metadata[_PROFILE_KEY] = np.frombuffer(profile, dtype='<f4').astype(float).tolist()
+    return metadata
+
+
 def lidar_cache_set(tx, rx, aoi, resp):
-    cache.set(_get_key('lidar', tx, rx, aoi), resp, timeout=_DURATION)
+    value = encode_lidar_response(resp)
+    cache.set(_get_key(_KEY_TYPE, tx, rx, aoi), value, timeout=_DURATION)
+    cache_stats.record_set(len(value))
+    logging.info(f'los cache: stored {len(value)}B {cache_stats.stats()}')
 
 
 def lidar_cache_get(tx, rx, aoi):
-    return cache.get(_get_key('lidar', tx, rx, aoi))
+    try:
+        resp = decode_lidar_response(cache.get(_get_key(_KEY_TYPE, tx, rx, aoi)))
+    except Exception:
+        logging.exception('los cache: failed to decode cached lidar response')
+        resp = None
+    cache_stats.record_get(resp is not None)
+    return resp
@@ -0,0 +1,173 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+"""
+Encodings of the DSM tiles
+
+DSM_TILE_ENCODING selects how new tiles are written, tiles already in s3 keep the encoding they
+were written with. Readers go through `readDSMBand` / `unscaledTilePath` and get float heights
+with DSM_NODATA whatever the encoding of the tile.
+
+deflate     float32, DEFLATE level 9, the original encoding
+zstd        float32, ZSTD with the floating point predictor
+lerc        float32, LERC + ZSTD, lossy up to DSM_TILE_MAX_Z_ERROR meters
+float16     half precision floats, GDAL reads them back as float32. Only ~1m precision above 1000m
+int16       int16 heights with a per-tile scale and offset, DSM_TILE_INT16_SCALE meter steps
+"""
+import os
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+
+# writers.gdal default nodata value
+DSM_NODATA = -9999
+INT16_NODATA = -32768
+INT16_MAX = 32767
+FLOAT16_NODATA = -10000
+
+DSM_TILE_ENCODINGS = {
+    'deflate': ('float32', {'compress': 'deflate', 'zlevel': 9}),
+    'zstd': ('float32', {'compress': 'zstd', 'zstd_level': 9, 'predictor': 3}),
+    'lerc': ('float32', {'compress': 'lerc_zstd', 'zstd_level': 9}),
+    'float16': ('float32', {'compress': 'zstd', 'zstd_level': 9, 'predictor': 3, 'nbits': 16}),
+    'int16': ('int16', {'compress': 'zstd', 'zstd_level': 9, 'predictor': 2}),
+}
+
+_UNSCALED_VRT_TEMPLATE = """<VRTDataset rasterXSize="{width}" rasterYSize="{height}">
+  <SRS>{crs}</SRS>
+  <GeoTransform>{geotransform}</GeoTransform>
+  <VRTRasterBand dataType="Float32" band="1">
+    <NoDataValue>{nodata}</NoDataValue>
+    <ComplexSource>
+      <SourceFilename relativeToVRT="1">{filename}</SourceFilename>
+      <SourceBand>1</SourceBand>
+      <SrcRect xOff="0" yOff="0" xSize="{width}" ySize="{height}" />
+      <DstRect xOff="0" yOff="0" xSize="{width}" ySize="{height}" />
+      <NODATA>{source_nodata}</NODATA>
+      <ScaleOffset>{offset}</ScaleOffset>
+      <ScaleRatio>{scale}</ScaleRatio>
+    </ComplexSource>
+  </VRTRasterBand>
+</VRTDataset>
+"""
+
+
+def getTileEncoding(encoding: str = None) -> str:
+    encoding = encoding or settings.DSM_TILE_ENCODING
+    if encoding not in DSM_TILE_ENCODINGS:
+        raise ValueError(f'unknown dsm tile encoding: {encoding}')
+    return encoding
+
+
+def getTileCreationOptions(encoding: str = None) -> dict:
+    """
+    rasterio creation options of the encoding, without the dtype
+    """
+    encoding = getTileEncoding(encoding)
+    options = dict(DSM_TILE_ENCODINGS[encoding][1])
+    if encoding == 'lerc':
+        options['max_z_error'] = settings.DSM_TILE_MAX_Z_ERROR
+    return options
+
+
+def getTileGDALOpts(encoding: str = None) -> str:
+    """
+    writers.gdal `gdalopts` of the encoding, int16 and float16 tiles are written as zstd floats by pdal
+
+    writers.gdal keeps nodata at DSM_NODATA, which is not a half precision float
+    """
+    encoding = getTileEncoding(encoding)
+    if encoding in ('int16', 'float16'):
+        encoding = 'zstd'
+    return ','.join(f'{key}={value}'.upper() for key, value in getTileCreationOptions(encoding).items())
+
+
+def writeDSMTile(filename: str, band, transform, crs, nodata=DSM_NODATA, encoding: str = None):
+    """
+    Write a DSM tile of float heights in the configured encoding
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+    import rasterio
+
+    encoding = getTileEncoding(encoding)
+    dtype, options = DSM_TILE_ENCODINGS[encoding][0], getTileCreationOptions(encoding)
+    band = np.asarray(band, dtype=np.float64)
+    scale, offset = 1.0, 0.0
+    if dtype == 'int16':
+        band, scale, offset, nodata = _quantize(band, nodata)
+    elif options.get('nbits') == 16:
+        # -9999 is not a half precision float, use the closest one
+        band[band == nodata] = FLOAT16_NODATA
+        nodata = FLOAT16_NODATA
+    with rasterio.open(
+        filename, 'w', driver='GTiff', width=band.shape[1], height=band.shape[0], count=1,
+        dtype=dtype, crs=crs, transform=transform, nodata=nodata, **options
+    ) as dataset:
+        if dtype == 'int16':
+            dataset.scales = (scale,)
+            dataset.offsets = (offset,)
+        dataset.write(band.astype(dtype), 1)
+
+
+def _quantize(band, nodata):
+    """
+    Returns (int16 band, scale, offset, int16 nodata), heights = band * scale + offset
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    valid = np.isfinite(band) & (band != nodata) & (band > DSM_NODATA)
+    if not np.any(valid):
+        return np.full(band.shape, INT16_NODATA, dtype=np.int16), 1.0, 0.0, INT16_NODATA
+    low, high = float(band[valid].min()), float(band[valid].max())
+    # Tiles with more relief than 65534 steps get coarser steps
+    scale = max(settings.DSM_TILE_INT16_SCALE, (high - low) / (2 * INT16_MAX))
+    offset = round((low + high) / 2 / scale) * scale
+    quantized = np.full(band.shape, INT16_NODATA, dtype=np.int16)
+    quantized[valid] = np.clip(np.round((band[valid] - offset) / scale), -INT16_MAX, INT16_MAX)
+    return quantized, scale, offset, INT16_NODATA
+
+
+def isScaled(dataset) -> bool:
+    return dataset.scales[0] != 1.0 or dataset.offsets[0] != 0.0
+
+
+def readDSMBand(dataset, window=None):
+    """
+    Float heights of band 1 of an open DSM tile, DSM_NODATA where there is no data
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    band = dataset.read(1, window=window)
+    if not isScaled(dataset) and band.dtype == np.float32 and dataset.nodata in (None, DSM_NODATA):
+        return band
+    heights = band.astype(np.float32) * np.float32(dataset.scales[0]) + np.float32(dataset.offsets[0])
+    if dataset.nodata is not None:
+        heights[band == dataset.nodata] = DSM_NODATA
+    return heights
+
+
+def unscaledTilePath(path: str) -> str:
+    """
+    Path of a float32 view of the tile for GDAL tools, which ignore scale and offset
+
+    Float tiles with DSM_NODATA are returned as is. Scaled tiles, and float16 tiles whose nodata
+    is FLOAT16_NODATA, get a VRT next to them that applies the scale and maps nodata to DSM_NODATA,
+    so mosaics of tiles of different encodings have a single nodata value.
+    """
+    # Lazy Import To Improve Start Time
+    import rasterio
+
+    with rasterio.open(path) as dataset:
+        if not isScaled(dataset) and dataset.nodata in (None, DSM_NODATA):
+            return path
+        vrt = _UNSCALED_VRT_TEMPLATE.format(
+            width=dataset.width, height=dataset.height, crs=escape(dataset.crs.to_wkt()),
+            geotransform=', '.join(repr(v) for v in dataset.transform.to_gdal()),
+            nodata=DSM_NODATA, source_nodata=dataset.nodata, filename=escape(os.path.basename(path)),
+            offset=repr(dataset.offsets[0]), scale=repr(dataset.scales[0]),
+        )
+    vrt_path = f'{path}.vrt'
+    with open(vrt_path, 'w') as f:
+        f.write(vrt)
+    return vrt_path
@@ -0,0 +1,86 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+"""
+Overview pyramid of the DSM tiles
+
+Point clouds are rendered into 1m DSM tiles at SlippyTiles.DEFAULT_OUTPUT_ZOOM. Coarser tiles
+at DSM_OVERVIEW_ZOOMS are derived from the four tiles below them, each level halving the
+resolution. Downsampling keeps the maximum height so obstructions survive in the overviews.
+
+Overview tiles are LidarDSMTileModels like the full resolution tiles, at their own zoom.
+"""
+import math
+
+from mmwave.lidar_utils import SlippyTiles
+from mmwave.lidar_utils.dsm_encoding import DSM_NODATA, unscaledTilePath, writeDSMTile
+
+# Resolution of the tiles at SlippyTiles.DEFAULT_OUTPUT_ZOOM (EPSG:3857 units)
+DSM_TILE_RESOLUTION_M = 1.0
+DSM_OVERVIEW_ZOOMS = (16, 15, 14, 13, 12)
+
+
+def tileResolution(zoom: int) -> float:
+    """
+    Pixel size of the DSM tiles at `zoom`
+    """
+    return DSM_TILE_RESOLUTION_M * 2 ** (SlippyTiles.DEFAULT_OUTPUT_ZOOM - zoom)
+
+
+def selectTileZoom(resolution: float = None) -> int:
+    """
+    Coarsest DSM tile zoom whose pixels are at most `resolution`, full resolution if None
+    """
+    if not resolution or resolution <= DSM_TILE_RESOLUTION_M:
+        return SlippyTiles.DEFAULT_OUTPUT_ZOOM
+    zoom = SlippyTiles.DEFAULT_OUTPUT_ZOOM - int(math.floor(math.log2(resolution / DSM_TILE_RESOLUTION_M)))
+    return max(min(DSM_OVERVIEW_ZOOMS), zoom)
+
+
+def getParentTiles(tiles) -> list:
+    """
+    Tiles one zoom level up that contain `tiles`
+    """
+    return sorted({(x // 2, y // 2) for x, y in tiles})
+
+
+def getChildTiles(x: int, y: int) -> list:
+    return [(2 * x + dx, 2 * y + dy) for dx in (0, 1) for dy in (0, 1)]
+
+
+def downsampleDSMTiles(child_files: list, zoom: int, x: int, y: int, filename: str, encoding: str = None) -> bool:
+    """
+    Write the DSM tile (x, y, zoom) from its child tiles at zoom + 1, keeping the max height of
+    every 2x2 block of child pixels, the tile is written in `encoding` (DSM_TILE_ENCODING by default)
+
+    Returns:
+        False if the children have no data in the tile, nothing is written then
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+    import rasterio
+    from rasterio.merge import merge
+    from rasterio.transform import from_origin
+
+    resolution = tileResolution(zoom)
+    datasets = [rasterio.open(unscaledTilePath(f)) for f in child_files]
+    try:
+        crs = datasets[0].crs
+        bounds = SlippyTiles.getBoundaryofTile(x, y, zoom).transform(crs.to_epsg(), clone=True).extent
+        # Mosaic the children on the grid of the tile at twice its resolution
+        mosaic, _ = merge(datasets, bounds=bounds, res=resolution / 2, nodata=DSM_NODATA, method='max')
+    finally:
+        for dataset in datasets:
+            dataset.close()
+
+    band = mosaic[0].astype(np.float64)
+    band[band <= DSM_NODATA] = -np.inf
+    height, width = (band.shape[0] + 1) // 2, (band.shape[1] + 1) // 2
+    padded = np.full((height * 2, width * 2), -np.inf)
+    padded[:band.shape[0], :band.shape[1]] = band
+    downsampled = padded.reshape(height, 2, width, 2).max(axis=(1, 3))
+    if np.all(np.isneginf(downsampled)):
+        return False
+    downsampled[np.isneginf(downsampled)] = DSM_NODATA
+
+    writeDSMTile(
+        filename, downsampled, from_origin(bounds[0], bounds[3], resolution, resolution), crs, encoding=encoding)
+    return True
@@ -0,0 +1,209 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+"""
+LiDAR profiles sampled from the pre-rendered DSM tiles
+
+Every point cloud is rendered into 1m DSM GeoTIFF tiles at SlippyTiles.DEFAULT_OUTPUT_ZOOM
+(see `convertPtCloudToDSMTiled`). For coarse profiles sampling those rasters along the link is
+much cheaper than querying the EPT point cloud, only the parts of the link without tiles are
+read from the point cloud.
+"""
+import logging
+import os
+import tempfile
+
+from django.contrib.gis.geos import LineString, MultiPoint, Point
+
+from mmwave.lidar_utils import SlippyTiles
+from mmwave.lidar_utils.progressive_lidar import DEFAULT_LINK_BUFFER
+from mmwave.lidar_utils.dsm_tile_cache import dsm_tile_cache
+from mmwave.lidar_utils.dsm_encoding import DSM_NODATA, readDSMBand
+
+# Same tile layout DSMTileEngine reads
+USE_OLD_TILES = "/tile"
+SAMPLE_MAX = 'max'
+SAMPLE_BILINEAR = 'bilinear'
+
+
+def tileIndices(lon, lat, zoom=SlippyTiles.DEFAULT_OUTPUT_ZOOM):
+    """
+    Vectorized `SlippyTiles.deg2num`
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    n = 2.0 ** zoom
+    lat_rad = np.radians(lat)
+    xtile = np.floor((np.asarray(lon) + 180.0) / 360.0 * n).astype(np.int64)
+    ytile = np.floor((1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n).astype(np.int64)
+    return xtile, ytile
+
+
+def sampleRaster(band, cols, rows, method=SAMPLE_MAX, radius=1):
+    """
+    Sample a raster band at fractional pixel coordinates
+
+    max - maximum of the pixels within `radius` pixels of the sample, like the max height
+          of the LiDAR points within the link buffer
+    bilinear - bilinear interpolation between pixel centers
+
+    Samples outside the band or touching nodata (NaN) pixels return NaN
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    height, width = band.shape
+    if method == SAMPLE_MAX:
+        col = np.floor(cols).astype(np.int64)
+        row = np.floor(rows).astype(np.int64)
+        result = np.full(col.shape, -np.inf)
+        valid = np.zeros(col.shape, dtype=bool)
+        for drow in range(-radius, radius + 1):
+            for dcol in range(-radius, radius + 1):
+                r = row + drow
+                c = col + dcol
+                inside = (r >= 0) & (r < height) & (c >= 0) & (c < width)
+                values = np.full(col.shape, np.nan)
+                values[inside] = band[r[inside], c[inside]]
+                ok = ~np.isnan(values)
+                result[ok] = np.maximum(result[ok], values[ok])
+                valid |= ok
+        result[~valid] = np.nan
+        return result
+    elif method == SAMPLE_BILINEAR:
+        # Pixel centers are at .5 offsets
+        x = np.asarray(cols) - 0.5
+        y = np.asarray(rows) - 0.5
+        x0 = np.clip(np.floor(x).astype(np.int64), 0, max(width - 2, 0))
+        y0 = np.clip(np.floor(y).astype(np.int64), 0, max(height - 2, 0))
+        x1 = np.minimum(x0 + 1, width - 1)
+        y1 = np.minimum(y0 + 1, height - 1)
+        fx = np.clip(x - x0, 0., 1.)
+        fy = np.clip(y - y0, 0., 1.)
+        top = band[y0, x0] * (1 - fx) + band[y0, x1] * fx
+        bottom = band[y1, x0] * (1 - fx) + band[y1, x1] * fx
+        result = top * (1 - fy) + bottom * fy
+        outside = (cols < 0) | (cols > width) | (rows < 0) | (rows > height)
+        result[outside] = np.nan
+        return result
+    raise ValueError(f'unknown sampling method {method}')
+
+
+def fetchDSMTiles(cloud, tiles, directory):
+    """
+    Download the DSM tiles of the cloud, returns {tile: local path} for the tiles that exist
+    """
+    zoom = SlippyTiles.DEFAULT_OUTPUT_ZOOM
+    filenames = [os.path.join(directory, f'{cloud.pk},{x},{y},{zoom}.tif') for x, y in tiles]
+    dsm_tile_cache.readMultiple(
+        [cloud.get_s3_key_tile(x, y, zoom, old_path=USE_OLD_TILES) for x, y in tiles], filenames)
+    return {
+        tile: filename for tile, filename in zip(tiles, filenames)
+        if os.path.exists(filename) and os.path.getsize(filename) > 0
+    }
+
+
+def sampleDSMTiles(cloud, xs, ys, lons, lats, method=SAMPLE_MAX, buffer=DEFAULT_LINK_BUFFER):
+    """
+    Sample the cloud's DSM tiles at the given points, NaN where there is no tile or no data
+
+    xs, ys - sample coordinates in the reference frame of the cloud
+    lons, lats - the same samples in EPSG:4326, used to find the tiles
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+    import rasterio
+    from rasterio.windows import Window
+
+    heights = np.full(len(xs), np.nan)
+    tile_x, tile_y = tileIndices(lons, lats)
+    tiles = sorted(set(zip(tile_x.tolist(), tile_y.tolist())))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        local_tiles = fetchDSMTiles(cloud, tiles, tmp_dir)
+        for (x, y), filename in local_tiles.items():
+            in_tile = np.flatnonzero((tile_x == x) & (tile_y == y))
+            with rasterio.open(filename) as dataset:
+                radius = max(0, int(np.ceil(buffer / abs(dataset.transform.a)))) if method == SAMPLE_MAX else 1
+                cols, rows = ~dataset.transform * (xs[in_tile], ys[in_tile])
+                cols = np.asarray(cols)
+                rows = np.asarray(rows)
+                # Only read the window of the tile the link passes through
+                col_off = int(max(0, np.floor(cols.min()) - radius))
+                row_off = int(max(0, np.floor(rows.min()) - radius))
+                col_end = int(min(dataset.width, np.floor(cols.max()) + radius + 2))
+                row_end = int(min(dataset.height, np.floor(rows.max()) + radius + 2))
+                if col_end <= col_off or row_end <= row_off:
+                    continue
+                band = readDSMBand(
+                    dataset, window=Window(col_off, row_off, col_end - col_off, row_end - row_off)
+                ).astype(np.float64)
+                band[band <= DSM_NODATA] = np.nan
+                heights[in_tile] = sampleRaster(band, cols - col_off, rows - row_off, method, radius)
+    return heights
+
+
+def fillMissingHeights(heights, start, end, lonlat, cloud, fallback):
+    """
+    Read the stretch of samples [start, end] without tiles from the point cloud
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    if end == start:
+        # A single missing sample is not worth a point cloud query, use its neighbours
+        neighbours = heights[max(0, start - 1):start + 2]
+        if not np.all(np.isnan(neighbours)):
+            heights[start] = np.nanmax(neighbours)
+            return
+        end = min(start + 1, len(heights) - 1)
+        start = max(0, end - 1)
+        if end == start:
+            return
+    # Samples of the sub link line up with the samples of the link
+    sublink = LineString([tuple(lonlat[start]), tuple(lonlat[end])], srid=4326)
+    try:
+        profile = np.asarray(fallback(sublink, cloud, end - start + 1), dtype=np.float64)
+    except Exception:
+        logging.exception(f'failed to fill missing dsm samples from {cloud.name}')
+        return
+    heights[start:end + 1] = np.where(np.isnan(heights[start:end + 1]), profile, heights[start:end + 1])
+
+
+def createDSMProfileSource(fallback, method=SAMPLE_MAX, link_buffer=DEFAULT_LINK_BUFFER):
+    """
+    Returns a LidarEngine profile source that samples the DSM tiles along the link
+
+    fallback - profile source (link, cloud, num_samples) used for the stretch of the link
+        the tiles do not cover
+    """
+
+    def getSegmentProfile(link, cloud, num_samples):
+        # Lazy Import To Improve Start Time
+        import numpy as np
+
+        if num_samples == 0:
+            return []
+        link_T = link.transform(cloud.srs, clone=True)
+        (x0, y0), (x1, y1) = link_T[0], link_T[-1]
+        t = np.linspace(0., 1., num_samples)
+        xs = x0 + t * (x1 - x0)
+        ys = y0 + t * (y1 - y0)
+        samples = MultiPoint([Point(x, y) for x, y in zip(xs, ys)], srid=cloud.srs).transform(4326, clone=True)
+        lonlat = np.array(samples.coords).reshape(-1, 2)
+
+        try:
+            heights = sampleDSMTiles(cloud, xs, ys, lonlat[:, 0], lonlat[:, 1], method, link_buffer)
+        except Exception:
+            logging.exception(f'failed to sample dsm tiles for {cloud.name}')
+            heights = np.full(num_samples, np.nan)
+
+        missing = np.flatnonzero(np.isnan(heights))
+        if len(missing) == num_samples:
+            return fallback(link, cloud, num_samples)
+        if len(missing) > 0:
+            fillMissingHeights(heights, missing[0], missing[-1], lonlat, cloud, fallback)
+        if np.all(np.isnan(heights)):
+            raise Exception('No LiDAR Points Found')
+        # LidarEngine interpolates the samples that are still missing
+        return heights.tolist()
+
+    return getSegmentProfile
@@ -0,0 +1,200 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+"""
+Host-local read-through cache for the DSM tiles in s3
+
+Viewsheds, DSM exports and surface height lookups in the same area read the same tiles again
+and again. Tiles are kept in a directory shared by every worker on the host, keyed by s3 key
+and ETag, and hard linked (copied across filesystems) to where the caller wants them.
+
+A tile's ETag is revalidated with a HEAD request once it has been cached for REVALIDATE_INTERVAL_S,
+a tile rebuilt in s3 is then downloaded again under its new ETag.
+
+layout: <LIDAR_CACHE_DIRECTORY>/dsm/<key hash>/{etag,<etag>.tif}
+"""
+import concurrent.futures
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+
+from IspToolboxApp.util import s3
+from mmwave.lidar_utils.ept_cache import LocalFileCache
+
+MAX_DOWNLOAD_WORKERS = s3.max_workers
+REVALIDATE_INTERVAL_S = 60 * 60
+_ETAG_UNSAFE_CHARACTERS = re.compile(r'[^A-Za-z0-9-]')
+
+
+def _normalizeETag(etag: str) -> str:
+    # ETags are quoted and multipart uploads add a -<parts> suffix
+    return _ETAG_UNSAFE_CHARACTERS.sub('_', etag.strip('"'))
+
+
+def _linkOrCopy(path: str, filename: str):
+    if os.path.lexists(filename):
+        os.remove(filename)
+    try:
+        os.link(path, filename)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(path, filename)
+
+
+class DSMTileCache(LocalFileCache):
+    """
+    Size-bounded LRU cache of DSM tiles on local disk
+
+    Callers get hard links to the cached tiles, so a tile evicted while it is in use stays
+    readable until the caller is done with it.
+    """
+    name = 'dsm'
+
+    def __init__(self, directory: str, max_bytes: int):
+        super().__init__(directory, max_bytes)
+        self.revalidations = 0
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        with self._stats_lock:
+            stats['revalidations'] = self.revalidations
+        return stats
+
+    def readMultiple(self, keys, filenames, bucket_name=s3.bucket_name):
+        """
+        Cached `s3.readMultipleS3Objects`: tiles that fail to download are skipped
+        """
+        with concurrent.futures.ThreadPoolExecutor(MAX_DOWNLOAD_WORKERS) as executor:
+            futures = [
+                executor.submit(self._readOrFallback, key, filename, bucket_name)
+                for key, filename in zip(keys, filenames)
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    pass
+        self._maybeEvict()
+
+    def readObject(self, key: str, fp, bucket_name=s3.bucket_name):
+        """
+        Cached `s3.readFromS3`
+        """
+        with open(self.getLocalPath(key, bucket_name), 'rb') as f:
+            shutil.copyfileobj(f, fp)
+        fp.flush()
+        self._maybeEvict()
+
+    def read(self, key: str, filename: str, bucket_name=s3.bucket_name):
+        """
+        Place the tile at `filename`
+        """
+        try:
+            _linkOrCopy(self.getLocalPath(key, bucket_name), filename)
+        except FileNotFoundError:
+            # Evicted between the lookup and the link
+            _linkOrCopy(self.getLocalPath(key, bucket_name), filename)
+
+    def getLocalPath(self, key: str, bucket_name=s3.bucket_name) -> str:
+        """
+        Returns the path of the cached tile, downloading it if it is missing or stale
+        """
+        entry_dir = self._entryDirectory(key, bucket_name)
+        etag_path = os.path.join(entry_dir, 'etag')
+        etag, checked = self._readETag(etag_path)
+        if etag is not None and time.time() - checked < REVALIDATE_INTERVAL_S:
+            path = self._touch(os.path.join(entry_dir, f'{etag}.tif'))
+            if path is not None:
+                return path
+
+        # Only one process on the host downloads a given tile, the others wait on the lock
+        with self._lock(entry_dir):
+            etag, checked = self._readETag(etag_path)
+            path = os.path.join(entry_dir, f'{etag}.tif')
+            if etag is not None and os.path.exists(path):
+                if time.time() - checked >= REVALIDATE_INTERVAL_S:
+                    with self._stats_lock:
+                        self.revalidations += 1
+                    current = s3.getObjectETag(key, bucket_name)
+                    if current is not None and _normalizeETag(current) == etag:
+                        os.utime(etag_path)
+                        checked = time.time()
+                if time.time() - checked < REVALIDATE_INTERVAL_S and self._touch(path) is not None:
+                    return path
+            return self._download(key, bucket_name, entry_dir, etag)
+
+    def _entryDirectory(self, key: str, bucket_name: str) -> str:
+        digest = hashlib.sha1(f'{bucket_name}/{key}'.encode()).hexdigest()[:20]
+        return os.path.join(self.directory, 'dsm', digest)
+
+    @staticmethod
+    def _readETag(etag_path: str):
+        """
+        Returns (ETag of the cached tile, time it was last checked against s3)
+        """
+        try:
+            with open(etag_path) as f:
+                return f.read(), os.path.getmtime(etag_path)
+        except FileNotFoundError:
+            return None, None
+
+    def _touch(self, path: str):
+        try:
+            # Refresh modification time, eviction is least-recently-used by mtime
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        with self._stats_lock:
+            self.hits += 1
+        return path
+
+    def _download(self, key: str, bucket_name: str, entry_dir: str, stale_etag: str) -> str:
+        os.makedirs(entry_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=entry_dir, suffix='.partial')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                etag = _normalizeETag(s3.readS3ObjectWithETag(key, f, bucket_name))
+            path = os.path.join(entry_dir, f'{etag}.tif')
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._atomicWrite(os.path.join(entry_dir, 'etag'), etag.encode())
+        if stale_etag is not None and stale_etag != etag:
+            try:
+                os.remove(os.path.join(entry_dir, f'{stale_etag}.tif'))
+            except FileNotFoundError:
+                pass
+        with self._stats_lock:
+            self.misses += 1
+            self.bytes_downloaded += os.path.getsize(path)
+        return path
+
+    def _readOrFallback(self, key: str, filename: str, bucket_name: str):
+        try:
+            self.read(key, filename, bucket_name)
+        except (ClientError, FileNotFoundError):
+            # Missing tile, skipped like in readMultipleS3Objects
+            raise
+        except Exception:
+            logging.exception(f'dsm tile cache failed, reading from s3: {key}')
+            s3.readMultipleS3Objects([key], [filename], bucket_name)
+
+    def _evictableFiles(self):
+        for root, _, files in os.walk(os.path.join(self.directory, 'dsm')):
+            for name in files:
+                if name.endswith('.tif'):
+                    yield os.path.join(root, name)
+
+
+dsm_tile_cache = DSMTileCache(
+    settings.LIDAR_CACHE_DIRECTORY,
+    settings.DSM_TILE_CACHE_MAX_BYTES,
+)
@@ -0,0 +1,371 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+"""
+Viewsheds of a DSM computed in process with NumPy
+
+Same algorithm and outputs as gdal_viewshed (https://gdal.org/programs/gdal_viewshed.html): the
+line of sight height of a cell is interpolated from the two cells next to it on the observer's
+side, sweeping outwards from the observer. The four 90° cones around the observer are swept one
+row (north and south) or one column (east and west) at a time, the cells of a row only depend on
+the previous row so every row is one vectorized step.
+
+Sectors only sweep the rows of the wedge between heading ± beamwidth / 2, and the cells the lines
+of sight of the wedge are interpolated from, so they match the full viewshed exactly.
+"""
+import math
+
+from django.contrib.gis.geos import GeometryCollection, MultiPoint, Point, Polygon
+
+from mmwave.lidar_utils.dsm_encoding import readDSMBand
+
+VIEWSHED_MODES = ('NORMAL', 'DEM', 'GROUND')
+# gdal_viewshed default, refraction makes the earth look flatter than it is
+VIEWSHED_CURVATURE_COEFF = 0.85714
+# Sphere diameter of EPSG:3857
+VIEWSHED_SPHERE_DIAMETER_M = 2 * 6378137.0
+# (bearing of the axis, sign of the bearing of positive lateral offsets, step, swept by columns)
+VIEWSHED_CONES = (
+    (0, 1, -1, False),
+    (180, -1, 1, False),
+    (270, -1, -1, True),
+    (90, 1, 1, True),
+)
+# Rows swept between two progress callbacks
+VIEWSHED_PROGRESS_ROWS = 256
+
+
+def viewshedWindow(transform, width: int, height: int, x: float, y: float, max_distance: float = None):
+    """
+    Observer pixel and window of the raster within `max_distance` of the observer, like gdal_viewshed
+
+    Returns:
+        (row, col, rasterio Window)
+    """
+    # Lazy Import To Improve Start Time
+    from rasterio.windows import Window
+
+    col = int(math.floor((x - transform.c) / transform.a))
+    row = int(math.floor((y - transform.f) / transform.e))
+    if not (0 <= row < height and 0 <= col < width):
+        raise ValueError('observer is outside of the DSM')
+    if not max_distance:
+        return row, col, Window(0, 0, width, height)
+    dx, dy = max_distance / abs(transform.a), max_distance / abs(transform.e)
+    col_off, row_off = max(int(math.floor(col - dx)), 0), max(int(math.floor(row - dy)), 0)
+    col_end, row_end = min(int(math.ceil(col + dx)) + 1, width), min(int(math.ceil(row + dy)) + 1, height)
+    return row, col, Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+
+def inSector(east, north, heading: float, beamwidth: float):
+    """
+    Whether the offsets from the observer are within heading ± beamwidth / 2, degrees clockwise from north
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    bearing = np.degrees(np.arctan2(east, north))
+    return np.abs((bearing - heading + 180) % 360 - 180) <= beamwidth / 2 + 1e-9
+
+
+def sectorFootprint(
+    x: float, y: float, heading: float, beamwidth: float, max_distance: float, steps: int = 64,
+    margin: float = 2.0
+) -> Polygon:
+    """
+    Area of the DSM a sector viewshed reads, in the units of x and y
+
+    The wedge between heading ± beamwidth / 2 and the cells its lines of sight are interpolated from:
+    a cell depends on the cells between it and the axis of its cone, and the diagonal back to the
+    observer. `margin` is added all around to cover the pixels on the edges.
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    start, end = heading - beamwidth / 2, heading + beamwidth / 2
+    bearings = set(np.linspace(start, end, max(int(math.ceil(steps * beamwidth / 360)), 1) + 1))
+    # The dependencies change shape on the axes and diagonals of the cones
+    bearings.update(range(int(math.ceil(start / 45)) * 45, int(end) + 1, 45))
+    bearings = sorted(bearings)
+
+    def dependencies(bearing):
+        dx = max_distance * math.sin(math.radians(bearing))
+        dy = max_distance * math.cos(math.radians(bearing))
+        if abs(dy) >= abs(dx):
+            axis, diagonal = (0, dy - math.copysign(abs(dx), dy)), (dx, math.copysign(abs(dx), dy))
+        else:
+            axis, diagonal = (dx - math.copysign(abs(dy), dx), 0), (math.copysign(abs(dy), dx), dy)
+        return [(x + dx, y + dy), (x + axis[0], y + axis[1]), (x + diagonal[0], y + diagonal[1])]
+
+    hulls = []
+    for first, second in zip(bearings[:-1], bearings[1:]):
+        points = [Point(x, y)] + [Point(*p) for p in dependencies(first) + dependencies(second)]
+        hulls.append(MultiPoint(*points).convex_hull)
+    # The arc between two bearings bulges out of their chord
+    chord = max((b - a for a, b in zip(bearings[:-1], bearings[1:])), default=0)
+    buffer = max_distance * (1 - math.cos(math.radians(chord / 2))) + margin
+    return GeometryCollection(*hulls).unary_union.buffer(buffer)
+
+
+def computeViewshed(
+    dsm, row: int, col: int, observer_height: float, target_height: float = 0.0,
+    resolution=(1.0, 1.0), max_distance: float = None, mode: str = 'GROUND',
+    curvature_coeff: float = VIEWSHED_CURVATURE_COEFF, heading: float = None, beamwidth: float = None,
+    visible_value: float = 255, invisible_value: float = 0, out_of_range_value: float = 0,
+    progress_callback=None,
+):
+    """
+    Viewshed of the observer at (row, col) of a DSM array, see the gdal_viewshed options
+
+    observer_height - height of the observer above the DSM (-oz)
+    target_height - height of the targets above the DSM (-tz), NORMAL mode only
+    resolution - (x, y) pixel size in the units of `max_distance`
+    mode - NORMAL: visible / invisible values, DEM: lowest visible height of a target,
+        GROUND: lowest visible height of a target above the DSM
+    heading, beamwidth - only compute the sector heading ± beamwidth / 2, degrees clockwise from north
+    progress_callback - called with the fraction of rows swept so far
+
+    Returns:
+        array with the shape of `dsm`, uint8 in NORMAL mode and float64 otherwise. Cells beyond
+        `max_distance` or outside of the sector are `out_of_range_value`
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    if mode not in VIEWSHED_MODES:
+        raise ValueError(f'unknown viewshed mode: {mode}')
+    res_x, res_y = abs(float(resolution[0])), abs(float(resolution[1]))
+    cones = _planCones(dsm.shape, row, col, res_x, res_y, max_distance, heading, beamwidth)
+
+    # Only the bounding box of the cells to sweep is read
+    top, bottom, left, right = _sweepExtent(cones, row, col)
+    window = (slice(top, bottom + 1), slice(left, right + 1))
+    shape = dsm.shape
+    dsm = np.asarray(dsm[window], dtype=np.float64)
+    row, col = row - top, col - left
+    rows, cols = np.ogrid[:dsm.shape[0], :dsm.shape[1]]
+    distance2 = ((cols - col) * res_x) ** 2 + ((rows - row) * res_y) ** 2
+    elevation = dsm - curvature_coeff * distance2 / VIEWSHED_SPHERE_DIAMETER_M
+    z_observer = elevation[row, col] + observer_height
+
+    # Height of the line of sight over each cell, NaN where it is not computed
+    los = np.full(dsm.shape, np.nan)
+    los[row, col] = elevation[row, col]
+    # Height of the horizon the cells further out see
+    horizon = elevation.copy()
+    # Cells of the viewshed, the others are swept only because its lines of sight are interpolated from them
+    in_range = np.zeros(dsm.shape, dtype=bool)
+    in_range[row, col] = True
+
+    total = max(sum(int(np.count_nonzero(cone[2][1:] <= cone[3][1:])) for cone in cones), 1)
+    swept = 0
+    for step, transposed, lo, hi, _, _, slopes in cones:
+        arrays = (elevation.T, horizon.T, los.T) if transposed else (elevation, horizon, los)
+        in_cone = in_range.T if transposed else in_range
+        o_row, o_col = (col, row) if transposed else (row, col)
+        # Lateral offsets of the whole row, sliced for every row swept
+        offsets = np.arange(-o_col, arrays[0].shape[1] - o_col)
+        lateral = (offsets, np.abs(offsets), np.sign(offsets))
+        for k in range(1, len(lo)):
+            if lo[k] > hi[k]:
+                continue
+            _sweepRow(*arrays, o_row, o_col, step, k, int(lo[k]), int(hi[k]), lateral, z_observer)
+            for start, end in [(-k, k)] if slopes is None else slopes:
+                a, b = max(int(lo[k]), math.ceil(k * start - 1e-9)), min(int(hi[k]), math.floor(k * end + 1e-9))
+                in_cone[o_row + step * k, o_col + a:o_col + b + 1] = True
+            swept += 1
+            if progress_callback is not None and swept % VIEWSHED_PROGRESS_ROWS == 0:
+                progress_callback(swept / total)
+    if progress_callback is not None:
+        progress_callback(1.0)
+
+    if mode == 'NORMAL':
+        swept_viewshed = np.where(elevation + target_height >= los, visible_value, invisible_value).astype(np.uint8)
+    elif mode == 'DEM':
+        swept_viewshed = los - elevation + dsm
+    else:
+        swept_viewshed = np.fmax(los - elevation, 0)
+    swept_viewshed[~in_range] = out_of_range_value
+    viewshed = np.full(shape, out_of_range_value, dtype=swept_viewshed.dtype)
+    viewshed[window] = swept_viewshed
+    return viewshed
+
+
+def _planCones(shape, row, col, res_x, res_y, max_distance, heading, beamwidth):
+    """
+    Lateral offsets from the observer of the cells to sweep in each row of each cone
+
+    Returns:
+        list of [step, transposed, lo, hi, bound_lo, bound_hi, slopes] of the VIEWSHED_CONES,
+        see `_wedgeBounds` for the slopes, None when there is no sector
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    sector = heading is not None and beamwidth is not None and beamwidth < 360
+    cones = []
+    for axis, sense, step, transposed in VIEWSHED_CONES:
+        height, width = shape[::-1] if transposed else shape
+        o_row, o_col = (col, row) if transposed else (row, col)
+        res_axis, res_lat = (res_x, res_y) if transposed else (res_y, res_x)
+        length = o_row if step < 0 else height - 1 - o_row
+        bound_lo, bound_hi = _coneBounds(length, transposed, -o_col, width - 1 - o_col, res_axis, res_lat, max_distance)
+        lo, hi, slopes = bound_lo, bound_hi, None
+        if sector:
+            wedge_lo, wedge_hi, slopes = _wedgeBounds(length, axis, sense, heading, beamwidth, res_axis, res_lat)
+            lo, hi = np.maximum(lo, wedge_lo), np.minimum(hi, wedge_hi)
+        cones.append([step, transposed, lo, hi, bound_lo, bound_hi, slopes])
+    if sector:
+        _addDependencies(cones)
+    return cones
+
+
+def _sweepExtent(cones, row, col):
+    """
+    (top, bottom, left, right) rows and columns of the cells the cones sweep, the observer included
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    top, bottom, left, right = row, row, col, col
+    for step, transposed, lo, hi, _, _, _ in cones:
+        swept = np.flatnonzero(lo <= hi)
+        if len(swept) == 0:
+            continue
+        o_row, o_col = (col, row) if transposed else (row, col)
+        axis = sorted([o_row, o_row + step * int(swept.max())])
+        lateral = [o_col + int(lo[swept].min()), o_col + int(hi[swept].max())]
+        rows, cols = (lateral, axis) if transposed else (axis, lateral)
+        top, bottom = min(top, rows[0]), max(bottom, rows[1])
+        left, right = min(left, cols[0]), max(right, cols[1])
+    return top, bottom, left, right
+
+
+def _coneBounds(length, strict, lateral_min, lateral_max, res_axis, res_lat, max_distance):
+    """
+    Smallest and largest lateral offset of the cells of each row of a cone, rows 0 to `length`
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    k = np.arange(length + 1)
+    half = k - 1 if strict else k
+    lo, hi = np.maximum(-half, lateral_min), np.minimum(half, lateral_max)
+    if max_distance:
+        lateral = np.sqrt(np.clip(max_distance ** 2 - (k * res_axis) ** 2, 0, None)) / res_lat
+        lateral = np.floor(lateral + 1e-9).astype(int)
+        lateral[k * res_axis > max_distance] = -1
+        lo, hi = np.maximum(lo, -lateral), np.minimum(hi, lateral)
+    return lo, hi
+
+
+def _wedgeBounds(length, axis, sense, heading, beamwidth, res_axis, res_lat):
+    """
+    Lateral offsets of each row of a cone that cover the sector
+
+    Returns:
+        (lo, hi, slopes), the cells of the sector k rows out are the lateral offsets between
+        k * start and k * end of any of the (start, end) slopes
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    k = np.arange(length + 1)
+    lo, hi = np.ones(length + 1, dtype=int), np.zeros(length + 1, dtype=int)
+    # Sector relative to the axis of the cone, positive angles towards positive lateral offsets
+    center = (sense * (heading - axis) + 180) % 360 - 180
+    limit = math.degrees(math.atan2(res_lat, res_axis))
+    arcs = [
+        (max(center - beamwidth / 2 + shift, -limit), min(center + beamwidth / 2 + shift, limit))
+        for shift in (-360, 0, 360)
+    ]
+    arcs = [(start, end) for start, end in arcs if start <= end]
+    if len(arcs) == 0:
+        return lo, hi, []
+    ratio = res_axis / res_lat
+    slopes = [(math.tan(math.radians(start)) * ratio, math.tan(math.radians(end)) * ratio) for start, end in arcs]
+    start, end = min(start for start, _ in slopes), max(end for _, end in slopes)
+    return np.floor(k * start).astype(int), np.ceil(k * end).astype(int), slopes
+
+
+def _addDependencies(cones):
+    """
+    Extend the rows of every cone to the cells the sector's lines of sight are interpolated from
+
+    The cell k rows out at lateral offset c depends on the cells k - 1 rows out at c and c - sign(c),
+    the east and west cones also depend on the diagonals the north and south cones sweep.
+    """
+    for index in (2, 3, 0, 1):
+        step, transposed, lo, hi, bound_lo, bound_hi, _ = cones[index]
+        for k in range(len(lo) - 2, 0, -1):
+            if lo[k + 1] > hi[k + 1]:
+                continue
+            a, b = int(lo[k + 1]), int(hi[k + 1])
+            a, b = (a - 1 if a > 0 else a), (b + 1 if b < 0 else b)
+            if transposed:
+                # North (negative lateral offsets) and south diagonals, the lateral offset of the
+                # diagonal in those cones is the offset along this cone's axis
+                for side, needed in ((0, a <= -k), (1, b >= k)):
+                    if needed:
+                        _extendRow(cones[side], k, step * k, step * k)
+            _extendRow(cones[index], k, max(a, int(bound_lo[k])), min(b, int(bound_hi[k])))
+
+
+def _extendRow(cone, k, a, b):
+    lo, hi = cone[2], cone[3]
+    if a > b:
+        return
+    if lo[k] > hi[k]:
+        lo[k], hi[k] = a, b
+    else:
+        lo[k], hi[k] = min(lo[k], a), max(hi[k], b)
+
+
+def _sweepRow(elevation, horizon, los, row, col, step, k, lo, hi, lateral, z_observer):
+    """
+    Line of sight heights of the cells k rows away from the observer, lateral offsets lo to hi
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    r = row + step * k
+    cells = slice(col + lo, col + hi + 1)
+    if k == 1:
+        # Cells next to the observer are always visible
+        los[r, cells] = elevation[r, cells]
+        return
+    offsets, distances, signs = (values[col + lo:col + hi + 1] for values in lateral)
+    previous = horizon[r - step]
+    # Interpolate the horizon where the line of sight crosses the previous row, then extend it to this row
+    diagonal = previous[col + offsets - signs]
+    straight = previous[cells]
+    z = z_observer + ((straight - z_observer) * k + (diagonal - straight) * distances) / (k - 1)
+    los[r, cells] = z
+    horizon[r, cells] = np.maximum(elevation[r, cells], z)
+
+
+def readViewshedDSM(dsm_filepath: str, x: float, y: float, max_distance: float = None):
+    """
+    Read the window of the DSM a viewshed of the observer at (x, y) needs
+
+    Returns:
+        (heights, row, col, transform, crs), (row, col) is the observer in `heights`
+    """
+    # Lazy Import To Improve Start Time
+    import rasterio
+
+    with rasterio.open(dsm_filepath) as dataset:
+        row, col, window = viewshedWindow(dataset.transform, dataset.width, dataset.height, x, y, max_distance)
+        heights = readDSMBand(dataset, window=window)
+        transform = dataset.window_transform(window)
+        crs = dataset.crs
+    return heights, row - int(window.row_off), col - int(window.col_off), transform, crs
+
+
+def writeViewshed(output_filepath: str, viewshed, transform, crs):
+    # Lazy Import To Improve Start Time
+    import rasterio
+
+    with rasterio.open(
+        output_filepath, 'w', driver='GTiff', width=viewshed.shape[1], height=viewshed.shape[0], count=1,
+        dtype=viewshed.dtype, crs=crs, transform=transform, compress='deflate'
+    ) as dataset:
+        dataset.write(viewshed, 1)
@@ -0,0 +1,369 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+"""
+Host-local read-through cache for Entwine Point Tile (EPT) point clouds
+
+PDAL's readers.ept fetches octree chunks straight from the remote entwine buckets,
+so every link profile, DSM export and tiling job downloads the same chunks again.
+This module mirrors the parts of an EPT dataset a query needs (ept.json, the hierarchy
+and the data chunks) into a directory shared by every worker on the host, and hands
+PDAL the local ept.json instead of the remote url.
+
+layout: <LIDAR_CACHE_DIRECTORY>/ept/<dataset hash>/{ept.json,ept-hierarchy/,ept-data/}
+"""
+import concurrent.futures
+import fcntl
+import hashlib
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from django.conf import settings
+
+# Number of lock files used to serialize downloads of the same chunk across processes
+NUMBER_LOCK_STRIPES = 256
+MAX_DOWNLOAD_WORKERS = 16
+DOWNLOAD_TIMEOUT_S = 60
+# Refresh ept.json once a day in case the dataset is rebuilt upstream
+METADATA_TTL_S = 24 * 60 * 60
+# Don't evict chunks that were used recently, a PDAL pipeline might still be reading them
+EVICTION_GRACE_PERIOD_S = 10 * 60
+EVICTION_INTERVAL_S = 60
+# Evict down to this fraction of the byte budget to avoid evicting on every download
+EVICTION_LOW_WATERMARK = 0.9
+
+EPT_DATA_EXTENSIONS = {
+    'laszip': 'laz',
+    'binary': 'bin',
+    'zstandard': 'zst',
+}
+
+
+class LocalFileCache:
+    """
+    Size-bounded LRU cache of files on local disk
+
+    Safe to share between processes: work on the same file is serialized with file locks
+    and files are written to a temporary name then atomically renamed.
+
+    Subclasses set `name`, the cache's subdirectory for lock files and log messages, and list
+    the files that count towards the byte budget in `_evictableFiles`.
+
+    Attributes
+    ----------
+    directory : str
+        root directory of the cache
+    max_bytes : int
+        byte budget for evictable files, least recently used files are evicted first
+    """
+    name = None
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._stats_lock = threading.Lock()
+        self._last_eviction = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_downloaded = 0
+        self.evictions = 0
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total > 0 else 0.,
+                'bytes_downloaded': self.bytes_downloaded,
+                'evictions': self.evictions,
+            }
+
+    def _atomicWrite(self, path: str, content: bytes):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.partial')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _lock(self, path: str):
+        """
+        Lock used to serialize work on `path` across processes, paths share a fixed number of lock files
+        """
+        stripe = int(hashlib.sha1(path.encode()).hexdigest(), 16) % NUMBER_LOCK_STRIPES
+        return self._lockFile(f'{stripe}.lock')
+
+    @contextmanager
+    def _lockFile(self, name: str, blocking: bool = True):
+        lock_dir = os.path.join(self.directory, 'locks', self.name)
+        os.makedirs(lock_dir, exist_ok=True)
+        with open(os.path.join(lock_dir, name), 'w') as lock_file:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_file, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _maybeEvict(self):
+        now = time.time()
+        if now - self._last_eviction < EVICTION_INTERVAL_S:
+            return
+        self._last_eviction = now
+        # Only one process evicts at a time, the others skip
+        with self._lockFile('evict.lock', blocking=False) as acquired:
+            if acquired:
+                self._evict()
+
+    def _evictableFiles(self):
+        """
+        Yields the paths of the files that count towards the byte budget
+        """
+        raise NotImplementedError
+
+    def _evict(self):
+        files = []
+        total = 0
+        for path in self._evictableFiles():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        if total <= self.max_bytes:
+            return
+
+        target = self.max_bytes * EVICTION_LOW_WATERMARK
+        cutoff = time.time() - EVICTION_GRACE_PERIOD_S
+        evicted = 0
+        for mtime, size, path in sorted(files):
+            if total <= target or mtime > cutoff:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        with self._stats_lock:
+            self.evictions += evicted
+        logging.info(f'{self.name} cache: evicted {evicted} files, {total}B remaining')
+
+
+class EPTChunkCache(LocalFileCache):
+    """
+    Size-bounded LRU cache of EPT octree chunks on local disk
+
+    Only point data chunks count towards the byte budget, metadata and hierarchy files
+    are small and needed by every query.
+    """
+    name = 'ept'
+
+    def getLocalEPT(self, url: str, bounds: tuple, resolution: float) -> str:
+        """
+        Make sure every chunk PDAL needs to read `bounds` at `resolution` is on local disk
+
+        Args:
+            url: remote url of the dataset's ept.json
+            bounds: (xmin, ymin, xmax, ymax) in the reference frame of the point cloud
+            resolution: readers.ept resolution of the query
+
+        Returns:
+            path to the local copy of ept.json
+        """
+        dataset_dir = self._datasetDirectory(url)
+        self.getLocalChunks(url, bounds, resolution)
+        return os.path.join(dataset_dir, 'ept.json')
+
+    def getMetadata(self, url: str) -> dict:
+        """
+        Contents of the dataset's ept.json
+        """
+        return self._loadMetadata(url, self._datasetDirectory(url))
+
+    def getLocalChunks(self, url: str, bounds: tuple, resolution: float, depth_begin: int = 0) -> tuple:
+        """
+        Download the point data chunks for `bounds` at `resolution`, skipping octree levels
+        shallower than `depth_begin` (already read at a lower resolution)
+
+        Returns:
+            (list of local chunk paths, octree depth the chunks extend to (exclusive))
+        """
+        base_url = url.rsplit('/', 1)[0] + '/'
+        dataset_dir = self._datasetDirectory(url)
+        info = self._loadMetadata(url, dataset_dir)
+
+        extension = EPT_DATA_EXTENSIONS[info['dataType']]
+        depth_end = self._depthEnd(info, resolution)
+        keys = self._requiredKeys(base_url, dataset_dir, info, bounds, depth_begin, depth_end)
+        paths = [os.path.join(dataset_dir, 'ept-data', f'{key}.{extension}') for key in keys]
+        with concurrent.futures.ThreadPoolExecutor(MAX_DOWNLOAD_WORKERS) as executor:
+            futures = [
+                executor.submit(self._fetch, f'{base_url}ept-data/{key}.{extension}', path)
+                for key, path in zip(keys, paths)
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+
+        self._maybeEvict()
+        return paths, depth_end
+
+    def _datasetDirectory(self, url: str) -> str:
+        digest = hashlib.sha1(url.encode()).hexdigest()[:20]
+        return os.path.join(self.directory, 'ept', digest)
+
+    def _loadMetadata(self, url: str, dataset_dir: str) -> dict:
+        path = os.path.join(dataset_dir, 'ept.json')
+        with self._lock(path):
+            stale = (
+                not os.path.exists(path) or
+                time.time() - os.path.getmtime(path) > METADATA_TTL_S
+            )
+            if stale:
+                content = self._download(url)
+                if os.path.exists(path):
+                    with open(path, 'rb') as f:
+                        if f.read() != content:
+                            # Dataset was rebuilt upstream, drop everything we have for it
+                            self._removeDataset(dataset_dir)
+                self._atomicWrite(path, content)
+        with open(path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def _depthEnd(info: dict, resolution: float):
+        """
+        Octree depth (exclusive) readers.ept reads down to for the requested resolution
+        """
+        if not resolution:
+            return math.inf
+        width = info['bounds'][3] - info['bounds'][0]
+        return max(1, math.ceil(math.log2(width / info['span'] / resolution)) + 1)
+
+    def _requiredKeys(
+        self, base_url: str, dataset_dir: str, info: dict, bounds: tuple, depth_begin: int, depth_end: int
+    ) -> list:
+        """
+        Walk the octree hierarchy and return the keys of the nodes PDAL will read
+
+        Mirrors readers.ept's node selection: nodes that overlap the query bounds and are shallower
+        than the depth implied by the requested resolution
+        """
+        cube = info['bounds']
+        width = cube[3] - cube[0]
+        keys = []
+        visited = set()
+        pending = ['0-0-0-0']
+        while pending:
+            hierarchy_key = pending.pop()
+            if hierarchy_key in visited:
+                continue
+            visited.add(hierarchy_key)
+            hierarchy = json.loads(self._fetch(
+                f'{base_url}ept-hierarchy/{hierarchy_key}.json',
+                os.path.join(dataset_dir, 'ept-hierarchy', f'{hierarchy_key}.json'),
+                read=True
+            ))
+            for key, count in hierarchy.items():
+                d, x, y, _ = (int(v) for v in key.split('-'))
+                if d >= depth_end:
+                    continue
+                size = width / 2 ** d
+                node_xmin = cube[0] + x * size
+                node_ymin = cube[1] + y * size
+                overlaps = (
+                    node_xmin <= bounds[2] and node_xmin + size >= bounds[0] and
+                    node_ymin <= bounds[3] and node_ymin + size >= bounds[1]
+                )
+                if not overlaps:
+                    continue
+                if count == -1:
+                    # Subtree is stored in its own hierarchy file
+                    pending.append(key)
+                elif count > 0 and d >= depth_begin:
+                    keys.append(key)
+        return keys
+
+    def _fetch(self, url: str, path: str, read: bool = False):
+        """
+        Return a cached file, downloading it if it is missing
+
+        Only one process on the host downloads a given file, the others wait on the lock and
+        then find it already cached
+        """
+        if not os.path.exists(path):
+            with self._lock(path):
+                if not os.path.exists(path):
+                    content = self._download(url)
+                    self._atomicWrite(path, content)
+                    with self._stats_lock:
+                        self.misses += 1
+                        self.bytes_downloaded += len(content)
+                    return content if read else None
+
+        with self._stats_lock:
+            self.hits += 1
+        try:
+            # Refresh modification time, eviction is least-recently-used by mtime
+            os.utime(path)
+        except FileNotFoundError:
+            return self._fetch(url, path, read)
+        if read:
+            with open(path, 'rb') as f:
+                return f.read()
+
+    def _download(self, url: str) -> bytes:
+        response = requests.get(url, timeout=DOWNLOAD_TIMEOUT_S)
+        response.raise_for_status()
+        return response.content
+
+    def _removeDataset(self, dataset_dir: str):
+        for subdir in ('ept-data', 'ept-hierarchy'):
+            directory = os.path.join(dataset_dir, subdir)
+            if os.path.isdir(directory):
+                for name in os.listdir(directory):
+                    os.remove(os.path.join(directory, name))
+
+    def _evictableFiles(self):
+        for root, _, files in os.walk(os.path.join(self.directory, 'ept')):
+            if os.path.basename(root) != 'ept-data':
+                continue
+            for name in files:
+                yield os.path.join(root, name)
+
+
+ept_chunk_cache = EPTChunkCache(
+    settings.LIDAR_CACHE_DIRECTORY,
+    settings.EPT_CHUNK_CACHE_MAX_BYTES,
+)
+
+
+def getCachedEPTPath(url: str, bounds: tuple, resolution: float) -> str:
+    """
+    Returns a path to a local copy of the EPT dataset with all the chunks required
+    for the query, falls back to the remote url if the cache is unavailable
+    """
+    try:
+        start = time.time()
+        path = ept_chunk_cache.getLocalEPT(url, bounds, resolution)
+        logging.info(f'ept chunk cache: {time.time() - start:.3f}s {ept_chunk_cache.stats()}')
+        return path
+    except Exception:
+        logging.exception(f'ept chunk cache failed, reading from remote: {url}')
+        return url
@@ -1,5 +1,10 @@
 # (c) Meta Platforms, Inc. and affiliates. Copyright
 from django.db import connections
+from django.core.cache import caches
+from datetime import datetime
+import logging
+import threading
+import time
 
 _FESM_LPC_PROJ_QUERY = """
 SELECT s_date, e_date
@@ -7,12 +12,141 @@ FROM fesm_lpc_proj
 WHERE LOWER(project_id)=LOWER(%s)
 """
 
+_FESM_LPC_PROJ_ALL_QUERY = """
+SELECT LOWER(project_id), s_date, e_date
+FROM fesm_lpc_proj
+"""
+
+COLLECTION_DATES_VERSION_KEY = 'lidar_collection_dates_version'
+COLLECTION_DATES_CACHE_NAME = 'los'
+# Reload the lookup tables at least this often, even if the version stamp did not change
+COLLECTION_DATES_TTL_S = 6 * 60 * 60
+COLLECTION_DATES_VERSION_CHECK_INTERVAL_S = 60
+
+
+class CollectionDateLookup:
+    """
+    In-memory lookup tables of point cloud collection dates
+
+    project years: fesm_lpc_proj project_id -> (start year, end year), used to name sources
+    start dates: USGS WESM workunit -> collection start date, used to sort point clouds
+
+    Both tables are loaded with one query each and kept for COLLECTION_DATES_TTL_S, or until the
+    WESM metadata update bumps the version stamp.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._last_check = 0
+        self._version = None
+        # None when the table failed to load
+        self._project_years = None
+        self._start_dates = None
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def getProjectYears(self, project_id):
+        self._ensureLoaded()
+        if self._project_years is None:
+            raise LookupError('collection years lookup is unavailable')
+        return self._project_years.get(project_id.lower(), (None, None))
+
+    def getStartDate(self, workunit):
+        self._ensureLoaded()
+        if self._start_dates is None:
+            raise LookupError('collection start date lookup is unavailable')
+        return self._start_dates.get(workunit, datetime.min)
+
+    def _ensureLoaded(self):
+        now = time.time()
+        fresh = self._loaded_at is not None and now - self._loaded_at < COLLECTION_DATES_TTL_S
+        if fresh and now - self._last_check < COLLECTION_DATES_VERSION_CHECK_INTERVAL_S:
+            return
+        with self._lock:
+            self._last_check = now
+            version = _getCollectionDatesVersion()
+            if fresh and version == self._version:
+                return
+            self._project_years = self._tryLoad(self._loadProjectYears)
+            self._start_dates = self._tryLoad(self._loadStartDates)
+            self._version = version
+            self._loaded_at = now
+
+    @staticmethod
+    def _tryLoad(loader):
+        try:
+            return loader()
+        except Exception:
+            logging.exception(f'failed to load lidar collection dates: {loader.__name__}')
+            return None
+
+    @staticmethod
+    def _loadProjectYears():
+        project_years = {}
+        with connections['gis_data'].cursor() as cursor:
+            cursor.execute(_FESM_LPC_PROJ_ALL_QUERY)
+            for project_id, s_date, e_date in cursor.fetchall():
+                if project_id is None or s_date is None or e_date is None:
+                    continue
+                if project_id not in project_years:
+                    project_years[project_id] = (s_date.year, e_date.year)
+        return project_years
+
+    @staticmethod
+    def _loadStartDates():
+        from mmwave.models import USGSLidarMetaDataModel
+
+        collect_starts = {}
+        for workunit, collect_start in USGSLidarMetaDataModel.objects.values_list('workunit', 'collect_start'):
+            collect_starts.setdefault(workunit, []).append(collect_start)
+
+        start_dates = {}
+        for workunit, dates in collect_starts.items():
+            # Mirrors `USGSLidarMetaDataModel.objects.get`, ambiguous workunits have no start date
+            if len(dates) != 1:
+                continue
+            try:
+                start_dates[workunit] = datetime.strptime(dates[0], '%Y-%m-%d')
+            except (TypeError, ValueError):
+                continue
+        return start_dates
+
+
+collection_date_lookup = CollectionDateLookup()
+
+
+def _getCollectionDatesVersion():
+    try:
+        return caches[COLLECTION_DATES_CACHE_NAME].get(COLLECTION_DATES_VERSION_KEY)
+    except Exception:
+        logging.exception('failed to read lidar collection dates version')
+        return None
+
+
+def bumpCollectionDatesVersion():
+    """
+    Reload the collection date lookup tables of every process, call after the WESM metadata changes
+    """
+    collection_date_lookup.invalidate()
+    try:
+        caches[COLLECTION_DATES_CACHE_NAME].set(COLLECTION_DATES_VERSION_KEY, time.time(), timeout=None)
+    except Exception:
+        logging.exception('failed to bump lidar collection dates version')
+
 
 def get_collection_years_for_project_id(project_id):
-    """Queries the database for start/end years for the given project id.
+    """Looks up start/end years for the given project id.
 
     Returns a tuple of start/end year if found, otherwise returns Nones
     """
+    try:
+        return collection_date_lookup.getProjectYears(project_id)
+    except LookupError:
+        pass
+
     with connections['gis_data'].cursor() as cursor:
         cursor.execute(_FESM_LPC_PROJ_QUERY, [project_id])
         row = cursor.fetchone()
@@ -23,3 +157,20 @@ def get_collection_years_for_project_id(project_id):
         else:
             s_date, e_date = row
             return s_date.year, e_date.year
+
+
+def get_collection_start_date(workunit):
+    """
+    Returns the collection start date of the WESM workunit, datetime.min if unknown
+    """
+    try:
+        return collection_date_lookup.getStartDate(workunit)
+    except LookupError:
+        pass
+
+    from mmwave.models import USGSLidarMetaDataModel
+    try:
+        metadata = USGSLidarMetaDataModel.objects.get(workunit=workunit)
+        return datetime.strptime(metadata.collect_start, '%Y-%m-%d')
+    except Exception:
+        return datetime.min
@@ -0,0 +1,220 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+"""
+Long-lived PDAL execution service for celery workers
+
+Heavy modules (pdal, numpy, scipy) are imported once when the worker process boots instead
+of on the first request, the static parts of pipelines are serialized once per
+(reader, filter set) and pipelines run on a bounded thread pool with per-request timeouts.
+"""
+import concurrent.futures
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+
+PDAL_FILTERS = {
+    'outlier': [
+        {
+            "class": 18,
+            "type": "filters.outlier",
+            "method": "statistical",
+            "mean_k": 12,
+            "multiplier": 2.2
+        },
+        {
+            "type": "filters.range",
+            "limits": "Classification![18:18]"
+        },
+    ],
+}
+
+
+class PDALServiceException(Exception):
+    pass
+
+
+class PDALTimeoutException(PDALServiceException):
+    pass
+
+
+class PDALServiceBusyException(PDALServiceException):
+    pass
+
+
+class PDALScratchDirectory:
+    """
+    Temporary directory for the files written by pipelines, use like `tempfile.TemporaryDirectory`
+
+    Pipelines that time out can not be interrupted and keep writing into the directory, so it is
+    only removed once the block exits and every pipeline tracked with `execute(..., scratch=)` is done.
+    """
+
+    def __init__(self):
+        self.name = tempfile.mkdtemp(prefix='pdal')
+        self._pending = set()
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def track(self, future):
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+            remove = self._closed and len(self._pending) == 0
+        if remove:
+            shutil.rmtree(self.name, ignore_errors=True)
+
+    def cleanup(self):
+        with self._lock:
+            self._closed = True
+            remove = len(self._pending) == 0
+        if remove:
+            shutil.rmtree(self.name, ignore_errors=True)
+        else:
+            logging.warning(f'{len(self._pending)} pdal pipelines still running, keeping {self.name}')
+
+    def __enter__(self):
+        return self.name
+
+    def __exit__(self, *args):
+        self.cleanup()
+
+
+class PDALPipelineTemplate:
+    """
+    Pipeline skeleton: reader -> static filters -> per-request stages
+
+    The static filter stages are serialized once, rendering a request only serializes the
+    stages that change (reader options, crop polygons, writers)
+    """
+
+    def __init__(self, reader: str, filters: tuple):
+        self.reader = reader
+        self.filters = filters
+        stages = [stage for name in filters for stage in PDAL_FILTERS[name]]
+        self._filters_json = ''.join(json.dumps(stage) + ',' for stage in stages)
+
+    def render(self, reader_options: dict, stages: list) -> str:
+        reader_stage = dict(reader_options, type=self.reader)
+        return (
+            '{"pipeline":[' + json.dumps(reader_stage) + ',' + self._filters_json +
+            ','.join(json.dumps(stage) for stage in stages) + ']}'
+        )
+
+
+@lru_cache(maxsize=None)
+def getPipelineTemplate(reader: str = 'readers.ept', filters: tuple = ()) -> PDALPipelineTemplate:
+    return PDALPipelineTemplate(reader, filters)
+
+
+def getFilterSet(use_outlier_filter: bool) -> tuple:
+    return ('outlier',) if use_outlier_filter else ()
+
+
+class PDALExecutionService:
+    """
+    Runs PDAL pipelines on a bounded pool of threads owned by the worker process
+
+    PDAL does the heavy lifting in C++, so a handful of threads keeps the worker busy without
+    the cost of spawning a `pdal` process per request. Requests beyond the pool size wait in a
+    bounded queue, and requests that do not complete in time raise a PDALTimeoutException.
+    A timed out request is only cancelled if it was still waiting for a worker: a running
+    pipeline can not be interrupted, it is abandoned and finishes in the background, its slot
+    is released then. Pipelines that write files should write them to a PDALScratchDirectory.
+
+    Attributes
+    ----------
+    max_workers : int
+        number of pipelines executing at the same time
+    max_pending : int
+        number of pipelines allowed to wait for a free worker
+    timeout : float
+        default per-request timeout (seconds), counted from submission
+    """
+
+    def __init__(self, max_workers: int, max_pending: int, timeout: float):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._executor = None
+        self._pid = None
+        self._executor_lock = threading.Lock()
+
+    def warmUp(self):
+        """
+        Import the modules used by LiDAR requests and start the pool, called at worker boot
+        """
+        start = time.time()
+        import numpy  # noqa: F401
+        import pdal  # noqa: F401
+        import scipy.interpolate  # noqa: F401
+        self._getExecutor()
+        logging.info(f'pdal execution service ready in {time.time() - start:.3f}s')
+
+    def execute(
+        self, pipeline_json: str, timeout: float = None, arrays: bool = True, scratch: PDALScratchDirectory = None
+    ):
+        """
+        Run a pipeline and return (arrays, count)
+
+        arrays - copy the points into NumPy arrays, pipelines that only write files (writers.gdal) return []
+        scratch - directory the pipeline writes to, kept until the pipeline is done even if it times out
+
+        Raises:
+            PDALServiceBusyException: too many requests are already queued
+            PDALTimeoutException: the pipeline did not complete within `timeout` seconds
+        """
+        if timeout is None:
+            timeout = self.timeout
+        start = time.time()
+        if not self._slots.acquire(timeout=timeout):
+            raise PDALServiceBusyException('pdal execution service queue is full')
+        try:
+            future = self._getExecutor().submit(self._run, pipeline_json, arrays)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        if scratch is not None:
+            scratch.track(future)
+        try:
+            return future.result(timeout=max(0., timeout - (time.time() - start)))
+        except concurrent.futures.TimeoutError:
+            if future.cancel():
+                raise PDALTimeoutException(f'pdal pipeline cancelled, no worker was free within {timeout}s')
+            raise PDALTimeoutException(f'pdal pipeline timed out after {timeout}s, it is left to finish in the background')
+
+    @staticmethod
+    def _run(pipeline_json: str, arrays: bool = True):
+        # Lazy Import To Improve Start Time
+        import pdal
+
+        pipeline = pdal.Pipeline(pipeline_json)
+        count = pipeline.execute()
+        return (pipeline.arrays if arrays else []), count
+
+    def _getExecutor(self):
+        # Celery forks worker processes, threads do not survive the fork so each process gets its own pool
+        with self._executor_lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix='pdal')
+                self._pid = os.getpid()
+            return self._executor
+
+
+pdal_service = PDALExecutionService(
+    settings.PDAL_POOL_WORKERS,
+    settings.PDAL_POOL_MAX_PENDING,
+    settings.PDAL_PIPELINE_TIMEOUT_S,
+)
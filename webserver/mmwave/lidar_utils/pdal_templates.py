@@ -1,8 +1,8 @@
 # (c) Meta Platforms, Inc. and affiliates. Copyright
-import json
-from django.contrib.gis.geos import Point
 from geopy.distance import distance as geopy_distance
 from geopy.distance import lonlat
+from mmwave.lidar_utils.ept_cache import getCachedEPTPath
+from mmwave.lidar_utils.pdal_service import pdal_service, getPipelineTemplate, getFilterSet
 
 DEFAULT_INTERPOLATION_STEP = 50. / 100.  # cm
 DEFAULT_FILTERS = {
@@ -66,55 +66,127 @@ def getLidarPointsAroundLink(
     num_samples, interpolation_step=DEFAULT_INTERPOLATION_STEP, link_buffer=3,
     use_outlier_filter=True
 ):
-    # Lazy Import To Improve Start Time
-    import pdal
-    from scipy.interpolate import interp1d
-    import numpy as np
-
     link_length = geopy_distance(
         lonlat(link[0][0], link[0][1]), lonlat(link[1][0], link[1][1])).meters
     # TODO achong: - create link buffer based on LIDAR cloud reference frame units
     # link_buffer = 3 -> 3 meters for EPSG:3857
     link_T = link.transform(ept_transform, clone=True)
-    bb_link_buffer = link_T.buffer(link_buffer)
-    bounding_box = ([bb_link_buffer.extent[0], bb_link_buffer.extent[2]], [
-                    bb_link_buffer.extent[1], bb_link_buffer.extent[3]])
-    query_json = f"""{{
-        "pipeline": [
-            {{
-                "type": "readers.ept",
-                "filename": "{ept_path}",
-                "bounds": "{bounding_box}",
-                "resolution" : {resolution},
-                "polygon": ["{link_T.buffer(link_buffer).wkt}/ EPSG: {ept_transform}"]
-            }},
-            {(
-                json.dumps(DEFAULT_FILTERS['outlier']) + ',' +
-                json.dumps({
-                    "type": "filters.range",
-                    "limits": "Classification![18:18]"
-                }) + ','
-            ) if use_outlier_filter else ''}
-            {{
-                "type":"filters.crop",
-                "polygon":"{link_T.buffer(link_buffer).wkt}"
-            }}
-        ]
-    }}"""
-    pipeline = pdal.Pipeline(query_json)
-    count = pipeline.execute()
+    arr, count = queryLidarPoints(
+        ept_path, [link_T.buffer(link_buffer)], ept_transform, resolution, use_outlier_filter)
     if count < 2:
         raise Exception('No LiDAR Points Found')
-    arr = pipeline.arrays[0]
-    x_idx = pipeline.arrays[0].dtype.names.index('X')
-    y_idx = pipeline.arrays[0].dtype.names.index('Y')
-    z_idx = pipeline.arrays[0].dtype.names.index('Z')
 
-    pts = [[link_T.project_normalized(
-        Point(pt[x_idx], pt[y_idx]))*link_length, pt[z_idx]] for pt in arr]
-    # Average Duplicate Points
-    dsts, hgts = takeMaxHeightAtDistance(
-        [pt[0] for pt in pts], [pt[1] for pt in pts])
+    link_data = calculateProfileFromPoints(
+        arr['X'], arr['Y'], arr['Z'], link_T, link_length, num_samples)
+    height_bounds = (min(link_data), max(link_data))
+    return link_data.tolist(), count, link_T.extent + height_bounds, link_T
+
+
+def queryLidarPoints(ept_path, polygons, ept_transform, resolution, use_outlier_filter=True):
+    """
+    Read the LiDAR points inside one or more polygons with a single PDAL pipeline
+
+    polygons - List of GEOS Polygons in the reference frame of the point cloud (ept_transform)
+
+    returns the structured point array and the number of points
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    extents = [polygon.extent for polygon in polygons]
+    extent = (
+        min(e[0] for e in extents), min(e[1] for e in extents),
+        max(e[2] for e in extents), max(e[3] for e in extents)
+    )
+    bounding_box = ([extent[0], extent[2]], [extent[1], extent[3]])
+    source = getCachedEPTPath(ept_path, extent, resolution)
+    template = getPipelineTemplate('readers.ept', getFilterSet(use_outlier_filter))
+    query_json = template.render(
+        {
+            "filename": source,
+            "bounds": str(bounding_box),
+            "resolution": resolution,
+            "polygon": [f'{polygon.wkt}/ EPSG: {ept_transform}' for polygon in polygons],
+        },
+        [{"type": "filters.crop", "polygon": [polygon.wkt for polygon in polygons]}]
+    )
+    arrays, count = pdal_service.execute(query_json)
+    if len(arrays) == 1:
+        return arrays[0], count
+    # filters.crop outputs one view per polygon, overlapping corridors share points
+    arr = np.concatenate(arrays)
+    return arr, arr.shape[0]
+
+
+def projectPointsOntoLink(x, y, link_T, link_length):
+    """
+    Vectorized equivalent of `link_T.project_normalized(Point(x, y)) * link_length`
+
+    Returns the along-track distance of every point (clamped to the ends of the link,
+    like GEOS) and the signed cross-track offset in the units of the link's reference frame
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    (x0, y0), (x1, y1) = link_T[0], link_T[-1]
+    dx = x1 - x0
+    dy = y1 - y0
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        return np.zeros(x.shape), np.hypot(x - x0, y - y0)
+
+    rel_x = x - x0
+    rel_y = y - y0
+    along = np.clip((rel_x * dx + rel_y * dy) / length_sq, 0., 1.) * link_length
+    cross = (rel_x * dy - rel_y * dx) / np.sqrt(length_sq)
+    return along, cross
+
+
+def assignPointsToLinks(x, y, links_T, link_buffer, chunk_size=1 << 16):
+    """
+    Find which link corridors contain each point
+
+    links_T - List of two point LineStrings in the reference frame of the points
+
+    returns a boolean array of shape (len(links_T), len(x)), True where the point is within
+    `link_buffer` of the link. Corridors can overlap so a point may belong to several links
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    starts = np.array([link_T[0] for link_T in links_T], dtype=np.float64).reshape(-1, 2)
+    ends = np.array([link_T[-1] for link_T in links_T], dtype=np.float64).reshape(-1, 2)
+    x0, y0 = starts[:, 0:1], starts[:, 1:2]
+    dx, dy = ends[:, 0:1] - x0, ends[:, 1:2] - y0
+    length_sq = dx * dx + dy * dy
+    # Avoid division by zero for degenerate links, those project every point onto their start
+    safe_length_sq = np.where(length_sq == 0, 1., length_sq)
+
+    assignment = np.zeros((len(links_T), x.shape[0]), dtype=bool)
+    # Broadcast links against chunks of points to bound the size of the temporaries
+    for start in range(0, x.shape[0], chunk_size):
+        rel_x = x[None, start:start + chunk_size] - x0
+        rel_y = y[None, start:start + chunk_size] - y0
+        t = np.clip((rel_x * dx + rel_y * dy) / safe_length_sq, 0., 1.)
+        assignment[:, start:start + chunk_size] = np.hypot(rel_x - t * dx, rel_y - t * dy) <= link_buffer
+    return assignment
+
+
+def calculateProfileFromPoints(x, y, z, link_T, link_length, num_samples):
+    """
+    Project LiDAR points onto the link, take the max height at each distance
+    and resample the result to `num_samples` evenly spaced heights
+    """
+    # Lazy Import To Improve Start Time
+    from scipy.interpolate import interp1d
+    import numpy as np
+
+    distances, _ = projectPointsOntoLink(x, y, link_T, link_length)
+    dsts, hgts = takeMaxHeightAtDistance(distances, z)
 
     # Resample Output Profile
     new_samples = np.linspace(0, link_length, num_samples)
@@ -125,6 +197,4 @@ def getLidarPointsAroundLink(
         bounds_error=False,
         fill_value=(hgts[0], hgts[1])
     )
-    link_data = interpfunc(new_samples)
-    height_bounds = (min(link_data), max(link_data))
-    return link_data.tolist(), count, link_T.extent + height_bounds, link_T
+    return interpfunc(new_samples)
@@ -0,0 +1,251 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+"""
+Incremental LiDAR profile refinement
+
+`getLiDARProfile` walks LOW -> MEDIUM -> HIGH -> ULTRA for the same link. A readers.ept query at
+a higher resolution reads every octree level the lower resolution queries already read, plus the
+deeper ones. Here the points read for a link segment are kept in a memory-mapped scratch file, and
+each refinement step only reads the octree chunks of the new, deeper levels and merges them in.
+
+The chunks are read with the reader for the dataType of the ept.json: readers.las for laszip,
+binary and zstandard chunks are decoded in process from the schema.
+"""
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from geopy.distance import distance as geopy_distance
+from geopy.distance import lonlat
+
+from mmwave.lidar_utils.ept_cache import ept_chunk_cache
+from mmwave.lidar_utils.pdal_service import pdal_service
+from mmwave.lidar_utils.pdal_templates import (
+    getLidarPointsAroundLink, calculateProfileFromPoints
+)
+
+DEFAULT_LINK_BUFFER = 3
+# Refinement requests for a link arrive within seconds of each other
+SCRATCH_TTL_S = 60 * 60
+SCRATCH_CLEANUP_INTERVAL_S = 10 * 60
+# PDAL reader of the octree chunks of each EPT dataType, the others are decoded in process
+EPT_CHUNK_READERS = {'laszip': 'readers.las'}
+EPT_DIMENSION_KINDS = {'signed': 'i', 'unsigned': 'u', 'float': 'f'}
+
+
+class ProgressivePointStore:
+    """
+    Per link segment scratch store of the points read so far, and how deep into the octree they go
+
+    Files are named <segment hash>.<depth end>.npy and hold an (n, 3) float64 array of X, Y, Z
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def load(self, key: str):
+        """
+        Returns (points, depth_end) for the deepest scratch file of the segment, (None, 0) if missing
+        """
+        # Lazy Import To Improve Start Time
+        import numpy as np
+
+        candidates = []
+        for path in glob.glob(os.path.join(self.directory, f'{key}.*.npy')):
+            try:
+                candidates.append((int(path.rsplit('.', 2)[1]), path))
+            except ValueError:
+                continue
+        if not candidates:
+            return None, 0
+        depth_end, path = max(candidates)
+        try:
+            return np.load(path, mmap_mode='r'), depth_end
+        except (FileNotFoundError, ValueError):
+            return None, 0
+
+    def save(self, key: str, points, depth_end: int):
+        # Lazy Import To Improve Start Time
+        import numpy as np
+
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.partial')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, points)
+        os.replace(tmp_path, os.path.join(self.directory, f'{key}.{depth_end}.npy'))
+        # Shallower scratch files for the segment are superseded
+        for path in glob.glob(os.path.join(self.directory, f'{key}.*.npy')):
+            if not path.endswith(f'.{depth_end}.npy'):
+                self._remove(path)
+
+    def cleanup(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, 'cleanup.lock'), 'w') as lock_file:
+            # Only one process on the host scans the store at a time, the others skip
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            cutoff = time.time() - SCRATCH_TTL_S
+            for path in glob.glob(os.path.join(self.directory, '*.npy')):
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        self._remove(path)
+                except FileNotFoundError:
+                    continue
+
+    def scheduleCleanup(self, interval: float = SCRATCH_CLEANUP_INTERVAL_S):
+        """
+        Remove expired scratch files every `interval` seconds from a daemon thread of this process
+        """
+        def run():
+            try:
+                self.cleanup()
+            except Exception:
+                logging.exception(f'failed to clean up {self.directory}')
+            self.scheduleCleanup(interval)
+
+        timer = threading.Timer(interval, run)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+progressive_point_store = ProgressivePointStore(
+    os.path.join(settings.LIDAR_CACHE_DIRECTORY, 'progressive'))
+
+
+def _pointsInPolygon(x, y, polygon):
+    """
+    Mask of the points inside `polygon` (even-odd rule over all its rings)
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    inside = np.zeros(len(x), dtype=bool)
+    for ring in polygon:
+        coords = np.asarray(ring.coords)
+        for (x0, y0), (x1, y1) in zip(coords[:-1], coords[1:]):
+            crosses = (y0 > y) != (y1 > y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+            inside ^= crosses & (x < x_cross)
+    return inside
+
+
+def decodeEPTChunk(info: dict, path: str):
+    """
+    Returns the (n, 3) float64 X, Y, Z of a binary or zstandard EPT chunk, described by the ept.json `info`
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    if info['dataType'] == 'zstandard':
+        import zstandard
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    schema = {dimension['name']: dimension for dimension in info['schema']}
+    dtype = np.dtype([
+        (dimension['name'], f"<{EPT_DIMENSION_KINDS[dimension['type']]}{dimension['size']}")
+        for dimension in info['schema']
+    ])
+    records = np.frombuffer(data, dtype=dtype)
+    return np.column_stack([
+        records[name] * schema[name].get('scale', 1.) + schema[name].get('offset', 0.)
+        for name in ('X', 'Y', 'Z')
+    ]).astype(np.float64)
+
+
+def readEPTChunks(info: dict, paths: list, polygon):
+    """
+    Returns the (n, 3) float64 X, Y, Z of the points of the EPT chunks at `paths` inside `polygon`
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    if not paths:
+        return np.zeros((0, 3))
+    if info['dataType'] in EPT_CHUNK_READERS:
+        reader = EPT_CHUNK_READERS[info['dataType']]
+        arrays, _ = pdal_service.execute(json.dumps({
+            'pipeline': [{'type': reader, 'filename': path} for path in paths] + [
+                {'type': 'filters.merge'},
+                {'type': 'filters.crop', 'polygon': polygon.wkt},
+            ]
+        }))
+        arr = arrays[0]
+        return np.column_stack([arr['X'], arr['Y'], arr['Z']]).astype(np.float64)
+
+    points = np.concatenate([decodeEPTChunk(info, path) for path in paths])
+    return points[_pointsInPolygon(points[:, 0], points[:, 1], polygon)]
+
+
+def queryLidarPointsIncremental(ept_path, polygon, resolution):
+    """
+    Return the X, Y, Z of the points inside `polygon` at `resolution`, reading only the
+    octree levels that were not already read for this polygon at a lower resolution
+
+    polygon - GEOS Polygon in the reference frame of the point cloud
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    key = hashlib.sha1(f'{ept_path}|{polygon.wkt}'.encode()).hexdigest()
+    points, depth_begin = progressive_point_store.load(key)
+    paths, depth_end = ept_chunk_cache.getLocalChunks(ept_path, polygon.extent, resolution, depth_begin)
+    if points is not None and depth_end <= depth_begin:
+        return points[:, 0], points[:, 1], points[:, 2]
+
+    new_points = readEPTChunks(ept_chunk_cache.getMetadata(ept_path), paths, polygon)
+    if points is not None:
+        new_points = np.concatenate([points, new_points])
+    progressive_point_store.save(key, new_points, depth_end)
+    return new_points[:, 0], new_points[:, 1], new_points[:, 2]
+
+
+def createProgressiveProfileSource(resolution, link_buffer=DEFAULT_LINK_BUFFER):
+    """
+    Returns a LidarEngine profile source that refines the segment profiles incrementally
+
+    Noisy point clouds need the statistical outlier filter to run over the full point set,
+    those (and any failure of the incremental path) use the regular PDAL query
+    """
+    def getSegmentProfile(link, cloud, num_samples):
+        if not cloud.noisy_data:
+            link_length = geopy_distance(
+                lonlat(link[0][0], link[0][1]), lonlat(link[1][0], link[1][1])).meters
+            link_T = link.transform(cloud.srs, clone=True)
+            try:
+                x, y, z = queryLidarPointsIncremental(
+                    cloud.url, link_T.buffer(link_buffer), resolution)
+            except Exception:
+                logging.exception(f'incremental lidar query failed {cloud.url}')
+            else:
+                if len(x) < 2:
+                    raise Exception('No LiDAR Points Found')
+                return calculateProfileFromPoints(x, y, z, link_T, link_length, num_samples).tolist()
+
+        lidar_profile, _, _, _ = getLidarPointsAroundLink(
+            cloud.url, link, cloud.srs,
+            resolution=resolution,
+            num_samples=num_samples,
+            link_buffer=link_buffer,
+            use_outlier_filter=cloud.noisy_data
+        )
+        return lidar_profile
+
+    return getSegmentProfile
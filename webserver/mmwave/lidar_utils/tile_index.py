@@ -0,0 +1,215 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+"""
+Index of the DSM tiles every point cloud has
+
+Checking whether a cloud has a DSM tile used to take one LidarDSMTileModel query (one S3 HEAD
+request outside of production) per (tile, cloud) pair. The index loads the (x, y) of every tile
+of a cloud at a zoom with one query and keeps them as a sorted array of packed coordinates, in
+process and in the shared cache.
+
+`createTileDSM` records new tiles with `addTile`, which bumps the cloud's version stamp so
+other processes reload their copy. Deleted tiles bump it with `bumpTileIndexVersionOnCommit`.
+"""
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, transaction
+
+from IspToolboxApp.util import s3
+
+DSM_TILE_INDEX_CACHE_NAME = 'los'
+# Bump the version when changing the layout of the shared copies
+DSM_TILE_INDEX_KEY = 'dsm_tile_index.v1'
+DSM_TILE_INDEX_VERSION_KEY = 'dsm_tile_index_version'
+# Shared and in process copies are reloaded at least this often, even if the version did not change
+DSM_TILE_INDEX_TTL_S = 6 * 60 * 60
+_TILE_KEY_REGEX = re.compile(r'(\d+)/(\d+)\.tif$')
+# Per thread {(database, cloud pk): on_commit callback} of the version bumps waiting for a commit
+_pending_bumps = threading.local()
+
+
+def packTiles(xs, ys):
+    """
+    Sorted, unique (x, y) tile coordinates packed into int64: x in the high 32 bits, y in the low
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    return np.unique((np.asarray(xs, dtype=np.int64) << 32) | np.asarray(ys, dtype=np.int64))
+
+
+def unpackTiles(packed) -> list:
+    """
+    (x, y) tile coordinates of packed tiles, see `packTiles`
+    """
+    return list(zip((packed >> 32).tolist(), (packed & 0xFFFFFFFF).tolist()))
+
+
+def _getVersion(pk):
+    try:
+        return caches[DSM_TILE_INDEX_CACHE_NAME].get(f'{DSM_TILE_INDEX_VERSION_KEY}:{pk}')
+    except Exception:
+        logging.exception('failed to read dsm tile index version')
+        return None
+
+
+def _setVersion(pk):
+    version = time.time()
+    try:
+        caches[DSM_TILE_INDEX_CACHE_NAME].set(f'{DSM_TILE_INDEX_VERSION_KEY}:{pk}', version, timeout=None)
+    except Exception:
+        logging.exception('failed to bump dsm tile index version')
+    return version
+
+
+class DSMTileIndex:
+    """
+    Per (point cloud, zoom) sorted arrays of the tiles that exist
+
+    Attributes
+    ----------
+    check_interval : float
+        seconds between checks of a cloud's shared version stamp
+    """
+
+    def __init__(self, check_interval: float):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        # (cloud pk, zoom) -> [packed tiles, version, last check, loaded at]
+        self._entries = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = {}
+
+    def invalidateCloud(self, pk):
+        with self._lock:
+            self._entries = {key: entry for key, entry in self._entries.items() if key[0] != pk}
+
+    def exists(self, cloud, x: int, y: int, z: int) -> bool:
+        # Lazy Import To Improve Start Time
+        import numpy as np
+
+        try:
+            tiles = self.getTiles(cloud, z)
+        except Exception:
+            logging.exception(f'dsm tile index failed, checking tile directly: {cloud.name}')
+            return cloud.existsTileUncached(x, y, z)
+        code = (int(x) << 32) | int(y)
+        i = np.searchsorted(tiles, code)
+        return bool(i < len(tiles) and tiles[i] == code)
+
+    def getTiles(self, cloud, z: int):
+        """
+        Returns the packed (x, y) of the cloud's tiles at zoom `z`, see `packTiles`
+        """
+        key = (cloud.pk, int(z))
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None and now - entry[2] < self.check_interval and now - entry[3] < DSM_TILE_INDEX_TTL_S:
+            return entry[0]
+        with self._lock:
+            version = _getVersion(cloud.pk)
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == version and now - entry[3] < DSM_TILE_INDEX_TTL_S:
+                entry[2] = now
+                return entry[0]
+            tiles = self._loadShared(cloud, int(z), version)
+            self._entries[key] = [tiles, version, now, now]
+            return tiles
+
+    def addTile(self, cloud, x: int, y: int, z: int):
+        """
+        Record a new tile, call after the tile's LidarDSMTileModel is saved
+        """
+        self.addTiles(cloud, [x], [y], z)
+
+    def addTiles(self, cloud, xs, ys, z: int):
+        """
+        Record new tiles, call after their LidarDSMTileModels are saved
+        """
+        # Lazy Import To Improve Start Time
+        import numpy as np
+
+        version = _setVersion(cloud.pk)
+        with self._lock:
+            entry = self._entries.get((cloud.pk, int(z)))
+            if entry is not None:
+                entry[0] = np.union1d(entry[0], packTiles(xs, ys))
+                entry[1] = version
+
+    def _loadShared(self, cloud, z, version):
+        # Lazy Import To Improve Start Time
+        import numpy as np
+
+        cache_key = f'{DSM_TILE_INDEX_KEY}:{cloud.pk}:{z}'
+        try:
+            cached = caches[DSM_TILE_INDEX_CACHE_NAME].get(cache_key)
+        except Exception:
+            logging.exception('failed to read dsm tile index')
+            cached = None
+        if cached is not None and cached[0] == version:
+            return np.frombuffer(cached[1], dtype='<i8')
+
+        start = time.time()
+        tiles = self._load(cloud, z)
+        logging.info(f'dsm tile index loaded {len(tiles)} tiles of {cloud.name} in {time.time() - start:.3f}s')
+        try:
+            caches[DSM_TILE_INDEX_CACHE_NAME].set(
+                cache_key, (version, tiles.astype('<i8').tobytes()), timeout=DSM_TILE_INDEX_TTL_S)
+        except Exception:
+            logging.exception('failed to store dsm tile index')
+        return tiles
+
+    @staticmethod
+    def _load(cloud, z):
+        if settings.PROD:
+            from mmwave.models import LidarDSMTileModel
+            tiles = list(LidarDSMTileModel.objects.filter(cld=cloud, zoom=z).values_list('x', 'y'))
+        else:
+            # Local environments do not populate LidarDSMTileModel, list the tiles in s3 instead
+            tiles = []
+            cloud_prefix = cloud.get_s3_prefix()
+            if cloud_prefix:
+                for key, size in s3.listObjects(f'{cloud_prefix}{z}/'):
+                    match = _TILE_KEY_REGEX.search(key)
+                    if match is not None and size > 0:
+                        tiles.append((int(match.group(1)), int(match.group(2))))
+        return packTiles([x for x, _ in tiles], [y for _, y in tiles])
+
+
+dsm_tile_index = DSMTileIndex(settings.DSM_TILE_INDEX_CHECK_INTERVAL_S)
+
+
+def bumpTileIndexVersion(pk):
+    """
+    Invalidate the cloud's tile index in every process, call after tiles of the cloud are deleted
+    """
+    _setVersion(pk)
+    dsm_tile_index.invalidateCloud(pk)
+
+
+def bumpTileIndexVersionOnCommit(pk, using=None):
+    """
+    Bump the cloud's version once the current transaction commits, once per cloud however many of
+    its tiles the transaction deletes
+    """
+    pending = getattr(_pending_bumps, 'callbacks', None)
+    if pending is None:
+        pending = _pending_bumps.callbacks = {}
+    key = (using, pk)
+    callback = pending.get(key)
+    # Callbacks of rolled back transactions are dropped by django, those bumps are registered again
+    if callback is not None and any(entry[1] is callback for entry in connections[using or 'default'].run_on_commit):
+        return
+
+    def bump():
+        pending.pop(key, None)
+        bumpTileIndexVersion(pk)
+
+    pending[key] = bump
+    transaction.on_commit(bump, using=using)
@@ -0,0 +1,169 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+"""
+XYZ PNG tiles of an RGBA raster in EPSG:3857, rendered in process
+
+Replaces `gdal2tiles.py --resampling=near --exclude`: every tile is sampled with nearest neighbour
+from the raster, tiles without any opaque pixel are skipped before they are rendered. Workers are
+threads since PNG encoding releases the GIL, each one reuses its tile buffer and PNG encoder.
+"""
+import collections
+import concurrent.futures
+import io
+import itertools
+import math
+import threading
+from typing import Iterator, NamedTuple
+
+# Half the width of the EPSG:3857 square
+MERCATOR_ORIGIN_M = 20037508.342789244
+VIEWSHED_TILE_SIZE = 512
+VIEWSHED_TILE_WORKERS = 8
+# Side in pixels of the blocks of the raster checked for opaque pixels before rendering tiles
+OCCUPANCY_BLOCK = 64
+# zlib level of the tiles, the tiles are mostly one color so higher levels barely help
+PNG_COMPRESS_LEVEL = 6
+
+
+class Tile(NamedTuple):
+    zoom: int
+    x: int
+    y: int
+    png: bytes
+
+
+def tileBounds(zoom: int, x: int, y: int):
+    """
+    (left, bottom, right, top) of the XYZ tile in EPSG:3857
+    """
+    size = 2 * MERCATOR_ORIGIN_M / 2 ** zoom
+    left, top = -MERCATOR_ORIGIN_M + x * size, MERCATOR_ORIGIN_M - y * size
+    return left, top - size, left + size, top
+
+
+def tilesCovering(bounds, zoom: int):
+    """
+    XYZ (x, y) of the tiles that intersect the (left, bottom, right, top) bounds in EPSG:3857
+    """
+    left, bottom, right, top = bounds
+    size = 2 * MERCATOR_ORIGIN_M / 2 ** zoom
+    last = 2 ** zoom - 1
+
+    def first(offset):
+        return min(max(int(math.floor(offset / size)), 0), last)
+
+    def end(offset):
+        # Tiles that only touch the bounds on their edge are left out
+        return min(max(int(math.ceil(offset / size)) - 1, 0), last)
+
+    x_min, x_max = first(left + MERCATOR_ORIGIN_M), end(right + MERCATOR_ORIGIN_M)
+    y_min, y_max = first(MERCATOR_ORIGIN_M - top), end(MERCATOR_ORIGIN_M - bottom)
+    return [(x, y) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1)]
+
+
+class _TileRenderer:
+    """
+    Renders and encodes tiles of one raster, one per worker so the buffers are reused between tiles
+    """
+
+    def __init__(self, rgba, transform, occupancy, tilesize, color):
+        # Lazy Import To Improve Start Time
+        import numpy as np
+
+        self.rgba = rgba
+        self.transform = transform
+        self.occupancy = occupancy
+        self.tile = np.zeros((tilesize, tilesize, 4), dtype=np.uint8)
+        self.tile[..., :3] = color
+        # Alpha only rasters are gathered into the alpha band of the tile
+        self.pixels = self.tile[..., 3] if rgba.ndim == 2 else self.tile
+        self.buffer = io.BytesIO()
+
+    def render(self, zoom: int, x: int, y: int):
+        """
+        PNG of the tile, None when every pixel is transparent
+        """
+        # Lazy Import To Improve Start Time
+        import numpy as np
+        from PIL import Image
+
+        tilesize = self.tile.shape[0]
+        left, _, right, top = tileBounds(zoom, x, y)
+        pixel = (right - left) / tilesize
+        centers = (np.arange(tilesize) + 0.5) * pixel
+        cols = np.floor((left + centers - self.transform.c) / self.transform.a).astype(np.int64)
+        rows = np.floor((top - centers - self.transform.f) / self.transform.e).astype(np.int64)
+        height, width = self.rgba.shape[:2]
+        in_cols = (cols >= 0) & (cols < width)
+        in_rows = (rows >= 0) & (rows < height)
+        if not in_cols.any() or not in_rows.any() or not self._occupied(rows[in_rows], cols[in_cols]):
+            return None
+        source = self.rgba[np.ix_(rows[in_rows], cols[in_cols])]
+        if not (source if self.rgba.ndim == 2 else source[..., 3]).any():
+            return None
+        self.pixels[...] = 0
+        self.pixels[np.ix_(in_rows, in_cols)] = source
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        Image.fromarray(self.tile, 'RGBA').save(self.buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+        return self.buffer.getvalue()
+
+    def _occupied(self, rows, cols) -> bool:
+        block = OCCUPANCY_BLOCK
+        return bool(self.occupancy[
+            rows.min() // block:rows.max() // block + 1, cols.min() // block:cols.max() // block + 1
+        ].any())
+
+
+def _occupancy(alpha):
+    """
+    Whether each OCCUPANCY_BLOCK² block of the alpha band has an opaque pixel
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    block = OCCUPANCY_BLOCK
+    height, width = alpha.shape
+    padded = np.zeros((-(-height // block) * block, -(-width // block) * block), dtype=bool)
+    padded[:height, :width] = alpha != 0
+    return padded.reshape(padded.shape[0] // block, block, padded.shape[1] // block, block).any(axis=(1, 3))
+
+
+def iterTiles(
+    rgba, transform, min_zoom: int, max_zoom: int, tilesize: int = VIEWSHED_TILE_SIZE,
+    workers: int = VIEWSHED_TILE_WORKERS, color=(0, 0, 0),
+) -> Iterator[Tile]:
+    """
+    Yields the XYZ tiles of zooms min_zoom to max_zoom that have an opaque pixel, zoom by zoom
+
+    rgba - (height, width, 4) uint8 array in EPSG:3857, alpha 0 is transparent. Or the
+        (height, width) alpha band of a raster of a single `color`
+    transform - affine transform of the array, north up
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+
+    rgba = np.ascontiguousarray(rgba, dtype=np.uint8)
+    height, width = rgba.shape[:2]
+    bounds = (
+        transform.c, transform.f + transform.e * height, transform.c + transform.a * width, transform.f
+    )
+    occupancy = _occupancy(rgba if rgba.ndim == 2 else rgba[..., 3])
+    local = threading.local()
+
+    def render(job):
+        if not hasattr(local, 'renderer'):
+            local.renderer = _TileRenderer(rgba, transform, occupancy, tilesize, color)
+        zoom, x, y = job
+        return job, local.renderer.render(zoom, x, y)
+
+    jobs = [(zoom, x, y) for zoom in range(min_zoom, max_zoom + 1) for x, y in tilesCovering(bounds, zoom)]
+    # Bounded number of rendered tiles waiting to be consumed
+    with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as executor:
+        pending = iter(jobs)
+        futures = collections.deque(executor.submit(render, job) for job in itertools.islice(pending, 2 * workers))
+        while futures:
+            (zoom, x, y), png = futures.popleft().result()
+            for job in itertools.islice(pending, 1):
+                futures.append(executor.submit(render, job))
+            if png is not None:
+                yield Tile(zoom, x, y, png)
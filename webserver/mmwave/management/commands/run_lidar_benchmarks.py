@@ -0,0 +1,75 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+import json
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from mmwave.benchmarks.harness import (
+    BenchmarkRunner, compareReports, STAGES, DEFAULT_LINK_LENGTHS_M, DEFAULT_RADII_M, DEFAULT_REPEAT,
+    DEFAULT_BUILDINGS, DEFAULT_REGRESSION_THRESHOLD
+)
+from mmwave.benchmarks.synthetic import DEFAULT_DENSITY, DEFAULT_SEED
+
+
+def _numbers(value):
+    numbers = (float(v) for v in value.split(',') if v)
+    return tuple(int(n) if n.is_integer() else n for n in numbers)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the LiDAR and viewshed engines offline on synthetic data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', type=str, help='write the json report to this path')
+        parser.add_argument('--baseline', type=str, help='json report of a previous run to compare against')
+        parser.add_argument('--stages', type=str, default=','.join(STAGES))
+        parser.add_argument('--link-lengths', type=_numbers, default=DEFAULT_LINK_LENGTHS_M, help='meters')
+        parser.add_argument('--radii', type=_numbers, default=DEFAULT_RADII_M, help='meters')
+        parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+        parser.add_argument('--density', type=float, default=DEFAULT_DENSITY, help='points per square meter')
+        parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+        parser.add_argument('--buildings', type=int, default=DEFAULT_BUILDINGS)
+        parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD)
+        parser.add_argument(
+            '--data-dir', type=str, default=os.path.join(settings.LIDAR_CACHE_DIRECTORY, 'benchmarks'),
+            help='directory the synthetic fixtures are generated into'
+        )
+
+    def handle(self, *args, **options):
+        stages = tuple(stage for stage in options['stages'].split(',') if stage)
+        unknown = [stage for stage in stages if stage not in STAGES]
+        if unknown:
+            self.stderr.write(f'unknown stages: {", ".join(unknown)}, expected: {", ".join(STAGES)}')
+            return
+
+        runner = BenchmarkRunner(
+            options['data_dir'],
+            stages=stages,
+            link_lengths=options['link_lengths'],
+            radii=options['radii'],
+            repeat=options['repeat'],
+            density=options['density'],
+            seed=options['seed'],
+            buildings=options['buildings'],
+        )
+        report = runner.run()
+        for result in report['results']:
+            median = 'failed' if result['median'] is None else f'{result["median"]:.3f}s'
+            self.stdout.write(f'{result["stage"]:<12} {json.dumps(result["params"]):<64} {median}')
+            if result['error']:
+                self.stderr.write(f'    {result["error"]}')
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f'wrote {options["output"]}')
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            self.stdout.write(f'compared to {baseline.get("commit")}:')
+            for row in compareReports(baseline, report, options['threshold']):
+                flag = ' REGRESSION' if row['regression'] else ''
+                self.stdout.write(
+                    f'{row["stage"]:<12} {json.dumps(row["params"]):<64} '
+                    f'{row["baseline"]:.3f}s -> {row["current"]:.3f}s ({row["ratio"]:.2f}x){flag}'
+                )
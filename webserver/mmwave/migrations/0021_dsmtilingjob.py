@@ -0,0 +1,34 @@
+# Generated by Django 3.1.13 on 2026-10-18 12:00
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mmwave', '0020_unique_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DSMTilingJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('RUNNING', 'Running'), ('DONE', 'Done'), ('FAILED', 'Failed')], db_index=True, default='PENDING', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('demand', models.PositiveIntegerField(default=0, help_text='Number of times the cloud was requested while waiting to be tiled')),
+                ('last_requested', models.DateTimeField(blank=True, default=None, null=True)),
+                ('blocks_total', models.PositiveIntegerField(default=0)),
+                ('blocks_done', models.PositiveIntegerField(default=0)),
+                ('blocks_failed', models.PositiveIntegerField(default=0)),
+                ('tiles_created', models.PositiveIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, default=None, null=True)),
+                ('finished', models.DateTimeField(blank=True, default=None, null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('cld', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='tiling_job', to='mmwave.eptlidarpointcloud')),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.1.13 on 2026-10-18 12:00
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mmwave', '0021_dsmtilingjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dsmtilingjob',
+            name='blocks_dispatched',
+            field=models.PositiveIntegerField(default=0, help_text='Blocks queued so far, the blocks are queued in slices as earlier ones finish'),
+        ),
+    ]
@@ -2,11 +2,11 @@ from .link_models import TGLink, LOSSummary
 from .dsm_models import DSMConversionJob, DSMResolutionOptionsEnum
 from .usgs_metadata_models import (
     USGSLidarMetaDataModel, EPTLidarPointCloud, LidarDSMTileModel,
-    TileModel,
+    TileModel, DSMTilingJob,
 )
 
 __all__ = [
     'TGLink', 'EPTLidarPointCloud', 'LOSSummary', 'DSMConversionJob',
     'USGSLidarMetaDataModel', 'DSMResolutionOptionsEnum',
-    'LidarDSMTileModel', 'TileModel',
+    'LidarDSMTileModel', 'TileModel', 'DSMTilingJob',
 ]
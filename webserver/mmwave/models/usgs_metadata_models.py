@@ -1,14 +1,17 @@
 # (c) Meta Platforms, Inc. and affiliates. Copyright
 from django.db import models
+from django.db.models import F
+from django.utils import timezone
 from django.contrib.gis.db import models as gis_models
 from django.contrib.gis.geos import GEOSGeometry
-from datetime import datetime
 from django.conf import settings
-from django.db.models.signals import post_delete
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
 from django.dispatch.dispatcher import receiver
 from IspToolboxApp.util import s3
 from storages.backends.s3boto3 import S3Boto3Storage
 from django.urls import reverse
+import logging
 
 
 class EPTLidarPointCloudManager(models.Manager):
@@ -82,6 +85,14 @@ class EPTLidarPointCloud(models.Model):
 
     @classmethod
     def query_intersect_aoi(cls, aoi: GEOSGeometry):
+        """
+        Point clouds whose boundary intersects the aoi, resolved in memory with the boundary index
+        """
+        from mmwave.lidar_utils.boundary_index import point_cloud_boundary_index
+        return point_cloud_boundary_index.query(aoi)
+
+    @classmethod
+    def query_intersect_aoi_db(cls, aoi: GEOSGeometry):
         query = (
             cls.objects.filter(
                 high_resolution_boundary__isnull=True,
@@ -100,11 +111,8 @@ class EPTLidarPointCloud(models.Model):
 
     @property
     def collection_start_date(self):
-        try:
-            metadata = USGSLidarMetaDataModel.objects.get(workunit=self.name)
-            return datetime.strptime(metadata.collect_start, '%Y-%m-%d')
-        except Exception:
-            return datetime.min
+        from mmwave.lidar_utils.lidar_engine_queries import get_collection_start_date
+        return get_collection_start_date(self.name)
 
     def s3_tile_directory_exists(self, **kwargs):
         return s3.checkPrefixExists(self.get_s3_folder_key(**kwargs))
@@ -127,6 +135,11 @@ class EPTLidarPointCloud(models.Model):
             return s3.findPointCloudPrefix('dsm/tiles/', self.name)
 
     def existsTile(self, x, y, z, **kwargs):
+        # Lazy import, the index imports the models
+        from mmwave.lidar_utils.tile_index import dsm_tile_index
+        return dsm_tile_index.exists(self, x, y, z)
+
+    def existsTileUncached(self, x, y, z, **kwargs):
         if settings.PROD:
             return LidarDSMTileModel.objects.filter(cld=self, x=x, y=y, zoom=z).exists()
         # Check S3 - we are in local environment - lidar dsm tile models not populated
@@ -140,7 +153,9 @@ class EPTLidarPointCloud(models.Model):
 
     # TODO achong: remove
     def getTile(self, x, y, z, fp, **kwargs):
-        return s3.readFromS3(self.get_s3_key_tile(x, y, z, **kwargs), fp)
+        # Lazy import, the cache imports the lidar utils
+        from mmwave.lidar_utils.dsm_tile_cache import dsm_tile_cache
+        return dsm_tile_cache.readObject(self.get_s3_key_tile(x, y, z, **kwargs), fp)
 
 
 class TileModel(models.Model, s3.S3PublicExportMixin):
@@ -197,12 +212,115 @@ class LidarDSMTileModel(TileModel):
         return self.cld.get_s3_key_tile(self.x, self.y, self.z, **kwargs)
 
 
+DSM_TILING_DEMAND_CACHE_NAME = 'los'
+DSM_TILING_DEMAND_KEY = 'dsm_tiling_demand'
+DSM_TILING_DEMAND_INTERVAL_S = 60 * 60
+
+
+class DSMTilingJob(models.Model):
+    """
+    Progress of tiling a point cloud into DSM tiles, see `mmwave.tasks.lidar_tasks.scheduleDSMTiling`
+
+    Clouds that users request while untiled collect demand and are tiled first.
+    """
+    class Status(models.TextChoices):
+        PENDING = "PENDING"
+        RUNNING = "RUNNING"
+        DONE = "DONE"
+        FAILED = "FAILED"
+
+    cld = models.OneToOneField(EPTLidarPointCloud, on_delete=models.CASCADE, related_name='tiling_job')
+    status = models.CharField(default=Status.PENDING, max_length=20, choices=Status.choices, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    demand = models.PositiveIntegerField(
+        default=0, help_text="Number of times the cloud was requested while waiting to be tiled"
+    )
+    last_requested = models.DateTimeField(null=True, blank=True, default=None)
+
+    blocks_total = models.PositiveIntegerField(default=0)
+    blocks_dispatched = models.PositiveIntegerField(
+        default=0, help_text="Blocks queued so far, the blocks are queued in slices as earlier ones finish"
+    )
+    blocks_done = models.PositiveIntegerField(default=0)
+    blocks_failed = models.PositiveIntegerField(default=0)
+    tiles_created = models.PositiveIntegerField(default=0)
+
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True, default=None)
+    finished = models.DateTimeField(null=True, blank=True, default=None)
+    updated = models.DateTimeField(auto_now=True)
+
+    @property
+    def blocks_in_flight(self):
+        return max(self.blocks_dispatched - self.blocks_done - self.blocks_failed, 0)
+
+    @classmethod
+    def recordDemand(cls, clouds):
+        """
+        Record a user request (viewshed, DSM export) for the clouds, the ones waiting to be tiled move up the queue
+
+        A cloud's requests are counted at most once every DSM_TILING_DEMAND_INTERVAL_S. Never raises, the
+        request goes on without recording its demand.
+        """
+        try:
+            cache = caches[DSM_TILING_DEMAND_CACHE_NAME]
+            pks = [
+                cloud.pk for cloud in clouds
+                if cache.add(f'{DSM_TILING_DEMAND_KEY}:{cloud.pk}', 1, timeout=DSM_TILING_DEMAND_INTERVAL_S)
+            ]
+            if len(pks) == 0:
+                return
+            now = timezone.now()
+            cls.objects.filter(cld__in=pks, status=cls.Status.PENDING).update(
+                demand=F('demand') + 1, last_requested=now, updated=now
+            )
+        except Exception:
+            logging.exception('failed to record dsm tiling demand')
+
+    @classmethod
+    def recordBlock(cls, pk: int, tiles_created: int, failed: bool = False):
+        """
+        Record a finished block of the cloud's tiling job, if it has one
+        """
+        blocks = {'blocks_failed': F('blocks_failed') + 1} if failed else {'blocks_done': F('blocks_done') + 1}
+        return cls.objects.filter(cld_id=pk, status=cls.Status.RUNNING).update(
+            tiles_created=F('tiles_created') + tiles_created, updated=timezone.now(), **blocks
+        )
+
+    @classmethod
+    def finishBlocks(cls, pk: int) -> bool:
+        """
+        Mark the blocks of the cloud's tiling job finished once every block is done or failed
+
+        Returns True for the one caller that marks them
+        """
+        now = timezone.now()
+        return cls.objects.filter(
+            cld_id=pk, status=cls.Status.RUNNING, finished__isnull=True, blocks_total__gt=0,
+            blocks_dispatched=F('blocks_total'), blocks_total=F('blocks_done') + F('blocks_failed'),
+        ).update(finished=now, updated=now) > 0
+
+
+@receiver(post_save, sender=EPTLidarPointCloud)
+@receiver(post_delete, sender=EPTLidarPointCloud)
+def invalidate_boundary_index(sender, instance, **kwargs):
+    """
+    Reload the in-memory boundary index when a point cloud changes
+    """
+    from mmwave.lidar_utils.boundary_index import bumpBoundaryIndexVersion
+    bumpBoundaryIndexVersion()
+
+
 @receiver(post_delete, sender=LidarDSMTileModel)
 def cleanup_tile(sender, instance, using, **kwargs):
     """
-    Delete file in S3 if we delete the model in the database
+    Delete file in S3 if we delete the model in the database, and reload the cloud's tile index
+    once the delete commits. Queryset deletes send this signal for every tile, the index is
+    reloaded once per cloud
     """
+    from mmwave.lidar_utils.tile_index import bumpTileIndexVersionOnCommit
     instance.tile.delete(save=False)
+    bumpTileIndexVersionOnCommit(instance.cld_id, using=using)
 
 
 class USGSLidarMetaDataModel(models.Model):
@@ -239,3 +357,13 @@ class USGSLidarMetaDataModel(models.Model):
     lpc_link = models.CharField(max_length=255, null=True)
     opr_link = models.CharField(max_length=255, null=True)
     metadata_link = models.CharField(max_length=255, null=True)
+
+
+@receiver(post_save, sender=USGSLidarMetaDataModel)
+@receiver(post_delete, sender=USGSLidarMetaDataModel)
+def invalidate_collection_dates(sender, instance, **kwargs):
+    """
+    Reload this process' collection date lookup when WESM metadata changes
+    """
+    from mmwave.lidar_utils.lidar_engine_queries import collection_date_lookup
+    collection_date_lookup.invalidate()
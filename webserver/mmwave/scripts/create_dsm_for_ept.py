@@ -1,8 +1,21 @@
 # (c) Meta Platforms, Inc. and affiliates. Copyright
 from mmwave.lidar_utils.SlippyTiles import getTiles, getBoundaryofTile, DEFAULT_OUTPUT_ZOOM
-from mmwave.lidar_utils.DSMEngine import DSMEngine
+from mmwave.lidar_utils.DSMEngine import DSMEngine, DSM_INTERMEDIATE_GDALOPTS
 from celery_async.celery import celery_app as app
-from mmwave.models import EPTLidarPointCloud, LidarDSMTileModel
+from mmwave.models import EPTLidarPointCloud, LidarDSMTileModel, DSMTilingJob
+from mmwave.lidar_utils.tile_index import dsm_tile_index, unpackTiles
+from mmwave.lidar_utils.dsm_overviews import (
+    DSM_OVERVIEW_ZOOMS, downsampleDSMTiles, getChildTiles, getParentTiles
+)
+from mmwave.lidar_utils.dsm_tile_cache import dsm_tile_cache
+from mmwave.lidar_utils.dsm_encoding import DSM_NODATA, getTileGDALOpts, writeDSMTile
+from mmwave.lidar_utils.DSMTileEngine import USE_OLD_TILES
+from IspToolboxApp.util import s3
+from django.contrib.gis.geos import Polygon
+from django.db import transaction
+from django.utils import timezone
+import math
+import os
 import tempfile
 from celery.utils.log import get_task_logger
 from celery.exceptions import SoftTimeLimitExceeded
@@ -10,23 +23,289 @@ from celery.exceptions import SoftTimeLimitExceeded
 
 logger = get_task_logger(__name__)
 
+# Tiles are rendered in blocks of DSM_TILE_BLOCK_SIZE x DSM_TILE_BLOCK_SIZE tiles, one pdal read per block
+DSM_TILE_BLOCK_SIZE = 16
+DSM_BLOCK_SOFT_TIME_LIMIT_S = 45 * 60
 
-@app.task
-def convertPtCloudToDSMTiled(pk: int):
+
+def groupTilesIntoBlocks(tiles, block_size: int = DSM_TILE_BLOCK_SIZE) -> list:
     """
-    For a point cloud create all tiles at DEFAULT_OUTPUT_ZOOM
+    Group (x, y) tiles into lists of tiles that share a block_size x block_size block
+    """
+    blocks = {}
+    for x, y in tiles:
+        blocks.setdefault((x // block_size, y // block_size), []).append((x, y))
+    return [sorted(block) for _, block in sorted(blocks.items())]
+
+
+def getBoundaryofTiles(tiles, z: int) -> Polygon:
+    """
+    Bounding box of the tiles (EPSG:4326)
+    """
+    xmin = min(x for x, _ in tiles)
+    ymin = min(y for _, y in tiles)
+    west, _, _, north = getBoundaryofTile(xmin, ymin, z).extent
+    _, south, east, _ = getBoundaryofTile(max(x for x, _ in tiles), max(y for _, y in tiles), z).extent
+    polygon = Polygon.from_bbox((west, south, east, north))
+    polygon.srid = 4326
+    return polygon
+
+
+def splitDSMIntoTiles(dsm_filepath: str, tiles, z: int, directory: str) -> dict:
+    """
+    Cut a DSM into one GeoTIFF per tile, tiles without data are skipped
+
+    Returns:
+        {(x, y): path of the tile's GeoTIFF}
+    """
+    # Lazy Import To Improve Start Time
+    import numpy as np
+    import rasterio
+    from rasterio.errors import WindowError
+    from rasterio.windows import Window, from_bounds
+
+    tile_files = {}
+    with rasterio.open(dsm_filepath) as dataset:
+        nodata = dataset.nodata if dataset.nodata is not None else DSM_NODATA
+        extent = Window(0, 0, dataset.width, dataset.height)
+        for x, y in tiles:
+            bounds = getBoundaryofTile(x, y, z).transform(dataset.crs.to_epsg(), clone=True).extent
+            window = from_bounds(*bounds, transform=dataset.transform)
+            # Round outwards to whole pixels
+            col_off, row_off = math.floor(window.col_off), math.floor(window.row_off)
+            window = Window(
+                col_off, row_off,
+                math.ceil(window.col_off + window.width) - col_off, math.ceil(window.row_off + window.height) - row_off
+            )
+            try:
+                window = window.intersection(extent)
+            except WindowError:
+                continue
+            data = dataset.read(1, window=window)
+            if data.size == 0 or (dataset.nodata is not None and np.all(data == dataset.nodata)):
+                continue
+            filename = os.path.join(directory, f'{x}-{y}.tif')
+            writeDSMTile(filename, data, dataset.window_transform(window), dataset.crs, nodata=nodata)
+            tile_files[(x, y)] = filename
+    return tile_files
+
+
+def getExistingTiles(cloud: EPTLidarPointCloud, tiles, z: int) -> dict:
+    """
+    LidarDSMTileModels of the tiles that already exist, {(x, y): LidarDSMTileModel}
+    """
+    tiles = set(tiles)
+    return {
+        (tile.x, tile.y): tile for tile in LidarDSMTileModel.objects.filter(
+            cld=cloud, zoom=z, x__in={x for x, _ in tiles}, y__in={y for _, y in tiles})
+        if (tile.x, tile.y) in tiles
+    }
+
+
+def saveDSMTiles(cloud: EPTLidarPointCloud, tile_files: dict, existing: dict, z: int) -> list:
+    """
+    Upload the tile files concurrently and create or update their LidarDSMTileModels in bulk
+
+    Args:
+        tile_files: {(x, y): path of the tile's GeoTIFF}
+        existing: LidarDSMTileModels to update instead of creating, see `getExistingTiles`
+
+    The overview tiles above the saved tiles lose their file so `createDSMOverviews` rebuilds them
+
+    Returns:
+        list of the saved LidarDSMTileModels, tiles that failed to upload are left out
+    """
+    lidartiles = []
+    for (x, y), filename in tile_files.items():
+        lidartile = existing.get((x, y), LidarDSMTileModel(cld=cloud, zoom=z, x=x, y=y))
+        lidartile.tile.name = lidartile.upload_to_path(filename)
+        lidartiles.append(lidartile)
+    failed = set(s3.writeMultipleS3Objects(
+        [lidartile.tile.name for lidartile in lidartiles],
+        [tile_files[(lidartile.x, lidartile.y)] for lidartile in lidartiles],
+        bucket_name=LidarDSMTileModel.bucket_name,
+    ))
+    if failed:
+        logger.error(f'failed to upload {len(failed)} tiles: {(cloud.pk, z)}')
+    lidartiles = [lidartile for lidartile in lidartiles if lidartile.tile.name not in failed]
+
+    with transaction.atomic():
+        LidarDSMTileModel.objects.bulk_create(
+            [lidartile for lidartile in lidartiles if lidartile.pk is None], ignore_conflicts=True)
+        LidarDSMTileModel.objects.bulk_update(
+            [lidartile for lidartile in lidartiles if lidartile.pk is not None], ['tile'])
+        if z - 1 in DSM_OVERVIEW_ZOOMS and lidartiles:
+            parents = getExistingTiles(cloud, getParentTiles((t.x, t.y) for t in lidartiles), z - 1)
+            # The s3 objects are kept until they are rebuilt, readers go through the tile index
+            LidarDSMTileModel.objects.filter(pk__in=[t.pk for t in parents.values()]).update(tile='')
+    dsm_tile_index.addTiles(
+        cloud, [lidartile.x for lidartile in lidartiles], [lidartile.y for lidartile in lidartiles], z)
+    return lidartiles
+
+
+def getDSMTilingBlocks(cloud: EPTLidarPointCloud) -> list:
+    """
+    Blocks of tiles covering a point cloud at DEFAULT_OUTPUT_ZOOM, always in the same order
     """
-    cloud = EPTLidarPointCloud.objects.get(pk=pk)
     boundary = (
         cloud.high_resolution_boundary if cloud.high_resolution_boundary else
         cloud.boundary
     )
-    tiles = getTiles(boundary, DEFAULT_OUTPUT_ZOOM)
-    for tile in tiles:
-        x, y = tile
-        boundary_tile = getBoundaryofTile(x, y, DEFAULT_OUTPUT_ZOOM)
-        if boundary.intersects(boundary_tile):
-            createTileDSM.delay(tile, DEFAULT_OUTPUT_ZOOM, pk)
+    tiles = [
+        (x, y) for x, y in getTiles(boundary, DEFAULT_OUTPUT_ZOOM)
+        if boundary.intersects(getBoundaryofTile(x, y, DEFAULT_OUTPUT_ZOOM))
+    ]
+    return groupTilesIntoBlocks(tiles)
+
+
+def dispatchDSMTilingBlocks(cloud: EPTLidarPointCloud, blocks: list):
+    """
+    Queue blocks of the point cloud, each block reports back to the cloud's tiling job with `finishBlock`
+    """
+    for block in blocks:
+        createBlockDSM.delay(block, DEFAULT_OUTPUT_ZOOM, cloud.pk)
+
+
+@app.task
+def convertPtCloudToDSMTiled(pk: int):
+    """
+    For a point cloud create all tiles at DEFAULT_OUTPUT_ZOOM, the cloud is tiled next by the scheduler
+    """
+    # Lazy import, the scheduler imports this module
+    from mmwave.tasks.lidar_tasks import requestDSMTilingSchedule
+    job, _ = DSMTilingJob.objects.get_or_create(cld_id=pk)
+    DSMTilingJob.objects.filter(pk=job.pk).exclude(status=DSMTilingJob.Status.RUNNING).update(
+        status=DSMTilingJob.Status.PENDING, last_requested=timezone.now(), updated=timezone.now())
+    requestDSMTilingSchedule()
+
+
+def finishBlock(pk: int, tiles_created: int, failed: bool = False):
+    """
+    Record the block in the cloud's tiling job and let the scheduler queue more blocks,
+    the overviews are built once every block of the job is finished
+    """
+    # Lazy import, the scheduler imports this module
+    from mmwave.tasks.lidar_tasks import requestDSMTilingSchedule
+    try:
+        if DSMTilingJob.recordBlock(pk, tiles_created, failed=failed):
+            if DSMTilingJob.finishBlocks(pk):
+                createDSMOverviews.delay(pk)
+            requestDSMTilingSchedule()
+    except Exception:
+        logger.exception(f'failed to record block: {pk}')
+
+
+@app.task
+def createDSMOverviews(pk: int):
+    """
+    Build the overview pyramid of a point cloud's DSM tiles at DSM_OVERVIEW_ZOOMS, see `dsm_overviews`
+
+    Every level is built from the level below it. Overview tiles that already have a file are skipped,
+    `saveDSMTiles` clears the file of the overview tiles above new tiles. Jobs with failed blocks
+    build no overviews, they would keep the holes of the failed blocks.
+
+    Returns:
+        number of overview tiles created
+    """
+    running = DSMTilingJob.objects.filter(cld_id=pk, status=DSMTilingJob.Status.RUNNING)
+    # Jobs with failed blocks are retried, the tiles that were created are skipped
+    if running.filter(blocks_failed__gt=0).update(
+        status=DSMTilingJob.Status.FAILED, finished=timezone.now(), updated=timezone.now()
+    ):
+        return 0
+    try:
+        cloud = EPTLidarPointCloud.objects.get(pk=pk)
+        created = 0
+        for z in DSM_OVERVIEW_ZOOMS:
+            children = set(unpackTiles(dsm_tile_index.getTiles(cloud, z + 1)))
+            for block in groupTilesIntoBlocks(getParentTiles(children)):
+                created += createOverviewTiles(cloud, block, z, children)
+            logger.info(f'done creating overviews: {(z, pk)}')
+    except Exception:
+        running.update(status=DSMTilingJob.Status.FAILED, updated=timezone.now())
+        raise
+    running.update(status=DSMTilingJob.Status.DONE, finished=timezone.now(), updated=timezone.now())
+    return created
+
+
+def createOverviewTiles(cloud: EPTLidarPointCloud, tiles: list, z: int, children: set) -> int:
+    """
+    Create the overview tiles at zoom `z` from the `children` tiles at zoom z + 1
+    """
+    existing = getExistingTiles(cloud, tiles, z)
+    pending = [tile for tile in tiles if tile not in existing or not existing[tile].tile.name]
+    if len(pending) == 0:
+        return 0
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        child_files = {
+            child: os.path.join(tmp_dir, f'{z + 1}-{child[0]}-{child[1]}.tif')
+            for tile in pending for child in getChildTiles(*tile) if child in children
+        }
+        dsm_tile_cache.readMultiple(
+            [cloud.get_s3_key_tile(x, y, z + 1, old_path=USE_OLD_TILES) for x, y in child_files],
+            list(child_files.values())
+        )
+        tile_files = {}
+        for x, y in pending:
+            files = [
+                child_files[child] for child in getChildTiles(x, y)
+                if child in child_files and os.path.exists(child_files[child]) and os.path.getsize(child_files[child]) > 0
+            ]
+            filename = os.path.join(tmp_dir, f'{z}-{x}-{y}.tif')
+            if len(files) > 0 and downsampleDSMTiles(files, z, x, y, filename):
+                tile_files[(x, y)] = filename
+        return len(saveDSMTiles(cloud, tile_files, existing, z))
+
+
+@app.task(default_retry_delay=30, max_retries=3, soft_time_limit=DSM_BLOCK_SOFT_TIME_LIMIT_S)
+def createBlockDSM(tiles: list, z: int, pk: int):
+    """
+    Create the DSM tiles of a block with a single pdal read
+
+    The block is rasterized once, cut into tiles in process, the tiles are uploaded
+    concurrently and their LidarDSMTileModels created in bulk. Tiles that already have
+    a file are skipped.
+
+    Returns:
+        number of tiles created
+    """
+    tiles = [tuple(tile) for tile in tiles]
+    logger.info(f'creating block: {(tiles[0], len(tiles), z, pk)}')
+    try:
+        created = createBlockTiles(tiles, z, pk)
+    except SoftTimeLimitExceeded as e:
+        logger.error(f'time limit exceeded: {(tiles[0], len(tiles), z, pk)}')
+        finishBlock(pk, 0, failed=True)
+        raise e
+    except Exception:
+        finishBlock(pk, 0, failed=True)
+        raise
+    logger.info(f'done creating block: {(tiles[0], created, z, pk)}')
+    finishBlock(pk, created)
+    return created
+
+
+def createBlockTiles(tiles: list, z: int, pk: int) -> int:
+    """
+    Body of `createBlockDSM`, returns the number of tiles created
+    """
+    cloud = EPTLidarPointCloud.objects.get(pk=pk)
+    existing = getExistingTiles(cloud, tiles, z)
+    pending = [tile for tile in tiles if tile not in existing or not existing[tile].tile.name]
+    if len(pending) == 0:
+        return 0
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        block_tif = os.path.join(tmp_dir, 'block.tif')
+        # Any failure to rasterize fails the block, only a block without points counts as done
+        points = DSMEngine(getBoundaryofTiles(pending, z), [cloud]).getDSM(
+            1.0, block_tif, gdalopts=DSM_INTERMEDIATE_GDALOPTS, fixed_extent=True)
+        if points == 0:
+            logger.info(f'block without points: {(tiles[0], len(tiles), z, pk)}')
+            return 0
+        tile_files = splitDSMIntoTiles(block_tif, pending, z, tmp_dir)
+        return len(saveDSMTiles(cloud, tile_files, existing, z))
 
 
 @app.task(default_retry_delay=30, max_retries=3, soft_time_limit=120)
@@ -44,9 +323,11 @@ def createTileDSM(tile: tuple, z: int, pk: int):
         if created or not lidartile.tile.name or lidartile.tile.size == 0:
             engine = DSMEngine(boundary_tile, [cloud])
             with tempfile.NamedTemporaryFile(suffix='.tif') as tmp_tif:
-                engine.getDSM(1.0, tmp_tif.name)
+                engine.getDSM(1.0, tmp_tif.name, gdalopts=getTileGDALOpts())
                 lidartile.tile.save(f'{lidartile.pk}', tmp_tif)
         lidartile.save()
+        if created:
+            dsm_tile_index.addTile(cloud, x, y, z)
         logger.info(f'done creating tile: {(tile, z, pk)}')
         return lidartile.pk
     except SoftTimeLimitExceeded as e:
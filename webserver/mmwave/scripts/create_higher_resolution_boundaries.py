@@ -1,13 +1,23 @@
 # (c) Meta Platforms, Inc. and affiliates. Copyright
 from mmwave.models import EPTLidarPointCloud
+from mmwave.lidar_utils.boundary_index import bumpBoundaryIndexVersion
 from django.contrib.gis.geos import GEOSGeometry
 from django.contrib.gis.gdal import SpatialReference, CoordTransform
 from bots.alert_fb_oncall import sendEmailToISPToolboxOncall
 from django.conf import settings
+from celery import chord
+from celery.exceptions import SoftTimeLimitExceeded
+from celery_async.celery import celery_app as app
 import logging
 import subprocess
 import json
 import shlex
+import time
+
+# Clouds are processed in chunks of HIGH_RES_BOUNDARY_CHUNK_SIZE on the dsm workers
+HIGH_RES_BOUNDARY_CHUNK_SIZE = 4
+# pdal info is killed after this long, the cloud is retried on the next run
+HIGH_RES_BOUNDARY_TIMEOUT_S = 30 * 60
 
 
 def createInfoCommand(url, ept_res=800.0, hexbin_edge_size=1000, hexbin_threshold=1):
@@ -21,15 +31,17 @@ def createInfoCommand(url, ept_res=800.0, hexbin_edge_size=1000, hexbin_threshol
     )
 
 
-def calculateEPTHighResolutionBoundary(cloud):
+def calculateEPTHighResolutionBoundary(cloud, timeout=HIGH_RES_BOUNDARY_TIMEOUT_S):
     """
         Calculate High Resolution Boundary of Point Cloud and save to model
+
+        Raises subprocess.TimeoutExpired if pdal takes longer than `timeout` seconds
     """
     default_coords = SpatialReference(4326)
     try:
         # Change Projection to 4236, write to cloud
         command = createInfoCommand(url=cloud.url, ept_res=50.0, hexbin_edge_size=50, hexbin_threshold=1)
-        result = subprocess.run(command, stdout=subprocess.PIPE)
+        result = subprocess.run(command, stdout=subprocess.PIPE, timeout=timeout)
         if result.returncode == 0:
             data = json.loads(result.stdout)
             projection = SpatialReference(data['metadata']['srs']['wkt'])
@@ -45,37 +57,78 @@ def calculateEPTHighResolutionBoundary(cloud):
         raise e
 
 
-def processPointCloudBoundaries():
+def getCloudsWithoutHighResolutionBoundary() -> list:
+    return list(
+        EPTLidarPointCloud.objects.filter(high_resolution_boundary__isnull=True).order_by('pk').values_list('pk', flat=True)
+    )
+
+
+@app.task(acks_late=True, soft_time_limit=HIGH_RES_BOUNDARY_CHUNK_SIZE * HIGH_RES_BOUNDARY_TIMEOUT_S + 5 * 60)
+def computeHighResolutionBoundaries(pks: list) -> dict:
+    """
+        Use PDAL to generate higher-resolution boundaries for a chunk of point clouds
+
+        Boundaries are saved as soon as they are computed and clouds that already have one are
+        skipped, so a chunk that is redelivered or a batch that is rerun resumes where it stopped.
+
+        Returns:
+            {'succeeded': [name], 'failed': [name error], 'skipped': [name]}
     """
-        Use PDAL to generate higher-resolution boundaries and write back to database:
+    report = {'succeeded': [], 'failed': [], 'skipped': []}
+    clouds = list(EPTLidarPointCloud.objects.filter(pk__in=pks).defer('boundary').order_by('pk'))
+    for i, cloud in enumerate(clouds):
+        if cloud.high_resolution_boundary is not None:
+            report['skipped'].append(cloud.name)
+            continue
+        logging.info(f'Processing {cloud.name}...')
+        start = time.time()
+        try:
+            calculateEPTHighResolutionBoundary(cloud)
+            report['succeeded'].append(cloud.name)
+        except subprocess.TimeoutExpired:
+            report['failed'].append(f'{cloud.name} timed out after {HIGH_RES_BOUNDARY_TIMEOUT_S}s')
+        except SoftTimeLimitExceeded:
+            # Report the rest of the chunk instead of failing the batch
+            report['failed'] += [f'{cld.name} chunk time limit exceeded' for cld in clouds[i:]]
+            break
+        except Exception as e:
+            report['failed'].append(f'{cloud.name} {str(e)}')
+        logging.info(f'Processed {cloud.name} in {time.time() - start:.1f}s')
+    return report
 
-        This is because the boundaries provided by EntWine are sometimes too coarse
-        to determine if a link will overlap them
+
+def dispatchHighResolutionBoundaries(callback) -> int:
+    """
+        Fan the clouds without a high resolution boundary out in chunks, `callback` gets the list
+        of chunk reports once every chunk is done
+
+        Returns:
+            number of clouds queued
+    """
+    pks = getCloudsWithoutHighResolutionBoundary()
+    chunks = [pks[i:i + HIGH_RES_BOUNDARY_CHUNK_SIZE] for i in range(0, len(pks), HIGH_RES_BOUNDARY_CHUNK_SIZE)]
+    if len(chunks) > 0:
+        chord(computeHighResolutionBoundaries.s(chunk) for chunk in chunks)(callback)
+    else:
+        callback.delay([])
+    return len(pks)
+
+
+def reportHighResolutionBoundaries(reports: list):
+    """
+        Consolidate the chunk reports of a batch, reload the boundary index and email oncall
     """
-    successful_conversions = []
-    failed_conversions = []
-    default_high_res_boundary = EPTLidarPointCloud._meta.get_field('high_resolution_boundary').get_default()
-    for cloud in EPTLidarPointCloud.objects.all().iterator():
-        if cloud.high_resolution_boundary == default_high_res_boundary:
-            logging.info(f'Processing {cloud.name}...')
-            try:
-                calculateEPTHighResolutionBoundary(cloud)
-                successful_conversions.append(cloud.name)
-            except Exception as e:
-                failed_conversions.append(f'{cloud.name} {str(e)}')
-
-    # Return the failed and successful clouds boundaries
-    return successful_conversions, failed_conversions
-
-
-def updatePointCloudBoundariesTask():
-    successes, failures = processPointCloudBoundaries()
+    successes = [name for report in reports for name in report['succeeded']]
+    failures = [name for report in reports for name in report['failed']]
+    bumpBoundaryIndexVersion()
     new_boundaries = "\n".join(successes)
     failed_high_resolution_boundaries = "\n".join(failures)
     result_msg = f'New Boundaries:\n {len(successes)}\n Failed to Update Boundaries:\n {len(failures)}\n' + \
                  f'Point Clouds:\n{new_boundaries}\nFailed To Create Boundaries:\n{failed_high_resolution_boundaries}'
+    logging.info(result_msg)
     if settings.PROD:
         sendEmailToISPToolboxOncall(
             '[Automated Message 🤖 ][Updated LiDAR Boundaries]',
             result_msg
         )
+    return successes, failures
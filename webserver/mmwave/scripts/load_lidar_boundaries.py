@@ -4,6 +4,7 @@ import json
 
 from isptoolbox_storage.mapbox.upload_tileset import prepareGeoJSONUploadMapbox
 from mmwave.models import EPTLidarPointCloud
+from mmwave.lidar_utils.boundary_index import bumpBoundaryIndexVersion
 from django.contrib.gis.geos import GEOSGeometry, GeometryCollection, Polygon
 from bots.alert_fb_oncall import sendEmailToISPToolboxOncall
 from isptoolbox_storage.storage import S3ManifestStorage
@@ -67,6 +68,8 @@ def loadBoundariesFromEntWine(send_email_success=False, send_email_failure=True)
     except Exception as e:
         if send_email_failure and settings.PROD:
             sendEmailToISPToolboxOncall(UNSUCCESSFUL_UPDATE_SUBJECT, f'Error: {str(e)}')
+    finally:
+        bumpBoundaryIndexVersion()
 
     return new_point_clouds
 
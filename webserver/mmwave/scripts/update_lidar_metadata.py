@@ -3,6 +3,7 @@ import requests
 import fiona
 import tempfile
 from mmwave.models import USGSLidarMetaDataModel
+from mmwave.lidar_utils.lidar_engine_queries import bumpCollectionDatesVersion
 from bots.alert_fb_oncall import sendEmailToISPToolboxOncall
 
 WESM_ENDPOINT = "https://prd-tnm.s3.amazonaws.com/StagedProducts/Elevation/metadata/WESM.gpkg"
@@ -46,6 +47,7 @@ def update_lidar_metadata():
                         )
                     except Exception as e:
                         errors.append(e)
+    bumpCollectionDatesVersion()
     return new_layers, errors
 
 
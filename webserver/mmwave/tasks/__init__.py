@@ -1,18 +1,24 @@
 from .link_tasks import (
-    getLinkInfo, getLiDARProfile, getTerrainProfile, getElevationProfile,
-    pullLatestPointCloudsEntwine, addHighResolutionBoundaries,
+    getLinkInfo, getLiDARProfile, prefetchLiDARProfiles, getTerrainProfile, getElevationProfile,
+    pullLatestPointCloudsEntwine, addHighResolutionBoundaries, finishHighResolutionBoundaries,
     uploadBoundaryTilesetMapbox, createNewlyAddedCloudOverlay,
     getDTMPoint,
 )
 from .dsm_tasks import exportDSMData
-from .lidar_tasks import updateLidarMetaData, pull_latest_pointcloud_metadata, tile_untiled_datasets
-from mmwave.scripts.create_dsm_for_ept import createTileDSM, convertPtCloudToDSMTiled
+from .lidar_tasks import (
+    updateLidarMetaData, pull_latest_pointcloud_metadata, tile_untiled_datasets, scheduleDSMTiling,
+)
+from mmwave.scripts.create_dsm_for_ept import (
+    createTileDSM, createBlockDSM, createDSMOverviews, convertPtCloudToDSMTiled,
+)
 from mmwave.scripts.smap import create_los_engagemnet_csv
 
 __all__ = [
-    'getLinkInfo', 'getLiDARProfile', 'getTerrainProfile', 'exportDSMData', 'getElevationProfile',
-    'updateLidarMetaData', 'createTileDSM', 'convertPtCloudToDSMTiled', 'getDTMPoint',
-    'pullLatestPointCloudsEntwine', 'addHighResolutionBoundaries',
+    'getLinkInfo', 'getLiDARProfile', 'prefetchLiDARProfiles', 'getTerrainProfile', 'exportDSMData', 'getElevationProfile',
+    'updateLidarMetaData', 'createTileDSM', 'createBlockDSM', 'createDSMOverviews', 'convertPtCloudToDSMTiled',
+    'getDTMPoint',
+    'pullLatestPointCloudsEntwine', 'addHighResolutionBoundaries', 'finishHighResolutionBoundaries',
     'uploadBoundaryTilesetMapbox', 'createNewlyAddedCloudOverlay',
-    'pull_latest_pointcloud_metadata', 'create_los_engagement_csv', 'tile_untiled_datasets'
+    'pull_latest_pointcloud_metadata', 'create_los_engagement_csv', 'tile_untiled_datasets',
+    'scheduleDSMTiling',
 ]
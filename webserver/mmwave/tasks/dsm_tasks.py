@@ -1,7 +1,7 @@
 # (c) Meta Platforms, Inc. and affiliates. Copyright
 from celery_async.celery import celery_app as app
 from mmwave.lidar_utils.DSMTileEngine import DSMTileEngine
-from mmwave.models import DSMConversionJob, EPTLidarPointCloud
+from mmwave.models import DSMConversionJob, DSMTilingJob, EPTLidarPointCloud
 import tempfile
 from area import area
 
@@ -14,18 +14,11 @@ def exportDSMData(DSMConversionJob_uuid):
     """
     conversion = DSMConversionJob.objects.filter(
         uuid=DSMConversionJob_uuid).get()
-    query = (
-        EPTLidarPointCloud.objects.filter(
-            high_resolution_boundary__isnull=True,
-            boundary__intersects=conversion.area_of_interest
-        ) |
-        EPTLidarPointCloud.objects.filter(
-            high_resolution_boundary__isnull=False,
-            high_resolution_boundary__intersects=conversion.area_of_interest
-        )
-    )
-    pt_clouds = query.all()
-    dsm_engine = DSMTileEngine(conversion.area_of_interest.envelope, pt_clouds)
+    pt_clouds = EPTLidarPointCloud.query_intersect_aoi(conversion.area_of_interest)
+    # Untiled clouds that users ask for are tiled first
+    DSMTilingJob.recordDemand(pt_clouds)
+    dsm_engine = DSMTileEngine(
+        conversion.area_of_interest.envelope, pt_clouds, resolution=float(conversion.resolution))
 
     with tempfile.NamedTemporaryFile(suffix=".tif") as temp_fp:
         # Run the DSM generation in a separate process, monitor that process and keep the
@@ -4,14 +4,25 @@ from mmwave.scripts.update_lidar_metadata import (
 )
 from celery_async.celery import celery_app as app
 from django.conf import settings
-from mmwave.models import EPTLidarPointCloud
-import redis
-import time
+from django.core.cache import caches
+from django.db.models import Case, Exists, F, IntegerField, OuterRef, Sum, Value, When
+from django.utils import timezone
+from mmwave.models import EPTLidarPointCloud, LidarDSMTileModel, DSMTilingJob
+import datetime
 from celery.utils.log import get_task_logger
-from mmwave.scripts.create_dsm_for_ept import convertPtCloudToDSMTiled
+from mmwave.scripts.create_dsm_for_ept import getDSMTilingBlocks, dispatchDSMTilingBlocks
 
 logger = get_task_logger(__name__)
 
+DSM_TILING_CACHE_NAME = 'los'
+DSM_TILING_LOCK_KEY = 'dsm_tiling_scheduler_lock'
+DSM_TILING_LOCK_TIMEOUT_S = 5 * 60
+DSM_TILING_REQUEST_KEY = 'dsm_tiling_scheduler_requested'
+DSM_TILING_REQUEST_TIMEOUT_S = 60
+DSM_TILING_RETRY_S = 10
+# Clouds requested within this window are tiled before any other
+DSM_TILING_RECENT_DEMAND_S = 7 * 24 * 60 * 60
+
 
 def updateLidarMetaData():
     results = update_lidar_metadata()
@@ -26,24 +37,137 @@ def pull_latest_pointcloud_metadata():
 
 @app.task
 def tile_untiled_datasets():
-    # Create connection to redis to check queue length and throttle
-    url = settings.CELERY_BROKER_URL.replace('redis://', '')
-    url = url.replace(':6379', '')
-    r = redis.Redis(url)
-
-    # Load all clouds and filter only those that are untiled
-    clouds = EPTLidarPointCloud.objects.all()
-    clouds = [(cld, cld.tiled) for cld in clouds]
-    clouds = filter(lambda x: not x[1], clouds)
-    idx = 0
-
-    # Tile all clouds and throttle to not overrun redis queue length
-    # and run out of memory
-    for cloud, tiled in clouds:
-        logger.info(f'cloud: {cloud.pk} {cloud.name} {idx}')
-        idx = idx + 1
-        convertPtCloudToDSMTiled.delay(cloud.pk)
-        while (True):
-            time.sleep(10)
-            if r.llen('dsm') < 1000:
+    """
+    Queue tiling jobs for the point clouds without DSM tiles, retry failed ones and start the scheduler
+    """
+    untiled = EPTLidarPointCloud.objects.filter(
+        ~Exists(LidarDSMTileModel.objects.filter(cld=OuterRef('pk'))),
+        tiling_job__isnull=True,
+    ).values_list('pk', flat=True)
+    created = DSMTilingJob.objects.bulk_create(
+        [DSMTilingJob(cld_id=pk) for pk in untiled], ignore_conflicts=True
+    )
+    retried = DSMTilingJob.objects.filter(
+        status=DSMTilingJob.Status.FAILED, attempts__lt=settings.DSM_TILING_MAX_ATTEMPTS
+    ).update(status=DSMTilingJob.Status.PENDING, updated=timezone.now())
+    logger.info(f'queued {len(created)} untiled clouds, retrying {retried}')
+    scheduleDSMTiling.delay()
+
+
+def requestDSMTilingSchedule(countdown: float = 0):
+    """
+    Debounced `scheduleDSMTiling`, at most one run is waiting in the queue
+    """
+    try:
+        if not caches[DSM_TILING_CACHE_NAME].add(DSM_TILING_REQUEST_KEY, 1, timeout=DSM_TILING_REQUEST_TIMEOUT_S):
+            return
+    except Exception:
+        logger.exception('failed to debounce dsm tiling scheduler')
+    scheduleDSMTiling.apply_async(countdown=countdown)
+
+
+def getNextDSMTilingJob():
+    """
+    Pending job to start next: clouds requested recently first, then by demand, then oldest first
+    """
+    recent = timezone.now() - datetime.timedelta(seconds=DSM_TILING_RECENT_DEMAND_S)
+    return DSMTilingJob.objects.filter(status=DSMTilingJob.Status.PENDING).annotate(
+        recent=Case(When(last_requested__gte=recent, then=Value(1)), default=Value(0), output_field=IntegerField())
+    ).order_by(
+        '-recent', '-demand', F('last_requested').desc(nulls_last=True), 'pk'
+    ).select_related('cld').first()
+
+
+def getDSMTilingBlocksInFlight() -> int:
+    """
+    Blocks of the running jobs that are queued or running on the dsm workers
+    """
+    return DSMTilingJob.objects.filter(status=DSMTilingJob.Status.RUNNING).aggregate(
+        blocks=Sum(F('blocks_dispatched') - F('blocks_done') - F('blocks_failed'))
+    )['blocks'] or 0
+
+
+def dispatchDSMTilingSlice(job: DSMTilingJob, limit: int) -> int:
+    """
+    Queue up to `limit` more blocks of a running job, returns the number of blocks queued
+
+    Blocks are counted as dispatched before they are queued, so the block that finishes
+    last always sees every block of the job dispatched and builds the overviews.
+    """
+    try:
+        blocks = getDSMTilingBlocks(job.cld)
+        start = job.blocks_dispatched
+        end = min(start + limit, len(blocks))
+        now = timezone.now()
+        if len(blocks) == 0:
+            DSMTilingJob.objects.filter(pk=job.pk).update(
+                status=DSMTilingJob.Status.DONE, finished=now, updated=now)
+            return 0
+        DSMTilingJob.objects.filter(pk=job.pk).update(
+            blocks_total=len(blocks), blocks_dispatched=max(start, end), updated=now)
+        dispatchDSMTilingBlocks(job.cld, blocks[start:end])
+    except Exception:
+        logger.exception(f'failed to queue tiling blocks: {job.cld_id}')
+        DSMTilingJob.objects.filter(pk=job.pk).update(status=DSMTilingJob.Status.FAILED, updated=timezone.now())
+        return 0
+    return max(end - start, 0)
+
+
+def startDSMTilingJob(job: DSMTilingJob, limit: int) -> int:
+    """
+    Start the job and queue up to `limit` of its cloud's blocks, returns the number of blocks queued
+    """
+    now = timezone.now()
+    # Counters are only ever updated in the database, blocks finish concurrently
+    DSMTilingJob.objects.filter(pk=job.pk).update(
+        status=DSMTilingJob.Status.RUNNING, attempts=F('attempts') + 1, started=now, finished=None,
+        blocks_total=0, blocks_dispatched=0, blocks_done=0, blocks_failed=0, tiles_created=0, updated=now,
+    )
+    job.blocks_dispatched = 0
+    blocks = dispatchDSMTilingSlice(job, limit)
+    logger.info(f'started tiling: {(job.cld_id, job.cld.name, blocks)}')
+    return blocks
+
+
+@app.task
+def scheduleDSMTiling():
+    """
+    Queue blocks of the tiling jobs until DSM_TILING_TARGET_BLOCKS_IN_FLIGHT blocks are queued or running
+
+    Runs when jobs are queued and whenever a block finishes, instead of polling the dsm queue.
+    The running jobs get their next slice of blocks first, then pending jobs are started.
+    """
+    cache = caches[DSM_TILING_CACHE_NAME]
+    cache.delete(DSM_TILING_REQUEST_KEY)
+    if not cache.add(DSM_TILING_LOCK_KEY, 1, timeout=DSM_TILING_LOCK_TIMEOUT_S):
+        # Another run holds the lock, look again once it is done
+        requestDSMTilingSchedule(countdown=DSM_TILING_RETRY_S)
+        return 0
+    try:
+        stale = DSMTilingJob.objects.filter(
+            status=DSMTilingJob.Status.RUNNING,
+            updated__lt=timezone.now() - datetime.timedelta(seconds=settings.DSM_TILING_STALE_S),
+        ).update(status=DSMTilingJob.Status.FAILED, updated=timezone.now())
+        if stale:
+            logger.error(f'marked {stale} stale tiling jobs failed')
+
+        target = settings.DSM_TILING_TARGET_BLOCKS_IN_FLIGHT
+        in_flight = getDSMTilingBlocksInFlight()
+        running = DSMTilingJob.objects.filter(
+            status=DSMTilingJob.Status.RUNNING, blocks_dispatched__lt=F('blocks_total')
+        ).order_by('started', 'pk').select_related('cld')
+        for job in running:
+            if in_flight >= target:
+                break
+            in_flight += dispatchDSMTilingSlice(job, target - in_flight)
+
+        started = 0
+        while in_flight < target:
+            job = getNextDSMTilingJob()
+            if job is None:
                 break
+            in_flight += startDSMTilingJob(job, target - in_flight)
+            started += 1
+        return started
+    finally:
+        cache.delete(DSM_TILING_LOCK_KEY)
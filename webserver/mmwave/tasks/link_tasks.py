@@ -21,6 +21,9 @@ from mmwave.lidar_utils.LidarEngine import (
     LidarEngine, LidarResolution, LIDAR_RESOLUTION_DEFAULTS,
     LIDAR_RESOLUTION_MAX_LINK_LENGTH, LidarEngineException
 )
+from mmwave.lidar_utils.BatchLidarEngine import BatchLidarEngine
+from mmwave.lidar_utils.progressive_lidar import createProgressiveProfileSource
+from mmwave.lidar_utils.dsm_profile import createDSMProfileSource
 from mmwave.lidar_utils.show_latest_pt_clouds import createNewPointCloudAvailability
 from shapely.geometry import LineString as shapely_LineString
 from mmwave.models import TGLink
@@ -28,7 +31,9 @@ from mmwave.scripts.load_lidar_boundaries import (
     loadBoundariesFromEntWine, createInvertedOverlay, getOverlayFromS3,
     HIGH_RES_PT_CLOUD_AVAILABILITY_OVERLAY_S3_PATH
 )
-from mmwave.scripts.create_higher_resolution_boundaries import updatePointCloudBoundariesTask
+from mmwave.scripts.create_higher_resolution_boundaries import (
+    dispatchHighResolutionBoundaries, reportHighResolutionBoundaries,
+)
 from isptoolbox_storage.mapbox.upload_tileset import uploadNewTileset
 from bots.alert_fb_oncall import sendEmailToISPToolboxOncall
 from django.conf import settings
@@ -37,6 +42,7 @@ GOOGLE_MAPS_SAMPLE_LIMIT = 512
 DEFAULT_NUM_SAMPLES_PER_M = 1
 LINK_DISTANCE_LIMIT = 100000
 MAXIMUM_NUM_POINTS_RETURNED = 1024
+DSM_PROFILE_RESOLUTIONS = (LidarResolution.LOW, LidarResolution.MEDIUM)
 TASK_LOGGER = get_task_logger(__name__)
 
 
@@ -235,10 +241,16 @@ def getLiDARProfile(network_id, data, resolution=LidarResolution.LOW.value):
             TASK_LOGGER.info('lidar cache miss for resolution %s', resolution)
 
             resp['dist'] = link_dist_m
+            # Each resolution step only reads the octree levels the previous steps did not
+            profile_source = createProgressiveProfileSource(LIDAR_RESOLUTION_DEFAULTS[resolution])
+            if resolution in DSM_PROFILE_RESOLUTIONS:
+                # Coarse profiles are sampled from the pre-rendered DSM tiles where available
+                profile_source = createDSMProfileSource(profile_source)
             le = LidarEngine(
                 link=LineString([tx_sub, rx_sub]),
                 resolution=LIDAR_RESOLUTION_DEFAULTS[resolution],
-                num_samples=MAXIMUM_NUM_POINTS_RETURNED
+                num_samples=MAXIMUM_NUM_POINTS_RETURNED,
+                profile_source=profile_source
             )
             resp['lidar_profile'] = le.getProfile()
             resp['url'] = le.getUrls()
@@ -268,6 +280,49 @@ def getLiDARProfile(network_id, data, resolution=LidarResolution.LOW.value):
     async_to_sync(channel_layer.group_send)(channel_name, resp)
 
 
+@app.task
+def prefetchLiDARProfiles(links, resolution=LidarResolution.HIGH.value):
+    """
+        Warms the LiDAR cache of `getLiDARProfile` for links sharing a tower (e.g. a sector and its CPEs),
+        the point clouds are read once for all the links instead of once per link
+
+        links - list of (tx, rx) [lng, lat] pairs
+    """
+    aoi = [0, 1]
+    pending = []
+    for tx, rx in links:
+        tx, rx = Point([float(f) for f in tx]), Point([float(f) for f in rx])
+        r = lidar_cache_get(tx, rx, aoi)
+        if r and r['resolution'] >= resolution:
+            continue
+        if genLinkDistance(tx, rx) < LIDAR_RESOLUTION_MAX_LINK_LENGTH[resolution]:
+            pending.append((tx, rx))
+    if len(pending) == 0:
+        return
+
+    batch = BatchLidarEngine(
+        [LineString([tx, rx]) for tx, rx in pending],
+        LIDAR_RESOLUTION_DEFAULTS[resolution],
+        MAXIMUM_NUM_POINTS_RETURNED
+    )
+    for (tx, rx), le in zip(pending, batch.getEngines()):
+        if le is None:
+            continue
+        lidar_cache_set(tx, rx, aoi, {
+            'lidar_profile': le.getProfile(),
+            'url': le.getUrls(),
+            'bb': le.getBoundingBox(),
+            'source': le.getSources(),
+            'tx': le.getTxLidarCoord(),
+            'rx': le.getRxLidarCoord(),
+            'aoi': aoi,
+            'resolution': resolution,
+            'res': LIDAR_RESOLUTION_DEFAULTS[resolution],
+            'dist': genLinkDistance(tx, rx),
+        })
+    TASK_LOGGER.info(f'prefetched lidar profiles for {len(pending)} links')
+
+
 @app.task
 def getTerrainProfile(network_id, data):
     """
@@ -319,12 +374,21 @@ def addHighResolutionBoundaries():
     """
     This task updates the lidar boundaries and availability overlay
 
-    1. computes the high resolution boundaries for PointClouds that do not have it and stores to database
-    2. calculates the lidar availability overlay
+    1. computes the high resolution boundaries for PointClouds that do not have it and stores to database,
+       in parallel chunks on the dsm workers
+    2. calculates the lidar availability overlay, once every chunk is done
     3. uploads the availability overlay to mapbox as a tileset
 
     """
-    updatePointCloudBoundariesTask()
+    dispatchHighResolutionBoundaries(finishHighResolutionBoundaries.s())
+
+
+@app.task
+def finishHighResolutionBoundaries(reports: list):
+    """
+    Report the boundaries computed by `addHighResolutionBoundaries` and rebuild the overlay
+    """
+    reportHighResolutionBoundaries(reports)
     createInvertedOverlay(use_high_resolution_boundaries=True, invert=True)
 
 
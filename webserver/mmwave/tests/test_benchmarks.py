@@ -0,0 +1,58 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+from django.test import TestCase
+from mmwave.benchmarks.harness import compareReports
+from mmwave.benchmarks.local_s3 import LocalS3
+from mmwave.benchmarks.synthetic import SyntheticSurface, BUILDING_GRID_M
+from IspToolboxApp.util import s3
+import numpy as np
+import os
+import tempfile
+
+BOUNDS = (-10078662.0, 3966024.0, -10076262.0, 3968424.0)
+
+
+class TestBenchmarkFixtures(TestCase):
+    def test_surface_is_deterministic(self):
+        xs = np.linspace(BOUNDS[0], BOUNDS[2], 1000)
+        ys = np.linspace(BOUNDS[1], BOUNDS[3], 1000)
+        np.testing.assert_array_equal(
+            SyntheticSurface(BOUNDS, 7).height(xs, ys), SyntheticSurface(BOUNDS, 7).height(xs, ys))
+        self.assertFalse(np.array_equal(
+            SyntheticSurface(BOUNDS, 7).height(xs, ys), SyntheticSurface(BOUNDS, 8).height(xs, ys)))
+
+    def test_building_footprints(self):
+        surface = SyntheticSurface(BOUNDS)
+        footprints = surface.footprints()
+        self.assertTrue(len(footprints) > 0)
+        (xmin, ymin, xmax, ymax), height = footprints[0]
+        center = ((xmin + xmax) / 2., (ymin + ymax) / 2.)
+        self.assertAlmostEqual(float(surface.buildings(*center)), height)
+        # Gap between buildings is ground
+        self.assertEqual(float(surface.buildings(xmin + BUILDING_GRID_M - 1., ymin + 1.)), 0.)
+
+    def test_local_s3(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with LocalS3(os.path.join(tmp_dir, 's3')):
+                s3.writeS3Object('dsm/tiles/1-cloud/17/1/2.tif', b'tile')
+                self.assertEqual(s3.getObjectSize('dsm/tiles/1-cloud/17/1/2.tif'), 4)
+                self.assertEqual(s3.findPointCloudPrefix('dsm/tiles/', 'cloud'), 'dsm/tiles/1-cloud/')
+                filename = os.path.join(tmp_dir, 'tile.tif')
+                s3.readMultipleS3Objects(['dsm/tiles/1-cloud/17/1/2.tif', 'missing.tif'], [filename, filename + '.2'])
+                self.assertTrue(os.path.exists(filename))
+                self.assertFalse(os.path.exists(filename + '.2'))
+            self.assertIsNot(s3.getObjectSize, LocalS3.getObjectSize)
+
+    def test_compare_reports(self):
+        baseline = {'results': [
+            {'stage': 'profile', 'params': {'link_length_m': 100}, 'median': 1.0},
+            {'stage': 'viewshed', 'params': {'radius_m': 500}, 'median': 2.0},
+        ]}
+        current = {'results': [
+            {'stage': 'profile', 'params': {'link_length_m': 100}, 'median': 1.5},
+            {'stage': 'viewshed', 'params': {'radius_m': 500}, 'median': 2.0},
+            {'stage': 'coverage', 'params': {'radius_m': 500}, 'median': 1.0},
+        ]}
+        comparison = compareReports(baseline, current, threshold=1.2)
+        self.assertEqual([row['stage'] for row in comparison], ['profile', 'viewshed'])
+        self.assertTrue(comparison[0]['regression'])
+        self.assertFalse(comparison[1]['regression'])
@@ -0,0 +1,43 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+from django.test import TestCase
+from django.contrib.gis.geos import GEOSGeometry, LineString
+from mmwave.lidar_utils.LidarEngine import segmentLinkByPointClouds
+from mmwave.models import EPTLidarPointCloud
+
+
+class TestPointCloudBoundaryIndex(TestCase):
+    def setUp(self):
+        self.west = EPTLidarPointCloud(
+            name="west_2015", count=1, url="https://isptoolbox.com/west_2015/ept.json", srs=3857,
+            boundary=GEOSGeometry('POLYGON((-1 -1, 0.5 -1, 0.5 1, -1 1, -1 -1))', srid=4326)
+        )
+        self.west.save()
+        self.east = EPTLidarPointCloud(
+            name="east_2018", count=1, url="https://isptoolbox.com/east_2018/ept.json", srs=3857,
+            boundary=GEOSGeometry('POLYGON((0 -1, 2 -1, 2 1, 0 1, 0 -1))', srid=4326)
+        )
+        self.east.save()
+        self.link = LineString([(-0.5, 0), (1.5, 0)], srid=4326)
+
+    def test_query_matches_database(self):
+        indexed = sorted(cloud.pk for cloud in EPTLidarPointCloud.query_intersect_aoi(self.link))
+        database = sorted(cloud.pk for cloud in EPTLidarPointCloud.query_intersect_aoi_db(self.link))
+        self.assertEqual(indexed, database)
+        self.assertEqual(indexed, sorted([self.west.pk, self.east.pk]))
+        self.assertEqual(
+            len(EPTLidarPointCloud.query_intersect_aoi(LineString([(5, 5), (6, 6)], srid=4326))), 0)
+
+    def test_index_reloads_after_boundary_update(self):
+        far_link = LineString([(4, 0), (4.5, 0)], srid=4326)
+        self.assertEqual(len(EPTLidarPointCloud.query_intersect_aoi(far_link)), 0)
+        self.east.high_resolution_boundary = GEOSGeometry('POLYGON((0 -1, 5 -1, 5 1, 0 1, 0 -1))', srid=4326)
+        self.east.save(update_fields=['high_resolution_boundary'])
+        self.assertEqual([c.pk for c in EPTLidarPointCloud.query_intersect_aoi(far_link)], [self.east.pk])
+
+    def test_segmentation_matches_database_clouds(self):
+        def summarize(segments):
+            return [(geometry.wkt, cloud.pk if cloud is not None else None) for geometry, cloud in segments]
+
+        indexed = segmentLinkByPointClouds(self.link, EPTLidarPointCloud.query_intersect_aoi(self.link))
+        database = segmentLinkByPointClouds(self.link, EPTLidarPointCloud.query_intersect_aoi_db(self.link))
+        self.assertEqual(summarize(indexed), summarize(database))
@@ -0,0 +1,87 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+import os
+import tempfile
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from django.test import TestCase
+
+from mmwave.lidar_utils.dsm_encoding import (
+    DSM_NODATA, DSM_TILE_ENCODINGS, getTileGDALOpts, readDSMBand, unscaledTilePath, writeDSMTile
+)
+
+TRANSFORM = from_origin(-10078662.0, 3968424.0, 1.0, 1.0)
+# Largest height error of every encoding at the default settings
+MAX_ERRORS = {'deflate': 0., 'zstd': 0., 'lerc': 0.01, 'float16': 0.5, 'int16': 0.005}
+
+
+def _surface():
+    rng = np.random.default_rng(7)
+    band = (120. + np.cumsum(rng.normal(0, 0.05, (64, 64)), axis=1)).astype(np.float32)
+    band[:4, :4] = DSM_NODATA
+    return band
+
+
+class TestDSMEncoding(TestCase):
+    def test_round_trip(self):
+        band = _surface()
+        valid = band != DSM_NODATA
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for encoding in DSM_TILE_ENCODINGS:
+                filename = os.path.join(tmp_dir, f'{encoding}.tif')
+                writeDSMTile(filename, band, TRANSFORM, 'EPSG:3857', encoding=encoding)
+                with rasterio.open(filename) as dataset:
+                    heights = readDSMBand(dataset)
+                self.assertEqual(heights.dtype, np.float32, encoding)
+                np.testing.assert_array_equal(heights[~valid], DSM_NODATA)
+                self.assertLessEqual(
+                    float(np.abs(heights[valid] - band[valid]).max()), MAX_ERRORS[encoding] + 1e-4, encoding)
+
+    def test_unscaled_tile_path(self):
+        band = _surface()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            float_tile = os.path.join(tmp_dir, 'float.tif')
+            writeDSMTile(float_tile, band, TRANSFORM, 'EPSG:3857', encoding='zstd')
+            self.assertEqual(unscaledTilePath(float_tile), float_tile)
+
+            int_tile = os.path.join(tmp_dir, 'int16.tif')
+            writeDSMTile(int_tile, band, TRANSFORM, 'EPSG:3857', encoding='int16')
+            with rasterio.open(unscaledTilePath(int_tile)) as dataset:
+                self.assertEqual(dataset.dtypes[0], 'float32')
+                self.assertEqual(dataset.transform, TRANSFORM)
+                heights = dataset.read(1)
+            np.testing.assert_allclose(heights, band, atol=0.006)
+
+            float16_tile = os.path.join(tmp_dir, 'float16.tif')
+            writeDSMTile(float16_tile, band, TRANSFORM, 'EPSG:3857', encoding='float16')
+            with rasterio.open(unscaledTilePath(float16_tile)) as dataset:
+                self.assertEqual(dataset.nodata, DSM_NODATA)
+                heights = dataset.read(1)
+            np.testing.assert_array_equal(heights[band == DSM_NODATA], DSM_NODATA)
+            np.testing.assert_allclose(heights[band != DSM_NODATA], band[band != DSM_NODATA], atol=0.5)
+
+    def test_gdal_opts(self):
+        self.assertEqual(getTileGDALOpts('deflate'), 'COMPRESS=DEFLATE,ZLEVEL=9')
+        self.assertEqual(getTileGDALOpts('int16'), getTileGDALOpts('zstd'))
+        self.assertEqual(getTileGDALOpts('float16'), getTileGDALOpts('zstd'))
+
+    def test_gdal_opts_keep_nodata(self):
+        """
+        Tiles written like writers.gdal does, float32 with DSM_NODATA and the `gdalopts`, read back nodata
+        """
+        band = _surface()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for encoding in DSM_TILE_ENCODINGS:
+                filename = os.path.join(tmp_dir, f'{encoding}.tif')
+                options = dict(option.split('=') for option in getTileGDALOpts(encoding).split(','))
+                with rasterio.open(
+                    filename, 'w', driver='GTiff', width=band.shape[1], height=band.shape[0], count=1,
+                    dtype='float32', crs='EPSG:3857', transform=TRANSFORM, nodata=DSM_NODATA, **options
+                ) as dataset:
+                    dataset.write(band, 1)
+                with rasterio.open(unscaledTilePath(filename)) as dataset:
+                    heights = readDSMBand(dataset)
+                np.testing.assert_array_equal(heights[band == DSM_NODATA], DSM_NODATA, encoding)
+        with self.assertRaises(ValueError):
+            getTileGDALOpts('png')
@@ -0,0 +1,66 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+import os
+import tempfile
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from django.test import TestCase
+
+from mmwave.lidar_utils.SlippyTiles import getBoundaryofTile
+from mmwave.lidar_utils.dsm_overviews import (
+    DSM_NODATA, selectTileZoom, getParentTiles, getChildTiles, downsampleDSMTiles, tileResolution
+)
+
+
+def _writeTile(filename, x, y, z, value):
+    minx, miny, maxx, maxy = getBoundaryofTile(x, y, z).transform(3857, clone=True).extent
+    width, height = int(round(maxx - minx)), int(round(maxy - miny))
+    data = np.full((height, width), value, dtype=np.float32)
+    with rasterio.open(
+        filename, 'w', driver='GTiff', width=width, height=height, count=1, dtype='float32',
+        crs='EPSG:3857', transform=from_origin(minx, maxy, 1.0, 1.0), nodata=DSM_NODATA
+    ) as dataset:
+        dataset.write(data, 1)
+    return data
+
+
+class TestDSMOverviews(TestCase):
+    def test_select_tile_zoom(self):
+        self.assertEqual(selectTileZoom(None), 17)
+        self.assertEqual(selectTileZoom(0.5), 17)
+        self.assertEqual(selectTileZoom(1.0), 17)
+        self.assertEqual(selectTileZoom(3.0), 16)
+        self.assertEqual(selectTileZoom(4.0), 15)
+        self.assertEqual(selectTileZoom(1000.0), 12)
+        self.assertEqual(tileResolution(15), 4.0)
+
+    def test_parent_child_tiles(self):
+        self.assertEqual(getParentTiles([(10, 20), (11, 21), (12, 20)]), [(5, 10), (6, 10)])
+        self.assertEqual(sorted(getChildTiles(5, 10)), [(10, 20), (10, 21), (11, 20), (11, 21)])
+
+    def test_downsample_keeps_max(self):
+        x, y = 33534, 52357
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            children = []
+            for i, (cx, cy) in enumerate(getChildTiles(x, y)):
+                filename = os.path.join(tmp_dir, f'{cx}_{cy}.tif')
+                _writeTile(filename, cx, cy, 17, 10.0 * (i + 1))
+                children.append(filename)
+            # Missing child tile is nodata in the overview
+            output = os.path.join(tmp_dir, 'overview.tif')
+            self.assertTrue(downsampleDSMTiles(children[:3], 16, x, y, output, 'zstd'))
+            with rasterio.open(output) as dataset:
+                self.assertEqual(dataset.res, (2.0, 2.0))
+                band = dataset.read(1)
+            self.assertEqual(band.max(), 30.0)
+            self.assertTrue(np.any(band == DSM_NODATA))
+            self.assertTrue(np.all(np.isin(band, [10.0, 20.0, 30.0, DSM_NODATA])))
+
+    def test_downsample_empty(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'child.tif')
+            _writeTile(filename, 67068, 104714, 17, DSM_NODATA)
+            output = os.path.join(tmp_dir, 'overview.tif')
+            self.assertFalse(downsampleDSMTiles([filename], 16, 33534, 52357, output))
+            self.assertFalse(os.path.exists(output))
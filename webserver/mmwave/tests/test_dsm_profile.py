@@ -0,0 +1,27 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+from django.test import TestCase
+from mmwave.lidar_utils.dsm_profile import tileIndices, sampleRaster, SAMPLE_MAX, SAMPLE_BILINEAR
+from mmwave.lidar_utils.SlippyTiles import deg2num
+import numpy as np
+
+
+class TestDSMProfileSampling(TestCase):
+    def test_tile_indices_match_deg2num(self):
+        lons = np.array([-122.14946687221527, -75.5376148223877, -66.10818070326883])
+        lats = np.array([37.485011083264226, 39.16653673334675, 18.416250557878442])
+        xs, ys = tileIndices(lons, lats)
+        for x, y, lon, lat in zip(xs, ys, lons, lats):
+            self.assertEqual((x, y), deg2num(lat, lon))
+
+    def test_max_sampler(self):
+        band = np.arange(25.).reshape(5, 5)
+        band[2, 2] = np.nan
+        heights = sampleRaster(band, np.array([2.5, 0.2, 10.]), np.array([2.5, 0.2, 1.]), SAMPLE_MAX, 1)
+        self.assertEqual(heights[0], 18.)
+        self.assertEqual(heights[1], 6.)
+        self.assertTrue(np.isnan(heights[2]))
+
+    def test_bilinear_sampler(self):
+        band = np.arange(25.).reshape(5, 5)
+        heights = sampleRaster(band, np.array([1.0, 2.5]), np.array([1.0, 0.5]), SAMPLE_BILINEAR)
+        np.testing.assert_allclose(heights, [3., 2.])
@@ -0,0 +1,60 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+from django.test import TestCase
+from mmwave.benchmarks.local_s3 import LocalS3
+from mmwave.lidar_utils import dsm_tile_cache as cache_module
+from mmwave.lidar_utils.dsm_tile_cache import DSMTileCache
+from IspToolboxApp.util import s3
+import os
+import tempfile
+import time
+
+import unittest.mock as mock
+
+TEST_KEY = 'dsm/tiles/1-cloud/17/1/2.tif'
+
+
+class TestDSMTileCache(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = DSMTileCache(os.path.join(self.tmp_dir.name, 'cache'), 1024 ** 2)
+        self.local_s3 = LocalS3(os.path.join(self.tmp_dir.name, 's3'))
+        self.local_s3.__enter__()
+        s3.writeS3Object(TEST_KEY, b'tile')
+
+    def tearDown(self):
+        self.local_s3.__exit__(None, None, None)
+        self.tmp_dir.cleanup()
+
+    def read(self, name):
+        filename = os.path.join(self.tmp_dir.name, name)
+        self.cache.readMultiple([TEST_KEY, 'missing.tif'], [filename, filename + '.missing'])
+        self.assertFalse(os.path.exists(filename + '.missing'))
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def test_repeated_read_hits_cache(self):
+        self.assertEqual(self.read('a.tif'), b'tile')
+        self.assertEqual(self.read('b.tif'), b'tile')
+        stats = self.cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_stale_tile_is_downloaded_again(self):
+        self.read('a.tif')
+        s3.writeS3Object(TEST_KEY, b'rebuilt tile')
+        self.assertEqual(self.read('b.tif'), b'tile')
+        stale = time.time() - cache_module.REVALIDATE_INTERVAL_S - 1
+        os.utime(os.path.join(self.cache._entryDirectory(TEST_KEY, s3.bucket_name), 'etag'), (stale, stale))
+        self.assertEqual(self.read('c.tif'), b'rebuilt tile')
+        self.assertEqual(self.cache.stats()['revalidations'], 1)
+        # Files handed out before the tile was rebuilt are unchanged
+        with open(os.path.join(self.tmp_dir.name, 'a.tif'), 'rb') as f:
+            self.assertEqual(f.read(), b'tile')
+
+    def test_eviction(self):
+        self.read('a.tif')
+        self.cache.max_bytes = 0
+        with mock.patch('mmwave.lidar_utils.ept_cache.EVICTION_GRACE_PERIOD_S', 0):
+            self.cache._evict()
+        self.assertEqual(list(self.cache._evictableFiles()), [])
+        self.assertEqual(self.read('b.tif'), b'tile')
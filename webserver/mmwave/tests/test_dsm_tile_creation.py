@@ -1,6 +1,6 @@
 # (c) Meta Platforms, Inc. and affiliates. Copyright
 from django.test import TestCase
-from mmwave.scripts.create_dsm_for_ept import createTileDSM
+from mmwave.scripts.create_dsm_for_ept import createTileDSM, createBlockDSM, groupTilesIntoBlocks
 from mmwave.models import EPTLidarPointCloud, LidarDSMTileModel
 
 from django.contrib.gis.geos import GEOSGeometry
@@ -84,3 +84,32 @@ class TestLidarDSMTileCreation(TestCase):
                     pk=new_tiles[-1])
             self.assertTrue(new_tile.tile.name)
         self.assertTrue(len(new_tiles) > 0)
+
+    def test_block_tile_creation(self):
+        """
+        Test DSM Tile generation for a block of tiles with a single pdal read
+        """
+        polygon = GEOSGeometry(POLYGON_SUNFLOWER)
+        tiles = getTiles(polygon, DEFAULT_OUTPUT_ZOOM)
+        cloud = EPTLidarPointCloud(
+            name=SUNFLOWER_DATASET_NAME, count=1,
+            url=SUNFLOWER_DATASET_URL,
+            srs=3857,
+            boundary=polygon, noisy_data=False
+        )
+        cloud.save()
+        blocks = groupTilesIntoBlocks(tiles)
+        self.assertEqual(sorted(tile for block in blocks for tile in block), sorted(tiles))
+        created = sum(createBlockDSM(block, DEFAULT_OUTPUT_ZOOM, cloud.id) for block in blocks)
+        self.assertTrue(created > 0)
+        lidartiles = LidarDSMTileModel.objects.filter(cld=cloud, zoom=DEFAULT_OUTPUT_ZOOM)
+        self.assertEqual(lidartiles.count(), created)
+        for lidartile in lidartiles:
+            self.assertTrue(lidartile.tile.name)
+            self.assertTrue(cloud.existsTile(lidartile.x, lidartile.y, DEFAULT_OUTPUT_ZOOM))
+        # Tiles that already exist are not created again
+        self.assertEqual(sum(createBlockDSM(block, DEFAULT_OUTPUT_ZOOM, cloud.id) for block in blocks), 0)
+
+    def test_group_tiles_into_blocks(self):
+        blocks = groupTilesIntoBlocks([(15, 0), (16, 0), (17, 31), (0, 15)], block_size=16)
+        self.assertEqual(blocks, [[(0, 15), (15, 0)], [(16, 0)], [(17, 31)]])
@@ -0,0 +1,142 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+from unittest import mock
+
+import numpy as np
+
+from django.contrib.gis.geos import GEOSGeometry
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from mmwave.lidar_utils.DSMTileEngine import DSMTileEngine
+from mmwave.models import EPTLidarPointCloud, LidarDSMTileModel, DSMTilingJob
+from mmwave.scripts import create_dsm_for_ept
+from mmwave.tasks import lidar_tasks
+
+BLOCKS = [[(x, 0)] for x in range(6)]
+
+
+def _createCloud(name):
+    cloud = EPTLidarPointCloud(
+        name=name, count=1, url=f"https://isptoolbox.com/{name}/ept.json", srs=3857,
+        boundary=GEOSGeometry('POLYGON((-1 -1, 1 -1, 1 1, -1 1, -1 -1))', srid=4326)
+    )
+    cloud.save()
+    return cloud
+
+
+@override_settings(DSM_TILING_TARGET_BLOCKS_IN_FLIGHT=10)
+@mock.patch('mmwave.tasks.lidar_tasks.scheduleDSMTiling.apply_async')
+@mock.patch('mmwave.tasks.lidar_tasks.scheduleDSMTiling.delay')
+class TestDSMTilingScheduler(TestCase):
+    def setUp(self):
+        caches[lidar_tasks.DSM_TILING_CACHE_NAME].delete(lidar_tasks.DSM_TILING_LOCK_KEY)
+        caches[lidar_tasks.DSM_TILING_CACHE_NAME].delete(lidar_tasks.DSM_TILING_REQUEST_KEY)
+        self.tiled = _createCloud("tiled_2019")
+        LidarDSMTileModel(cld=self.tiled, x=1, y=1, zoom=17).save()
+        self.clouds = [_createCloud(f"untiled_{i}") for i in range(3)]
+
+    def test_queue_untiled_clouds(self, *args):
+        lidar_tasks.tile_untiled_datasets()
+        self.assertEqual(
+            set(DSMTilingJob.objects.values_list('cld_id', flat=True)), {cloud.pk for cloud in self.clouds}
+        )
+        # Queuing again does not duplicate jobs
+        lidar_tasks.tile_untiled_datasets()
+        self.assertEqual(DSMTilingJob.objects.count(), 3)
+
+    @mock.patch('mmwave.tasks.lidar_tasks.getDSMTilingBlocks', return_value=BLOCKS)
+    def test_schedule_by_demand_until_target(self, blocks, *args):
+        lidar_tasks.tile_untiled_datasets()
+        DSMTilingJob.recordDemand([self.clouds[2]])
+        with mock.patch('mmwave.tasks.lidar_tasks.dispatchDSMTilingBlocks') as dispatch:
+            self.assertEqual(lidar_tasks.scheduleDSMTiling(), 2)
+            # The second cloud only gets the blocks left under the target
+            self.assertEqual(
+                [(c.args[0].pk, c.args[1]) for c in dispatch.call_args_list],
+                [(self.clouds[2].pk, BLOCKS), (self.clouds[0].pk, BLOCKS[:4])]
+            )
+        self.assertEqual(lidar_tasks.getDSMTilingBlocksInFlight(), 10)
+
+        # Finished blocks make room for the rest of the running cloud, then the next cloud
+        for _ in range(3):
+            DSMTilingJob.recordBlock(self.clouds[2].pk, 256)
+        with mock.patch('mmwave.tasks.lidar_tasks.dispatchDSMTilingBlocks') as dispatch:
+            self.assertEqual(lidar_tasks.scheduleDSMTiling(), 1)
+            self.assertEqual(
+                [(c.args[0].pk, c.args[1]) for c in dispatch.call_args_list],
+                [(self.clouds[0].pk, BLOCKS[4:]), (self.clouds[1].pk, BLOCKS[:1])]
+            )
+        self.assertEqual(lidar_tasks.getDSMTilingBlocksInFlight(), 10)
+        job = DSMTilingJob.objects.get(cld=self.clouds[2])
+        self.assertEqual((job.status, job.blocks_done, job.tiles_created), (DSMTilingJob.Status.RUNNING, 3, 768))
+
+    def test_demand_is_rate_limited(self, *args):
+        lidar_tasks.tile_untiled_datasets()
+        DSMTilingJob.recordDemand([self.clouds[0]])
+        DSMTilingJob.recordDemand([self.clouds[0], self.clouds[1]])
+        # Reading the DSM tiles is not a request for the cloud
+        DSMTileEngine(self.clouds[2].boundary, [self.clouds[2]])
+        self.assertEqual(
+            [DSMTilingJob.objects.get(cld=cloud).demand for cloud in self.clouds], [1, 1, 0]
+        )
+
+    @mock.patch('mmwave.scripts.create_dsm_for_ept.createDSMOverviews.delay')
+    @mock.patch('mmwave.tasks.lidar_tasks.dispatchDSMTilingBlocks')
+    @mock.patch('mmwave.tasks.lidar_tasks.getDSMTilingBlocks', return_value=BLOCKS[:2])
+    def test_failed_block_settles_job(self, blocks, dispatch, overviews, *args):
+        lidar_tasks.tile_untiled_datasets()
+        lidar_tasks.scheduleDSMTiling()
+        cloud = self.clouds[0]
+        create_dsm_for_ept.finishBlock(cloud.pk, 5)
+        overviews.assert_not_called()
+        create_dsm_for_ept.finishBlock(cloud.pk, 0, failed=True)
+        overviews.assert_called_once_with(cloud.pk)
+        job = DSMTilingJob.objects.get(cld=cloud)
+        self.assertEqual((job.blocks_done, job.blocks_failed), (1, 1))
+        self.assertIsNotNone(job.finished)
+
+        no_tiles = np.array([], dtype=np.int64)
+        with mock.patch('mmwave.scripts.create_dsm_for_ept.dsm_tile_index.getTiles', return_value=no_tiles):
+            create_dsm_for_ept.createDSMOverviews(cloud.pk)
+        # The failed block is retried by the next discovery run
+        self.assertEqual(DSMTilingJob.objects.get(cld=cloud).status, DSMTilingJob.Status.FAILED)
+        lidar_tasks.tile_untiled_datasets()
+        self.assertEqual(DSMTilingJob.objects.get(cld=cloud).status, DSMTilingJob.Status.PENDING)
+
+    @mock.patch('mmwave.scripts.create_dsm_for_ept.s3.writeMultipleS3Objects', return_value=[])
+    def test_new_tiles_invalidate_overviews(self, write, *args):
+        """
+        Saving full resolution tiles clears the file of their overview tiles so they are rebuilt
+        """
+        cloud = self.clouds[0]
+        for x, y in [(0, 0), (1, 0)]:
+            LidarDSMTileModel(cld=cloud, x=x, y=y, zoom=16, tile=f'{x}-{y}.tif').save()
+        create_dsm_for_ept.saveDSMTiles(cloud, {(1, 1): 'block/1-1.tif'}, {}, 17)
+        overviews = {(t.x, t.y): t.tile.name for t in LidarDSMTileModel.objects.filter(cld=cloud, zoom=16)}
+        self.assertEqual(overviews, {(0, 0): '', (1, 0): '1-0.tif'})
+        self.assertTrue(LidarDSMTileModel.objects.filter(cld=cloud, zoom=17, x=1, y=1).exists())
+
+    @mock.patch('mmwave.scripts.create_dsm_for_ept.finishBlock')
+    @mock.patch('mmwave.scripts.create_dsm_for_ept.DSMEngine.getDSM', return_value=0)
+    def test_block_without_points_is_done(self, getDSM, finish, *args):
+        cloud = self.clouds[0]
+        self.assertEqual(create_dsm_for_ept.createBlockDSM([(2, 2), (2, 3)], 17, cloud.pk), 0)
+        self.assertTrue(getDSM.call_args.kwargs['fixed_extent'])
+        finish.assert_called_once_with(cloud.pk, 0)
+
+    @mock.patch('mmwave.scripts.create_dsm_for_ept.finishBlock')
+    @mock.patch('mmwave.scripts.create_dsm_for_ept.DSMEngine.getDSM', side_effect=OSError('No space left on device'))
+    def test_failed_block_is_not_done(self, getDSM, finish, *args):
+        cloud = self.clouds[0]
+        with self.assertRaises(OSError):
+            create_dsm_for_ept.createBlockDSM([(2, 2), (2, 3)], 17, cloud.pk)
+        finish.assert_called_once_with(cloud.pk, 0, failed=True)
+
+    def test_failed_dispatch(self, *args):
+        lidar_tasks.tile_untiled_datasets()
+        with mock.patch('mmwave.tasks.lidar_tasks.getDSMTilingBlocks', side_effect=Exception('boundary')):
+            lidar_tasks.scheduleDSMTiling()
+        self.assertEqual(DSMTilingJob.objects.filter(status=DSMTilingJob.Status.FAILED).count(), 3)
+        # Failed jobs are retried by the next discovery run
+        lidar_tasks.tile_untiled_datasets()
+        self.assertEqual(DSMTilingJob.objects.filter(status=DSMTilingJob.Status.PENDING).count(), 3)
@@ -0,0 +1,138 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from django.contrib.gis.geos import Point
+from django.test import TestCase
+
+from mmwave.lidar_utils.dsm_viewshed import computeViewshed, inSector, readViewshedDSM, sectorFootprint
+
+# Largest difference with gdal_viewshed in GROUND and DEM mode, float32 DSM heights
+GDAL_VIEWSHED_TOLERANCE_M = 1e-3
+
+
+def _surface(size=201, seed=3):
+    """
+    Rolling terrain with buildings on it
+    """
+    rng = np.random.default_rng(seed)
+    dsm = 50 + np.cumsum(rng.normal(0, 0.05, (size, size)), 0) + np.cumsum(rng.normal(0, 0.05, (size, size)), 1)
+    for _ in range(size * size // 300):
+        row, col = rng.integers(0, size, 2)
+        height, width = rng.integers(3, 12, 2)
+        dsm[row:row + height, col:col + width] += rng.uniform(3, 15)
+    return dsm.astype(np.float32)
+
+
+class TestDSMViewshed(TestCase):
+    def test_flat_ground(self):
+        dsm = np.zeros((101, 101), dtype=np.float32)
+        viewshed = computeViewshed(dsm, 50, 50, 10, max_distance=40, curvature_coeff=0, out_of_range_value=-1)
+        rows, cols = np.ogrid[:101, :101]
+        in_range = (rows - 50) ** 2 + (cols - 50) ** 2 <= 40 ** 2
+        np.testing.assert_allclose(viewshed[in_range], 0, atol=1e-9)
+        np.testing.assert_array_equal(viewshed[~in_range], -1)
+
+        normal = computeViewshed(dsm, 50, 50, 10, max_distance=40, mode='NORMAL', out_of_range_value=1)
+        self.assertEqual(normal.dtype, np.uint8)
+        np.testing.assert_array_equal(normal[in_range], 255)
+
+    def test_wall(self):
+        dsm = np.zeros((101, 101), dtype=np.float32)
+        # Wall 20m high, 10 rows north of the observer
+        dsm[40, :] = 20
+        viewshed = computeViewshed(dsm, 50, 50, 10, curvature_coeff=0)
+        # The line of sight over the top of the wall is 30m high 20 rows north of the observer
+        self.assertAlmostEqual(viewshed[30, 50], 30)
+        self.assertEqual(viewshed[40, 50], 0)
+        self.assertTrue(np.all(viewshed[:40] > 0))
+        self.assertTrue(np.all(viewshed[41:] == 0))
+
+        dem = computeViewshed(dsm, 50, 50, 10, curvature_coeff=0, mode='DEM')
+        self.assertAlmostEqual(dem[30, 50], 30)
+        normal = computeViewshed(dsm, 50, 50, 10, target_height=31, curvature_coeff=0, mode='NORMAL')
+        self.assertEqual(normal[30, 50], 255)
+        self.assertEqual(normal[20, 50], 0)
+
+    def test_curvature(self):
+        dsm = np.zeros((1, 2001), dtype=np.float32)
+        viewshed = computeViewshed(dsm, 0, 0, 2, resolution=(10., 10.), mode='DEM')
+        # The horizon of an observer 2m high is about 5km out
+        visible = viewshed[0] <= 1e-9
+        self.assertTrue(np.all(visible[:450]))
+        self.assertFalse(np.any(visible[600:]))
+
+    def test_sector(self):
+        dsm = _surface()
+        full = computeViewshed(dsm, 100, 100, 10, 2, max_distance=95, out_of_range_value=-1)
+        rows, cols = np.mgrid[:201, :201]
+        for heading, beamwidth in ((0, 90), (123, 30), (350, 60), (200, 300), (45, 1)):
+            viewshed = computeViewshed(
+                dsm, 100, 100, 10, 2, max_distance=95, heading=heading, beamwidth=beamwidth, out_of_range_value=-1)
+            in_sector = inSector(cols - 100, 100 - rows, heading, beamwidth)
+            in_sector[100, 100] = True
+            np.testing.assert_array_equal(viewshed[in_sector], full[in_sector])
+            np.testing.assert_array_equal(viewshed[~in_sector], -1)
+
+    def test_sector_footprint(self):
+        dsm = _surface()
+        rng = np.random.default_rng(5)
+        for heading, beamwidth in ((0, 90), (123, 30), (200, 300), (44.5, 1)):
+            expected = computeViewshed(
+                dsm, 100, 100, 10, 2, max_distance=95, heading=heading, beamwidth=beamwidth, out_of_range_value=-1)
+            # Pixel centers, y up, observer at (100.5, 100.5)
+            footprint = sectorFootprint(100.5, 100.5, heading, beamwidth, 95).prepared
+            outside = np.array([
+                [not footprint.contains(Point(col + 0.5, 200.5 - row)) for col in range(201)] for row in range(201)
+            ])
+            # Nothing outside of the footprint changes the sector
+            noisy = dsm.copy()
+            noisy[outside] = rng.uniform(0, 500, int(outside.sum()))
+            viewshed = computeViewshed(
+                noisy, 100, 100, 10, 2, max_distance=95, heading=heading, beamwidth=beamwidth, out_of_range_value=-1)
+            np.testing.assert_array_equal(viewshed, expected)
+            self.assertGreater(outside.sum(), 0)
+
+    def test_progress(self):
+        progress = []
+        computeViewshed(_surface(size=1001), 500, 500, 10, progress_callback=progress.append)
+        self.assertGreater(len(progress), 2)
+        self.assertEqual(progress, sorted(progress))
+        self.assertEqual(progress[-1], 1.0)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            computeViewshed(np.zeros((3, 3)), 1, 1, 10, mode='VISIBLE')
+
+    @unittest.skipIf(shutil.which('gdal_viewshed') is None, 'gdal_viewshed is not installed')
+    def test_matches_gdal_viewshed(self):
+        dsm = _surface()
+        x, y, max_distance = 100.5, 100.5, 90
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dsm_filepath = os.path.join(tmp_dir, 'dsm.tif')
+            with rasterio.open(
+                dsm_filepath, 'w', driver='GTiff', width=201, height=201, count=1, dtype='float32',
+                crs='EPSG:3857', transform=from_origin(0, 201, 1, 1)
+            ) as dataset:
+                dataset.write(dsm, 1)
+            heights, row, col, transform, _ = readViewshedDSM(dsm_filepath, x, y, max_distance)
+            rows, cols = np.ogrid[:heights.shape[0], :heights.shape[1]]
+            in_range = (rows - row) ** 2 + (cols - col) ** 2 <= max_distance ** 2
+            for mode in ('GROUND', 'DEM', 'NORMAL'):
+                output_filepath = os.path.join(tmp_dir, f'{mode}.tif')
+                subprocess.check_output([
+                    'gdal_viewshed', '-b', '1', '-oz', '10', '-tz', '2', '-md', str(max_distance),
+                    '-ox', str(x), '-oy', str(y), '-om', mode, dsm_filepath, output_filepath
+                ])
+                with rasterio.open(output_filepath) as dataset:
+                    self.assertEqual(dataset.transform, transform)
+                    expected = dataset.read(1)
+                viewshed = computeViewshed(heights, row, col, 10, 2, max_distance=max_distance, mode=mode)
+                np.testing.assert_allclose(
+                    viewshed[in_range], expected[in_range], atol=GDAL_VIEWSHED_TOLERANCE_M, err_msg=mode)
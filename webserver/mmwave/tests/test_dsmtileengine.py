@@ -1,10 +1,14 @@
 # (c) Meta Platforms, Inc. and affiliates. Copyright
 from django.test import TestCase
-from django.contrib.gis.geos import GEOSGeometry
+from django.contrib.gis.geos import GEOSGeometry, Point, Polygon
 from mmwave.lidar_utils.DSMTileEngine import DSMTileEngine
+from mmwave.lidar_utils.SlippyTiles import getTiles
+from mmwave.lidar_utils.dsm_overviews import getParentTiles
+from mmwave.lidar_utils.tile_index import packTiles
 from mmwave.models import EPTLidarPointCloud
 import tempfile
 import os
+import unittest.mock as mock
 
 polygon = GEOSGeometry("""
         {
@@ -56,3 +60,41 @@ class TestDsmTileEngine(TestCase):
             self.assertTrue(os.path.getsize(tmp_tif.name) > 0)
             created_dsm = True
         self.assertTrue(created_dsm)
+
+    def test_tile_zoom_checks_overview_coverage(self):
+        """
+        Overview tiles are only used when they cover every full resolution tile of the polygon
+        """
+        area = Polygon.from_bbox((-122.16, 37.48, -122.14, 37.49))
+        area.srid = 4326
+        tiles = getTiles(area, 17)
+        parents = getParentTiles(tiles)
+        index = {17: tiles, 16: parents[1:]}
+
+        def getIndexTiles(cloud, z):
+            return packTiles([x for x, _ in index[z]], [y for _, y in index[z]])
+
+        dsm_engine = DSMTileEngine(area, [self.test_cloud], resolution=2.0)
+        with mock.patch('mmwave.lidar_utils.DSMTileEngine.dsm_tile_index.getTiles', side_effect=getIndexTiles):
+            self.assertEqual(dsm_engine.tileZoom(), 17)
+            index[16] = parents
+            self.assertEqual(dsm_engine.tileZoom(), 16)
+            # Tiles missing at full resolution need no overview
+            index[17] = [(x, y) for x, y in tiles if (x // 2, y // 2) != parents[0]]
+            index[16] = parents[1:]
+            self.assertEqual(dsm_engine.tileZoom(), 16)
+
+    def test_surface_heights(self):
+        dsm_engine = DSMTileEngine(polygon, [self.test_cloud])
+        points = [
+            Point(-122.14940, 37.48510, srid=4326),
+            Point(-122.14925, 37.48520, srid=4326),
+            Point(-100.0, 40.0, srid=4326),
+        ]
+        heights = dsm_engine.getSurfaceHeights(points)
+        self.assertEqual(len(heights), len(points))
+        for point, height in zip(points, heights):
+            self.assertAlmostEqual(dsm_engine.getSurfaceHeight(point), height)
+        # No tile outside of the point cloud
+        self.assertEqual(heights[2], 0)
+        self.assertEqual(len(dsm_engine.getSurfaceHeights([])), 0)
@@ -0,0 +1,60 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+from django.test import TestCase
+from mmwave.lidar_utils.ept_cache import EPTChunkCache
+import json
+import os
+import tempfile
+
+import unittest.mock as mock
+
+TEST_EPT_URL = 'https://isptoolbox.com/test_cloud/ept.json'
+TEST_EPT_FILES = {
+    'ept.json': {'bounds': [0, 0, 0, 1024, 1024, 1024], 'span': 128, 'dataType': 'laszip'},
+    'ept-hierarchy/0-0-0-0.json': {'0-0-0-0': 5, '1-0-0-0': 3, '1-1-1-0': -1},
+    'ept-hierarchy/1-1-1-0.json': {'1-1-1-0': 4, '2-2-2-0': 1, '2-3-3-0': 1},
+}
+
+
+def _fake_download(url):
+    path = url.replace('https://isptoolbox.com/test_cloud/', '')
+    if path in TEST_EPT_FILES:
+        return json.dumps(TEST_EPT_FILES[path]).encode()
+    return b'laz'
+
+
+class TestEPTChunkCache(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = EPTChunkCache(self.tmp_dir.name, 1024 ** 2)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_fetches_only_overlapping_chunks(self):
+        """
+        Only nodes overlapping the query bounds above the resolution depth are downloaded
+        """
+        with mock.patch.object(self.cache, '_download', side_effect=_fake_download):
+            path = self.cache.getLocalEPT(TEST_EPT_URL, (600, 600, 700, 700), 1)
+        chunks = sorted(os.listdir(os.path.join(os.path.dirname(path), 'ept-data')))
+        self.assertEqual(chunks, ['0-0-0-0.laz', '1-1-1-0.laz', '2-2-2-0.laz'])
+
+    def test_repeated_query_hits_cache(self):
+        """
+        A repeated query in the same area should not download anything
+        """
+        with mock.patch.object(self.cache, '_download', side_effect=_fake_download) as download:
+            self.cache.getLocalEPT(TEST_EPT_URL, (600, 600, 700, 700), 1)
+            num_downloads = download.call_count
+            self.cache.getLocalEPT(TEST_EPT_URL, (600, 600, 700, 700), 1)
+            self.assertEqual(download.call_count, num_downloads)
+        self.assertTrue(self.cache.stats()['hits'] > 0)
+
+    def test_depth_begin_skips_levels_already_read(self):
+        """
+        Refining a query only returns the chunks of the deeper octree levels
+        """
+        with mock.patch.object(self.cache, '_download', side_effect=_fake_download):
+            paths, depth_end = self.cache.getLocalChunks(TEST_EPT_URL, (600, 600, 700, 700), 1, depth_begin=2)
+        self.assertEqual(depth_end, 4)
+        self.assertEqual([os.path.basename(p) for p in paths], ['2-2-2-0.laz'])
@@ -0,0 +1,64 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+import json
+import subprocess
+from unittest import mock
+
+from django.contrib.gis.gdal import SpatialReference
+from django.contrib.gis.geos import GEOSGeometry
+from django.test import TestCase
+
+from mmwave.models import EPTLidarPointCloud
+from mmwave.scripts.create_higher_resolution_boundaries import (
+    computeHighResolutionBoundaries, getCloudsWithoutHighResolutionBoundary, reportHighResolutionBoundaries
+)
+
+PDAL_INFO = json.dumps({
+    'metadata': {'srs': {'wkt': SpatialReference(4326).wkt}},
+    'boundary': {'boundary': 'POLYGON((0 0, 0.5 0, 0.5 0.5, 0 0.5, 0 0))'},
+})
+
+
+def _pdalInfo(command, **kwargs):
+    if 'slow_2019' in command[-1]:
+        raise subprocess.TimeoutExpired(command, kwargs.get('timeout'))
+    if 'broken_2019' in command[-1]:
+        return subprocess.CompletedProcess(command, 1, stdout=b'')
+    return subprocess.CompletedProcess(command, 0, stdout=PDAL_INFO.encode())
+
+
+class TestHighResolutionBoundaries(TestCase):
+    def setUp(self):
+        self.clouds = {}
+        for name in ['fast_2019', 'slow_2019', 'broken_2019', 'done_2019']:
+            cloud = EPTLidarPointCloud(
+                name=name, count=1, url=f"https://isptoolbox.com/{name}/ept.json", srs=3857,
+                boundary=GEOSGeometry('POLYGON((-1 -1, 1 -1, 1 1, -1 1, -1 -1))', srid=4326)
+            )
+            if name == 'done_2019':
+                cloud.high_resolution_boundary = cloud.boundary
+            cloud.save()
+            self.clouds[name] = cloud
+
+    @mock.patch('mmwave.scripts.create_higher_resolution_boundaries.subprocess.run', side_effect=_pdalInfo)
+    def test_chunk_report(self, run):
+        self.assertEqual(
+            getCloudsWithoutHighResolutionBoundary(),
+            sorted(self.clouds[name].pk for name in ['fast_2019', 'slow_2019', 'broken_2019'])
+        )
+        report = computeHighResolutionBoundaries([cloud.pk for cloud in self.clouds.values()])
+        self.assertEqual(report['succeeded'], ['fast_2019'])
+        self.assertEqual(report['skipped'], ['done_2019'])
+        self.assertEqual(sorted(failure.split(' ')[0] for failure in report['failed']), ['broken_2019', 'slow_2019'])
+        self.assertTrue(all(call.kwargs['timeout'] > 0 for call in run.call_args_list))
+
+        # Rerunning the chunk resumes with the clouds that still have no boundary
+        report = computeHighResolutionBoundaries([cloud.pk for cloud in self.clouds.values()])
+        self.assertEqual(sorted(report['skipped']), ['done_2019', 'fast_2019'])
+
+    def test_consolidated_report(self):
+        successes, failures = reportHighResolutionBoundaries([
+            {'succeeded': ['a'], 'failed': ['b timed out'], 'skipped': []},
+            {'succeeded': ['c'], 'failed': [], 'skipped': ['d']},
+        ])
+        self.assertEqual(successes, ['a', 'c'])
+        self.assertEqual(failures, ['b timed out'])
@@ -3,14 +3,19 @@ from django.test import TestCase, TransactionTestCase, Client
 from mmwave.tasks import getElevationProfile
 from mmwave.tasks.link_tasks import MAXIMUM_NUM_POINTS_RETURNED
 from mmwave.lidar_utils.pdal_templates import (
-    getLidarPointsAroundLink, takeMaxHeightAtDistance
+    getLidarPointsAroundLink, takeMaxHeightAtDistance, projectPointsOntoLink,
+    assignPointsToLinks
 )
-from mmwave.lidar_utils.LidarEngine import LidarEngine
+from mmwave.lidar_utils.LidarEngine import LidarEngine, LidarResolution, LIDAR_RESOLUTION_DEFAULTS
+from mmwave.lidar_utils.BatchLidarEngine import BatchLidarEngine
 from mmwave.lidar_utils.DSMEngine import DSMEngine
+from mmwave.lidar_utils.pdal_service import PDALTimeoutException
+import json
 import tempfile
 import os
 from django.contrib.gis.geos import Point, LineString, GEOSGeometry
-from mmwave.models import EPTLidarPointCloud
+from mmwave.models import EPTLidarPointCloud, USGSLidarMetaDataModel
+from datetime import datetime
 
 import unittest.mock as mock
 
@@ -70,6 +75,78 @@ class TestDSMExport(TestCase):
         self.assertTrue(created_dsm)
 
 
+def _fake_rasterize(pipeline_json, timeout=None, **kwargs):
+    stages = json.loads(pipeline_json)['pipeline']
+    if 'broken' in stages[0]['filename']:
+        raise PDALTimeoutException('pdal pipeline timed out')
+    writer = [stage for stage in stages if stage.get('type') == 'writers.gdal'][0]
+    with open(writer['filename'], 'wb') as f:
+        f.write(b'tif')
+    return [], 1
+
+
+def _fake_point_query(pipeline_json, timeout=None):
+    """
+    Stands in for PDAL: the points of a 1m lattice inside each crop polygon, one view per polygon
+    """
+    import numpy as np
+
+    stages = json.loads(pipeline_json)['pipeline']
+    crop = [stage for stage in stages if stage.get('type') == 'filters.crop'][0]
+    arrays = []
+    for wkt in crop['polygon']:
+        polygon = GEOSGeometry(wkt)
+        prepared = polygon.prepared
+        xmin, ymin, xmax, ymax = polygon.extent
+        xs, ys = np.meshgrid(np.arange(np.floor(xmin), np.ceil(xmax)), np.arange(np.floor(ymin), np.ceil(ymax)))
+        inside = [prepared.contains(Point(x, y)) for x, y in zip(xs.ravel(), ys.ravel())]
+        arr = np.zeros(sum(inside), dtype=[('X', np.float64), ('Y', np.float64), ('Z', np.float64)])
+        arr['X'], arr['Y'] = xs.ravel()[inside], ys.ravel()[inside]
+        arr['Z'] = 10 + 3 * np.sin(arr['X'] / 7) + 2 * np.cos(arr['Y'] / 5)
+        arrays.append(arr)
+    return arrays, sum(arr.shape[0] for arr in arrays)
+
+
+class TestDSMExportClouds(TestCase):
+    def setUp(self):
+        self.polygon = GEOSGeometry('POLYGON((-90.54 33.54, -90.53 33.54, -90.53 33.55, -90.54 33.55, -90.54 33.54))')
+        self.polygon.srid = 4326
+        self.clouds = [
+            EPTLidarPointCloud(name=name, count=1, url=f'https://isptoolbox.com/{name}/ept.json', srs=3857)
+            for name in ('cloud_2010', 'broken_2012', 'cloud_2015')
+        ]
+
+    @mock.patch('mmwave.lidar_utils.DSMEngine.celery_task_subprocess_check_output_wrapper')
+    @mock.patch('mmwave.lidar_utils.DSMEngine.pdal_service.execute', side_effect=_fake_rasterize)
+    @mock.patch('mmwave.lidar_utils.DSMEngine.getCachedEPTPath', side_effect=lambda url, *args: url)
+    def test_failed_cloud_is_left_out(self, cached_path, execute, subprocess):
+        with tempfile.NamedTemporaryFile(suffix='.tif') as temp:
+            DSMEngine(self.polygon, self.clouds).getDSM(1.0, temp.name)
+        self.assertEqual(execute.call_count, 3)
+        buildvrt = subprocess.call_args_list[0][0][0]
+        self.assertEqual(buildvrt[0], 'gdalbuildvrt')
+        # Merged in cloud order without the cloud that failed
+        self.assertEqual([os.path.basename(f) for f in buildvrt[2:]], ['0.tif', '2.tif'])
+
+    @mock.patch('mmwave.lidar_utils.DSMEngine.pdal_service.execute', side_effect=_fake_rasterize)
+    @mock.patch('mmwave.lidar_utils.DSMEngine.getCachedEPTPath', side_effect=lambda url, *args: url)
+    def test_fixed_extent(self, cached_path, execute):
+        with tempfile.NamedTemporaryFile(suffix='.tif') as temp:
+            points = DSMEngine(self.polygon, self.clouds[:1]).getDSM(1.0, temp.name, fixed_extent=True)
+        self.assertEqual(points, 1)
+        writer = json.loads(execute.call_args[0][0])['pipeline'][-1]
+        xmin, ymin, xmax, ymax = self.polygon.transform(3857, clone=True).extent
+        self.assertEqual(writer['bounds'], str(([xmin, xmax], [ymin, ymax])))
+
+    @mock.patch('mmwave.lidar_utils.DSMEngine.pdal_service.execute', side_effect=_fake_rasterize)
+    @mock.patch('mmwave.lidar_utils.DSMEngine.getCachedEPTPath', side_effect=lambda url, *args: url)
+    def test_all_clouds_failed(self, cached_path, execute):
+        with tempfile.NamedTemporaryFile(suffix='.tif') as temp:
+            with self.assertRaises(Exception) as context:
+                DSMEngine(self.polygon, self.clouds[1:2]).getDSM(1.0, temp.name)
+        self.assertIn('broken_2012', str(context.exception))
+
+
 class SimplePageLoadTest(TestCase):
     def test_los_check_simple(self):
         """
@@ -159,6 +236,37 @@ class LiDARTestCase(TransactionTestCase):
 
         self.assertTrue(link.dims > 0)
 
+    @mock.patch('mmwave.lidar_utils.pdal_templates.pdal_service.execute', side_effect=_fake_point_query)
+    @mock.patch('mmwave.lidar_utils.pdal_templates.getCachedEPTPath', side_effect=lambda url, *args: url)
+    def test_batch_profiles(self, cached_path, execute):
+        """
+        BatchLidarEngine reads the point cloud once and matches a LidarEngine per link
+        """
+        import numpy as np
+
+        cloud = EPTLidarPointCloud(
+            name="cloud1", count=1,
+            url="https://isptoolbox.com/ptcloud_2019.json",
+            srs=3857,
+            boundary=GEOSGeometry(LiDARTestCase.geojson1)
+        )
+        cloud.save()
+        # Sector and its CPEs, every link starts at the tower
+        tower = LiDARTestCase.pt1
+        links = [
+            LineString([tower, (tower[0] + dx, tower[1] + dy)])
+            for dx, dy in ((4e-4, 0), (0, 4e-4), (-3e-4, 3e-4), (2e-4, -4e-4))
+        ]
+        resolution = LIDAR_RESOLUTION_DEFAULTS[LidarResolution.HIGH]
+        with mock.patch.object(EPTLidarPointCloud, 'query_intersect_aoi', return_value=[cloud]):
+            profiles = BatchLidarEngine([link.clone() for link in links], resolution, 64).getProfiles()
+            self.assertEqual(execute.call_count, 1)
+            expected = [LidarEngine(link.clone(), resolution, 64).getProfile() for link in links]
+        self.assertEqual(execute.call_count, 1 + len(links))
+        self.assertEqual(len(profiles), len(links))
+        for profile, expected_profile in zip(profiles, expected):
+            np.testing.assert_allclose(profile, expected_profile)
+
     def test_dedup_lidar_profile(self):
         """
         Check that lidar profile deduplication works as intended
@@ -170,6 +278,31 @@ class LiDARTestCase(TransactionTestCase):
         self.assertEqual(len(h), 3)
         self.assertEqual(h[1], 10)
 
+    def test_vectorized_link_projection(self):
+        """
+        Check that vectorized projection matches GEOS project_normalized
+        """
+        link = LineString([(0, 0), (300, 400)])
+        xs = [-50, 0, 150, 300, 400, 100]
+        ys = [-50, 0, 200, 400, 600, 0]
+        distances, offsets = projectPointsOntoLink(xs, ys, link, 1000)
+        for x, y, dst in zip(xs, ys, distances):
+            self.assertAlmostEqual(link.project_normalized(Point(x, y)) * 1000, dst)
+        self.assertAlmostEqual(offsets[2], 0)
+        self.assertAlmostEqual(abs(offsets[5]), 80)
+
+    def test_assign_points_to_links(self):
+        """
+        Points are assigned to every link corridor they fall in
+        """
+        links = [LineString([(0, 0), (100, 0)]), LineString([(0, 0), (0, 100)])]
+        xs = [0, 50, 2, 50, 103, 200]
+        ys = [0, 2, 50, 50, 0, 200]
+        assignment = assignPointsToLinks(xs, ys, links, 3, chunk_size=4)
+        self.assertEqual(assignment.shape, (2, 6))
+        self.assertEqual(assignment[0].tolist(), [True, True, False, False, True, False])
+        self.assertEqual(assignment[1].tolist(), [True, False, True, False, False, False])
+
 
 class ElevationProfileTestCase(TestCase):
 
@@ -265,3 +398,17 @@ class LidarEngineTestCase(TestCase):
             'IA_FullState',
             'IA_FullState'
         )
+
+    def test_collection_start_date_lookup(self):
+        cloud = EPTLidarPointCloud(
+            name="TX_Central_B1_2017", count=1, url="https://isptoolbox.com/TX_Central_B1_2017/ept.json", srs=3857,
+            boundary=GEOSGeometry('POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))', srid=4326)
+        )
+        self.assertEqual(cloud.collection_start_date, datetime.min)
+        USGSLidarMetaDataModel(
+            workunit="TX_Central_B1_2017", collect_start="2017-01-15", collect_end="2017-03-01",
+            ql="QL 2", spec="USGS Lidar Base Specification 1.2", p_method="linear mode", horiz_crs="6344",
+            vert_crs="5703", lpc_category="Meets", lpc_reason="", opr_category="Meets", opr_reason="",
+            onemeter_category="Meets"
+        ).save()
+        self.assertEqual(cloud.collection_start_date, datetime(2017, 1, 15))
@@ -0,0 +1,40 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+from django.test import TestCase
+from mmwave.lidar_utils.caching import encode_lidar_response, decode_lidar_response
+from mmwave.lidar_utils.LidarEngine import LidarResolution
+import pickle
+
+
+class TestLidarCacheCodec(TestCase):
+    def setUp(self):
+        self.resp = {
+            'lidar_profile': [float(i) / 3. for i in range(1024)],
+            'url': ['https://s3-us-west-2.amazonaws.com/usgs-lidar-public/MS_MSDeltaYazoo-Phase1_2009/ept.json'],
+            'bb': (-10072453.5, 3968373.2, -10071854.8, 3968795.0, 30.5, 52.25),
+            'source': ['MS_MSDeltaYazoo-Phase1 (Collected 2009)'],
+            'tx': (-10072453.5, 3968373.2),
+            'rx': (-10071854.8, 3968795.0),
+            'aoi': [0, 1],
+            'resolution': LidarResolution.HIGH,
+            'res': 1,
+            'dist': 735.3,
+            'error': None,
+        }
+
+    def test_round_trip(self):
+        decoded = decode_lidar_response(encode_lidar_response(self.resp))
+        self.assertEqual(len(decoded['lidar_profile']), 1024)
+        for original, cached in zip(self.resp['lidar_profile'], decoded['lidar_profile']):
+            self.assertAlmostEqual(original, cached, places=4)
+        self.assertEqual(decoded['source'], self.resp['source'])
+        self.assertEqual(decoded['bb'], list(self.resp['bb']))
+        self.assertEqual(decoded['resolution'], LidarResolution.HIGH)
+        self.assertIsNone(decoded['error'])
+
+    def test_smaller_than_pickle(self):
+        self.assertLess(len(encode_lidar_response(self.resp)), len(pickle.dumps(self.resp)) / 2)
+
+    def test_unknown_format_is_a_miss(self):
+        encoded = encode_lidar_response(self.resp)
+        self.assertIsNone(decode_lidar_response(bytes([encoded[0] + 1]) + encoded[1:]))
+        self.assertIsNone(decode_lidar_response(self.resp))
@@ -0,0 +1,63 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+from django.test import TestCase
+from mmwave.lidar_utils.pdal_service import (
+    PDALExecutionService, PDALScratchDirectory, PDALTimeoutException, getPipelineTemplate, getFilterSet
+)
+import json
+import os
+import threading
+
+import unittest.mock as mock
+
+
+class TestPDALExecutionService(TestCase):
+    def test_pipeline_template(self):
+        template = getPipelineTemplate('readers.ept', getFilterSet(True))
+        self.assertIs(template, getPipelineTemplate('readers.ept', ('outlier',)))
+        pipeline = json.loads(template.render(
+            {'filename': 'ept.json', 'resolution': 1}, [{'type': 'filters.crop', 'polygon': 'POLYGON EMPTY'}]
+        ))['pipeline']
+        self.assertEqual(
+            [stage['type'] for stage in pipeline],
+            ['readers.ept', 'filters.outlier', 'filters.range', 'filters.crop']
+        )
+        self.assertEqual(pipeline[0]['filename'], 'ept.json')
+
+    def test_timeout(self):
+        service = PDALExecutionService(1, 1, 0.1)
+        release = threading.Event()
+        with mock.patch.object(service, '_run', side_effect=lambda *args: release.wait(5)):
+            with self.assertRaises(PDALTimeoutException):
+                service.execute('{}')
+            release.set()
+
+    def test_scratch_outlives_timed_out_pipeline(self):
+        service = PDALExecutionService(1, 1, 0.1)
+        release = threading.Event()
+        done = threading.Event()
+
+        def run(pipeline_json, arrays):
+            release.wait(5)
+            # The abandoned pipeline still writes its output
+            with open(os.path.join(scratch.name, 'dsm.tif'), 'wb') as f:
+                f.write(b'tif')
+            return [], 1
+
+        scratch = PDALScratchDirectory()
+        with mock.patch.object(service, '_run', side_effect=run):
+            with scratch:
+                with self.assertRaises(PDALTimeoutException):
+                    service.execute('{}', arrays=False, scratch=scratch)
+            self.assertTrue(os.path.isdir(scratch.name))
+            service._getExecutor().submit(done.set)
+            release.set()
+            done.wait(5)
+        self.assertFalse(os.path.exists(scratch.name))
+
+    def test_arrays_on_request(self):
+        service = PDALExecutionService(1, 1, 5)
+        pipeline = mock.Mock(arrays=['points'])
+        pipeline.execute.return_value = 3
+        with mock.patch.dict('sys.modules', pdal=mock.Mock(Pipeline=mock.Mock(return_value=pipeline))):
+            self.assertEqual(service.execute('{}'), (['points'], 3))
+            self.assertEqual(service.execute('{}', arrays=False), ([], 3))
@@ -0,0 +1,161 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+from django.contrib.gis.geos import LineString
+from django.test import TestCase
+from mmwave.lidar_utils.ept_cache import EPTChunkCache
+from mmwave.lidar_utils.LidarEngine import LidarResolution, LIDAR_RESOLUTION_DEFAULTS
+from mmwave.lidar_utils import progressive_lidar
+from mmwave.lidar_utils.progressive_lidar import ProgressivePointStore, queryLidarPointsIncremental
+import json
+import numpy as np
+import os
+import tempfile
+import unittest
+import unittest.mock as mock
+
+try:
+    import pdal
+except ImportError:
+    pdal = None
+
+TEST_EPT_URL = 'https://isptoolbox.com/test_cloud/ept.json'
+# Octree nodes are written down to this depth where they overlap the test area
+TEST_EPT_DEPTH = 6
+TEST_EPT_AREA = (80, 80, 160, 160)
+TEST_EPT_INFO = {
+    'version': '1.0.0',
+    'bounds': [0, 0, 0, 256, 256, 256],
+    'boundsConforming': [0, 0, 0, 256, 256, 8],
+    'span': 16,
+    'dataType': 'binary',
+    'hierarchyType': 'json',
+    'srs': {},
+    'schema': [
+        {'name': 'X', 'type': 'signed', 'size': 4, 'scale': 0.01, 'offset': 0},
+        {'name': 'Y', 'type': 'signed', 'size': 4, 'scale': 0.01, 'offset': 0},
+        {'name': 'Z', 'type': 'signed', 'size': 4, 'scale': 0.01, 'offset': 0},
+        {'name': 'Intensity', 'type': 'unsigned', 'size': 2},
+    ],
+}
+
+
+def _writeTestEPT(directory):
+    """
+    Writes a binary EPT dataset with 10 random points in each node overlapping TEST_EPT_AREA
+    """
+    rng = np.random.default_rng(0)
+    dtype = np.dtype([('X', '<i4'), ('Y', '<i4'), ('Z', '<i4'), ('Intensity', '<u2')])
+    os.makedirs(os.path.join(directory, 'ept-data'))
+    os.makedirs(os.path.join(directory, 'ept-hierarchy'))
+    hierarchy = {}
+    for d in range(TEST_EPT_DEPTH):
+        size = 256 / 2 ** d
+        first = [int(TEST_EPT_AREA[i] // size) for i in (0, 1)]
+        last = [int(TEST_EPT_AREA[i + 2] // size) for i in (0, 1)]
+        for x in range(first[0], min(last[0], 2 ** d - 1) + 1):
+            for y in range(first[1], min(last[1], 2 ** d - 1) + 1):
+                records = np.zeros(10, dtype=dtype)
+                records['X'] = rng.uniform(x * size, (x + 1) * size, 10) * 100
+                records['Y'] = rng.uniform(y * size, (y + 1) * size, 10) * 100
+                records['Z'] = rng.uniform(0, 8, 10) * 100
+                records['Intensity'] = rng.integers(0, 1000, 10)
+                key = f'{d}-{x}-{y}-0'
+                records.tofile(os.path.join(directory, 'ept-data', f'{key}.bin'))
+                hierarchy[key] = 10
+    info = dict(TEST_EPT_INFO, points=sum(hierarchy.values()))
+    for name, content in (('ept.json', info), ('ept-hierarchy/0-0-0-0.json', hierarchy)):
+        with open(os.path.join(directory, name), 'w') as f:
+            json.dump(content, f)
+
+
+def _sortedRows(points):
+    points = np.asarray(points)
+    return points[np.lexsort(points.T[::-1])]
+
+
+class TestProgressivePointStore(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = ProgressivePointStore(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_load_missing_segment(self):
+        points, depth_end = self.store.load('missing')
+        self.assertIsNone(points)
+        self.assertEqual(depth_end, 0)
+
+    def test_deeper_levels_supersede_shallower(self):
+        """
+        Saving points read down to a deeper octree level replaces the shallower scratch file
+        """
+        self.store.save('segment', np.ones((2, 3)), 3)
+        self.store.save('segment', np.ones((5, 3)), 6)
+        points, depth_end = self.store.load('segment')
+        self.assertEqual(depth_end, 6)
+        self.assertEqual(points.shape, (5, 3))
+
+
+class TestIncrementalQuery(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.source_dir = os.path.join(self.tmp_dir.name, 'source')
+        _writeTestEPT(self.source_dir)
+        self.polygon = LineString((100, 110), (140, 130)).buffer(6)
+        cache = EPTChunkCache(os.path.join(self.tmp_dir.name, 'cache'), 1024 ** 3)
+
+        def download(url):
+            with open(url.replace('https://isptoolbox.com/test_cloud', self.source_dir), 'rb') as f:
+                return f.read()
+
+        self.patches = [
+            mock.patch.object(cache, '_download', side_effect=download),
+            mock.patch.object(progressive_lidar, 'ept_chunk_cache', cache),
+            mock.patch.object(
+                progressive_lidar, 'progressive_point_store',
+                ProgressivePointStore(os.path.join(self.tmp_dir.name, 'progressive'))
+            ),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.tmp_dir.cleanup()
+
+    def _refine(self, resolutions):
+        for resolution in resolutions:
+            x, y, z = queryLidarPointsIncremental(TEST_EPT_URL, self.polygon, LIDAR_RESOLUTION_DEFAULTS[resolution])
+        return _sortedRows(np.column_stack([x, y, z]))
+
+    def test_refinement_matches_single_query(self):
+        """
+        Points merged LOW -> ULTRA equal the points of an ULTRA query on an empty scratch store
+        """
+        refined = self._refine(list(LidarResolution))
+        self.assertGreater(len(refined), 0)
+        empty_store = ProgressivePointStore(os.path.join(self.tmp_dir.name, 'empty'))
+        with mock.patch.object(progressive_lidar, 'progressive_point_store', empty_store):
+            np.testing.assert_array_equal(refined, self._refine([LidarResolution.ULTRA]))
+
+    @unittest.skipUnless(pdal, 'pdal is not installed')
+    def test_refinement_matches_readers_ept(self):
+        """
+        Points merged LOW -> ULTRA equal the points of a single readers.ept ULTRA query
+        """
+        refined = self._refine(list(LidarResolution))
+        xmin, ymin, xmax, ymax = self.polygon.extent
+        pipeline = pdal.Pipeline(json.dumps({'pipeline': [
+            {
+                'type': 'readers.ept',
+                'filename': os.path.join(self.source_dir, 'ept.json'),
+                'resolution': LIDAR_RESOLUTION_DEFAULTS[LidarResolution.ULTRA],
+                'bounds': str(([xmin, xmax], [ymin, ymax])),
+            },
+            {'type': 'filters.crop', 'polygon': self.polygon.wkt},
+        ]}))
+        pipeline.execute()
+        arr = pipeline.arrays[0]
+        expected = _sortedRows(np.column_stack([arr['X'], arr['Y'], arr['Z']]))
+        np.testing.assert_allclose(refined, expected)
@@ -0,0 +1,59 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.contrib.gis.geos import GEOSGeometry
+from mmwave.lidar_utils.tile_index import dsm_tile_index, packTiles
+from mmwave.models import EPTLidarPointCloud, LidarDSMTileModel
+import unittest.mock as mock
+
+
+@override_settings(PROD=True)
+class TestDSMTileIndex(TestCase):
+    def setUp(self):
+        dsm_tile_index.invalidate()
+        self.cloud = EPTLidarPointCloud(
+            name="tiles_2019", count=1, url="https://isptoolbox.com/tiles_2019/ept.json", srs=3857,
+            boundary=GEOSGeometry('POLYGON((-1 -1, 1 -1, 1 1, -1 1, -1 -1))', srid=4326)
+        )
+        self.cloud.save()
+        for x, y in [(30000, 50000), (30001, 50000), (30000, 50002)]:
+            LidarDSMTileModel(cld=self.cloud, x=x, y=y, zoom=17).save()
+
+    def tearDown(self):
+        dsm_tile_index.invalidate()
+
+    def test_exists_matches_database(self):
+        for x, y in [(30000, 50000), (30001, 50000), (30000, 50002), (30001, 50002), (50000, 30000)]:
+            self.assertEqual(self.cloud.existsTile(x, y, 17), self.cloud.existsTileUncached(x, y, 17))
+        self.assertFalse(self.cloud.existsTile(30000, 50000, 16))
+
+    def test_add_tile(self):
+        self.assertFalse(self.cloud.existsTile(30002, 50000, 17))
+        LidarDSMTileModel(cld=self.cloud, x=30002, y=50000, zoom=17).save()
+        dsm_tile_index.addTile(self.cloud, 30002, 50000, 17)
+        self.assertTrue(self.cloud.existsTile(30002, 50000, 17))
+
+    def test_delete_tiles(self):
+        """
+        Deleting tiles, one by one or in bulk, reloads the cloud's index
+        """
+        self.assertTrue(self.cloud.existsTile(30000, 50000, 17))
+        with mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func()):
+            LidarDSMTileModel.objects.get(cld=self.cloud, x=30000, y=50000, zoom=17).delete()
+            self.assertFalse(self.cloud.existsTile(30000, 50000, 17))
+            self.assertTrue(self.cloud.existsTile(30001, 50000, 17))
+            LidarDSMTileModel.objects.filter(cld=self.cloud).delete()
+        self.assertFalse(self.cloud.existsTile(30001, 50000, 17))
+        self.assertFalse(self.cloud.existsTile(30000, 50002, 17))
+
+    def test_bulk_delete_bumps_version_once(self):
+        with mock.patch('mmwave.lidar_utils.tile_index.bumpTileIndexVersion') as bump:
+            start = len(connection.run_on_commit)
+            LidarDSMTileModel.objects.filter(cld=self.cloud).delete()
+            callbacks = [entry[1] for entry in connection.run_on_commit[start:]]
+            self.assertEqual(len(callbacks), 1)
+            callbacks[0]()
+        bump.assert_called_once_with(self.cloud.pk)
+
+    def test_pack_tiles(self):
+        self.assertEqual(list(packTiles([2, 1, 1], [0, 5, 5])), [(1 << 32) | 5, 2 << 32])
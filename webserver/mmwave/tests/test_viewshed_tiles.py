@@ -0,0 +1,50 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+import io
+
+import numpy as np
+from PIL import Image
+from rasterio.transform import from_origin
+from django.test import TestCase
+
+from mmwave.lidar_utils.viewshed_tiles import iterTiles, tileBounds, tilesCovering
+
+# Corner of a zoom 17 tile, 1m pixels
+LEFT, TOP = tileBounds(17, 33500, 52000)[0], tileBounds(17, 33500, 52000)[3]
+TRANSFORM = from_origin(LEFT - 100, TOP + 100, 1., 1.)
+
+
+class TestViewshedTiles(TestCase):
+    def test_tiles_covering(self):
+        self.assertEqual(tilesCovering(tileBounds(17, 33500, 52000), 17), [(33500, 52000)])
+        self.assertEqual(tilesCovering(tileBounds(17, 33500, 52000), 16), [(16750, 26000)])
+        left, bottom, right, top = tileBounds(17, 33500, 52000)
+        self.assertEqual(len(tilesCovering((left - 1, bottom, right + 1, top), 17)), 3)
+
+    def test_empty_tiles_are_skipped(self):
+        alpha = np.zeros((400, 400), dtype=np.uint8)
+        self.assertEqual(list(iterTiles(alpha, TRANSFORM, 12, 17)), [])
+
+        # Obstructed 40m square in the corner of tile (33500, 52000)
+        alpha[100:140, 100:140] = 128
+        tiles = list(iterTiles(alpha, TRANSFORM, 12, 17, tilesize=256, workers=2))
+        self.assertEqual([tile.zoom for tile in tiles], list(range(12, 18)))
+        tile = tiles[-1]
+        self.assertEqual((tile.x, tile.y), (33500, 52000))
+        image = np.asarray(Image.open(io.BytesIO(tile.png)))
+        self.assertEqual(image.shape, (256, 256, 4))
+        left, _, right, _ = tileBounds(17, 33500, 52000)
+        inside = (np.arange(256) + 0.5) * (right - left) / 256 < 40
+        np.testing.assert_array_equal(image[..., 3], np.where(np.outer(inside, inside), 128, 0))
+        np.testing.assert_array_equal(image[..., :3], 0)
+
+    def test_rgba(self):
+        rgba = np.zeros((400, 400, 4), dtype=np.uint8)
+        rgba[150:250, 150:250] = (255, 0, 0, 200)
+        alpha_tile, = iterTiles(rgba[..., 3], TRANSFORM, 17, 17, color=(255, 0, 0))
+        rgba_tile, = iterTiles(rgba, TRANSFORM, 17, 17)
+        alpha_image = np.asarray(Image.open(io.BytesIO(alpha_tile.png)))
+        rgba_image = np.asarray(Image.open(io.BytesIO(rgba_tile.png)))
+        opaque = rgba_image[..., 3] > 0
+        self.assertTrue(opaque.any())
+        np.testing.assert_array_equal(alpha_image[..., 3], rgba_image[..., 3])
+        np.testing.assert_array_equal(alpha_image[opaque], rgba_image[opaque])
@@ -519,6 +519,49 @@ CACHES = {
     },
 }
 
+# Host-local caches shared by all celery workers on the same machine
+LIDAR_CACHE_DIRECTORY = os.environ.get(
+    "LIDAR_CACHE_DIRECTORY", "/tmp/isptoolbox-lidar-cache"
+)
+EPT_CHUNK_CACHE_MAX_BYTES = int(
+    os.environ.get("EPT_CHUNK_CACHE_MAX_BYTES", 20 * 1024 ** 3)
+)
+DSM_TILE_CACHE_MAX_BYTES = int(
+    os.environ.get("DSM_TILE_CACHE_MAX_BYTES", 10 * 1024 ** 3)
+)
+
+# Encoding of new DSM tiles, see mmwave.lidar_utils.dsm_encoding. Existing tiles are read whatever their encoding
+DSM_TILE_ENCODING = os.environ.get("DSM_TILE_ENCODING", "zstd")
+# Largest height error (meters) of the lerc encoding and height step of the int16 encoding
+DSM_TILE_MAX_Z_ERROR = float(os.environ.get("DSM_TILE_MAX_Z_ERROR", 0.01))
+DSM_TILE_INT16_SCALE = float(os.environ.get("DSM_TILE_INT16_SCALE", 0.01))
+
+# Point cloud boundaries are served from an in-memory index, reloaded when the shared version stamp changes
+LIDAR_BOUNDARY_INDEX_ENABLED = (
+    os.environ.get("LIDAR_BOUNDARY_INDEX_ENABLED", "true").lower() == "true"
+)
+LIDAR_BOUNDARY_INDEX_CHECK_INTERVAL_S = float(
+    os.environ.get("LIDAR_BOUNDARY_INDEX_CHECK_INTERVAL_S", 30)
+)
+
+# DSM tile existence is served from a per point cloud index, reloaded when the cloud's version stamp changes
+DSM_TILE_INDEX_CHECK_INTERVAL_S = float(
+    os.environ.get("DSM_TILE_INDEX_CHECK_INTERVAL_S", 30)
+)
+
+# Untiled point clouds are tiled with at most this many blocks queued or running on the dsm workers
+DSM_TILING_TARGET_BLOCKS_IN_FLIGHT = int(
+    os.environ.get("DSM_TILING_TARGET_BLOCKS_IN_FLIGHT", 64)
+)
+# Tiling jobs without progress for this long are marked failed and retried up to DSM_TILING_MAX_ATTEMPTS times
+DSM_TILING_STALE_S = float(os.environ.get("DSM_TILING_STALE_S", 6 * 60 * 60))
+DSM_TILING_MAX_ATTEMPTS = int(os.environ.get("DSM_TILING_MAX_ATTEMPTS", 3))
+
+# PDAL pipelines run on a pool of threads inside each celery worker process
+PDAL_POOL_WORKERS = int(os.environ.get("PDAL_POOL_WORKERS", 4))
+PDAL_POOL_MAX_PENDING = int(os.environ.get("PDAL_POOL_MAX_PENDING", 16))
+PDAL_PIPELINE_TIMEOUT_S = float(os.environ.get("PDAL_PIPELINE_TIMEOUT_S", 120))
+
 # FB admin SAML SSO, dev only for now
 if PROD:
     SAML_DJANGO_USER_MAIN_ATTRIBUTE = "email"
@@ -4,6 +4,7 @@ from .task_models import (
     AbstractAsyncTaskAPIModel
 )
 from rest_framework import serializers
+from celery_async import celery_app as app
 import redis
 import json
 import time
@@ -17,6 +18,7 @@ class PointToPointServiceability(
     EXPIRE_TIME_RESULTS = 3600 * 24 * 7 * 30
 
     task_name = "workspace.tasks.ptp_tasks.calculate_serviceability"
+    batch_task_name = "workspace.tasks.ptp_tasks.calculate_serviceability_batch"
 
     @classmethod
     def get_rest_queryset(cls, request):
@@ -65,10 +67,48 @@ class PointToPointServiceability(
         r = redis.Redis.from_url(settings.CELERY_BROKER_URL)
         r.set(self.key_elevation_profile(), val, ex=int(time.time() + self.EXPIRE_TIME_RESULTS))
 
-    def calculate_serviceability(self):
+    @classmethod
+    def start_batch_task(cls, serviceabilities):
+        """
+        Start a single task for many links, see `calculate_serviceability_batch`
+        """
+        logging.info(f"starting task: {cls.batch_task_name}")
+        app.send_task(cls.batch_task_name, ([s.uuid for s in serviceabilities],))
+
+    @classmethod
+    def calculate_serviceability_batch(cls, serviceabilities):
+        """
+        Calculate the serviceability of many links, the LiDAR profiles of all the links are read in one batch
+
+        Links that fail are recorded as UNKNOWN and the rest of the batch carries on
+        """
+        ptps = [s.ptp for s in serviceabilities]
+        lidar_profiles = ptps[0].calculate_lidar_batch(ptps) if ptps else []
+        for serviceability, lidar in zip(serviceabilities, lidar_profiles):
+            try:
+                if lidar is None:
+                    raise Exception(f"LiDAR data not available for link {serviceability.ptp.pk}")
+                serviceability.calculate_serviceability(lidar=lidar)
+            except Exception:
+                logging.exception(f"failed to calculate serviceability {serviceability.uuid}")
+                serviceability.set_serviceability_unknown()
+
+    def set_serviceability_unknown(self):
+        """
+        Record that the serviceability of the link could not be calculated
+        """
+        try:
+            redis.Redis.from_url(settings.CELERY_BROKER_URL).delete(self.key_elevation_profile())
+        except Exception:
+            logging.exception("failed to clear gis data")
+        self.serviceable = PointToPointServiceability.Serviceability.UNKNOWN
+        self.number_of_obstructions = None
+        self.save()
+
+    def calculate_serviceability(self, lidar=None):
         try:
             # Start By Computing GIS Data
-            gis_data = self.ptp.gis_data()
+            gis_data = self.ptp.gis_data(lidar=lidar)
             self.gis_data = json.dumps(gis_data.__dict__)
             # Calculate Obstructions
             self.number_of_obstructions = self.ptp.calculate_obstructions(gis_data)
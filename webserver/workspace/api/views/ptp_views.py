@@ -4,6 +4,7 @@ from .task_api_views import (
     TaskAPICreateView, TaskAPIRetrieveDeleteView, TaskAPIStopView
 )
 from rest_framework.schemas.openapi import AutoSchema
+from rest_framework.serializers import ListSerializer
 
 
 class PointToPointServiceabilityRetrieveDeleteView(
@@ -17,10 +18,24 @@ class PointToPointServiceabilityRetrieveDeleteView(
 class PointToPointServiceabilityCreateView(
     TaskAPICreateView
 ):
+    """
+    Also accepts a list of links, their serviceability is calculated by a single task
+    """
     serializer_class = workspace_models.PointToPointLinkServiceableSerializer
     tags = ['Point To Point']
     schema = AutoSchema(tags=tags)
 
+    def get_serializer(self, *args, **kwargs):
+        if isinstance(kwargs.get('data'), list):
+            kwargs['many'] = True
+        return super().get_serializer(*args, **kwargs)
+
+    def perform_create(self, serializer):
+        if not isinstance(serializer, ListSerializer):
+            return super().perform_create(serializer)
+        tasks = serializer.save(owner=self.request.user)
+        workspace_models.PointToPointServiceability.start_batch_task(tasks)
+
 
 class PointToPointServiceabilityStopView(
     TaskAPIStopView
@@ -7,7 +7,7 @@ from django.core.exceptions import FieldDoesNotExist
 from django.db import models
 from django.conf import settings
 from django.contrib.gis.db import models as geo_models
-from django.contrib.gis.geos import GEOSGeometry, LineString, Polygon
+from django.contrib.gis.geos import GEOSGeometry, LineString, MultiPoint, Polygon
 from django.contrib.sessions.models import Session
 from django.core.validators import (
     MaxLengthValidator,
@@ -50,6 +50,7 @@ from .model_constants import (
     SPEED_OF_LIGHT
 )
 from mmwave.lidar_utils.LidarEngine import LidarEngine, LidarResolution, LIDAR_RESOLUTION_DEFAULTS
+from mmwave.lidar_utils.BatchLidarEngine import BatchLidarEngine
 
 from mmwave.tasks.link_tasks import getDTMPoint, getElevationProfile
 from mmwave.models import EPTLidarPointCloud
@@ -817,6 +818,9 @@ class CPELocation(UnitPreferencesModelMixin, WorkspaceFeature):
         return FeatureType.CPE.value
 
     def get_dsm_height(self) -> float:
+        dsm = getattr(self, "_dsm_height", None)
+        if dsm is not None:
+            return dsm
         point = self.geojson
         tile_engine = DSMTileEngine(
             point, EPTLidarPointCloud.query_intersect_aoi(point)
@@ -824,6 +828,21 @@ class CPELocation(UnitPreferencesModelMixin, WorkspaceFeature):
         dsm = tile_engine.getSurfaceHeight(point)
         return dsm
 
+    @staticmethod
+    def prefetch_dsm_heights(cpes) -> None:
+        """
+        Look up the DSM height of many CPEs with one grouped read of the DSM tiles,
+        call before saving new CPEs so `_modify_height` does not read them one by one.
+        """
+        cpes = list(cpes)
+        if len(cpes) == 0:
+            return
+        points = [cpe.geojson for cpe in cpes]
+        aoi = MultiPoint(*points, srid=points[0].srid)
+        tile_engine = DSMTileEngine(aoi, EPTLidarPointCloud.query_intersect_aoi(aoi))
+        for cpe, dsm in zip(cpes, tile_engine.getSurfaceHeights(points)):
+            cpe._dsm_height = float(dsm)
+
     def get_dtm_height(self) -> float:
         return getDTMPoint(self.geojson)
 
@@ -1080,9 +1099,12 @@ class PointToPointLink(UnitPreferencesModelMixin, WorkspaceFeature):
                 'elevation': self.elevation
             })
 
-    def gis_data(self):
+    def gis_data(self, lidar: List[float] = None):
+        """
+        lidar - LiDAR profile of the link if it was already computed, see `calculate_lidar_batch`
+        """
         return PointToPointLink.PointToPointGisData(
-            self.calculate_lidar(),
+            self.calculate_lidar() if lidar is None else lidar,
             self.calculate_fresnel(),
             self.calculate_elevation(),
             self.calculate_profile(),
@@ -1103,6 +1125,19 @@ class PointToPointLink(UnitPreferencesModelMixin, WorkspaceFeature):
         )
         return le.getProfile()
 
+    @staticmethod
+    def calculate_lidar_batch(links):
+        """
+        LiDAR profiles of many links, the point clouds are read once for all the links
+
+        Returns a profile per link, None where no LiDAR data is available
+        """
+        return BatchLidarEngine(
+            [link.geojson.clone() for link in links],
+            LIDAR_RESOLUTION_DEFAULTS[LidarResolution.HIGH],
+            PointToPointLink.DEFAULT_NUMBER_SAMPLES,
+        ).getProfiles()
+
     def calculate_obstructions(self, gis_data: PointToPointGisData):
         """
         Determine Locations of Obstructions along link
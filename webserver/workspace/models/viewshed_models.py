@@ -1,11 +1,15 @@
 # (c) Meta Platforms, Inc. and affiliates. Copyright
 from celery.utils.log import get_task_logger
-from django.db import models
+from django.db import models, transaction
 from django.contrib.gis.geos import Point
 from django.conf import settings
 from storages.backends.s3boto3 import S3Boto3Storage
-from IspToolboxApp.util.s3 import S3PublicExportMixin, writeMultipleS3Objects
-from django.db.models.signals import post_delete, post_save, pre_delete
+from IspToolboxApp.util.s3 import (
+    S3PublicExportMixin,
+    deleteMultipleS3Objects,
+    streamS3Objects,
+)
+from django.db.models.signals import post_save, pre_delete
 from django.dispatch import receiver
 from workspace.models.network_models import AccessPointLocation, AccessPointSector
 from workspace.models.task_models import (
@@ -14,15 +18,20 @@ from workspace.models.task_models import (
     AbstractAsyncTaskPrimaryKeyMixin,
 )
 from workspace.utils.geojson_circle import destination
-from mmwave.models import EPTLidarPointCloud, TileModel
+from mmwave.models import DSMTilingJob, EPTLidarPointCloud, TileModel
 from mmwave.lidar_utils.DSMTileEngine import DSMTileEngine
+from mmwave.lidar_utils.dsm_viewshed import (
+    computeViewshed,
+    readViewshedDSM,
+    sectorFootprint,
+    writeViewshed,
+)
+from mmwave.lidar_utils.viewshed_tiles import iterTiles
 from mmwave.tasks.link_tasks import getDTMPoint
 import jwt
 import datetime
 import math
 import tempfile
-import shlex
-import subprocess
 import rasterio
 import PIL
 from PIL import Image
@@ -31,19 +40,21 @@ import json
 from rasterio import mask
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 import time
-import os
-import re
 from numpy import polyfit, polyval
 from django.core.validators import MaxValueValidator, MinValueValidator
 
-from workspace.utils.process_utils import celery_task_subprocess_check_output_wrapper
-
 
 CURRENT_VIEWSHED_VERSION = 1
 DEFAULT_PROJECTION = 3857
 DEFAULT_OBSTRUCTED_COLOR = [0, 0, 0, 128]
 PIL.Image.MAX_IMAGE_PIXELS = 20_000 * 20_000
 TASK_LOGGER = get_task_logger(__name__)
+# Line of sight progress is reported in steps of this fraction of the rows
+VIEWSHED_PROGRESS_STEP = 0.1
+# Sectors compute this many degrees more on each side than the crop to the sector polygon
+VIEWSHED_SECTOR_MARGIN_DEG = 1.0
+# Uploaded tiles are recorded in the database in batches of this size
+VIEWSHED_TILE_BATCH_SIZE = 500
 
 
 class Viewshed(
@@ -175,17 +186,21 @@ class Viewshed(
         Compute Viewshed of Access Point
         """
         # Delete all tiles from previous calculations
-        aoi = self.radio.getDSMExtentRequired()
+        aoi = self.__dsmExtent()
         TASK_LOGGER.info("starting dsm download")
-        dsm_engine = DSMTileEngine(aoi, EPTLidarPointCloud.query_intersect_aoi(aoi))
-        with tempfile.NamedTemporaryFile(mode="w+b", suffix=".tif") as dsm_file:
+        clouds = EPTLidarPointCloud.query_intersect_aoi(aoi)
+        # Untiled clouds that users ask for are tiled first
+        DSMTilingJob.recordDemand(clouds)
+        dsm_engine = DSMTileEngine(aoi, clouds, clip_tiles=True)
+        with tempfile.TemporaryDirectory() as dsm_dir:
             start = time.time()
             if status_callback is not None:
                 status_callback(
                     "Loading coverage data...", self.__timeRemainingViewshed(0)
                 )
             try:
-                dsm_engine.getDSM(dsm_file.name)
+                # The viewshed reads the virtual mosaic, the tiles are not merged into a new file
+                dsm_filepath = dsm_engine.buildVRT(dsm_dir)
                 TASK_LOGGER.info("dsm download complete")
             except Exception:
                 TASK_LOGGER.exception("dsm download failed")
@@ -199,7 +214,7 @@ class Viewshed(
             try:
                 TASK_LOGGER.info("starting viewshed computation")
                 self.__renderViewshed(
-                    dsm_file=dsm_file, status_callback=status_callback
+                    dsm_filepath=dsm_filepath, status_callback=status_callback
                 )
                 TASK_LOGGER.info("successfully completed viewshed computation")
             except Exception:
@@ -229,31 +244,83 @@ class Viewshed(
             )
         return time_remaining
 
-    def __createRawGDALViewshedCommand(
-        self, dsm_filepath, output_filepath, dsm_projection
-    ):
+    def __sectorBeamwidth(self):
+        """
+        Beamwidth of the line of sight computation, None for access points
         """
-        Generate shell commmand to run gdal_viewshed: requires gdal-bin > 3.1.0
+        if self.ap is None and self.sector is not None:
+            return min(self.sector.azimuth + 2 * VIEWSHED_SECTOR_MARGIN_DEG, 360.0)
+        return None
 
-        documentation: https://gdal.org/programs/gdal_viewshed.html
+    def __dsmExtent(self):
         """
-        transformed_observer = self.radio.observer.transform(dsm_projection, clone=True)
-        transformed_height = self.translate_dtm_height_to_dsm_height()
-        output_value = 1
-        if self.mode != Viewshed.CoverageStatus.NORMAL:
-            output_value = -1
-        return f"""gdal_viewshed -b 1 -ov {output_value}
-            -oz {transformed_height} -tz {self.radio.default_cpe_height} -md {self.__calculateRadiusViewshed()}
-            -ox {transformed_observer.x} -oy {transformed_observer.y} -om {self.mode}
-            {dsm_filepath} {output_filepath}
+        DSM needed by the viewshed, sectors only need their wedge and the cells its lines of sight
+        are interpolated from
+        """
+        beamwidth = self.__sectorBeamwidth()
+        if beamwidth is None:
+            return self.radio.getDSMExtentRequired()
+        observer = self.radio.observer.transform(DEFAULT_PROJECTION, clone=True)
+        footprint = sectorFootprint(
+            observer.x,
+            observer.y,
+            self.sector.heading,
+            beamwidth,
+            self.__calculateRadiusViewshed(),
+        )
+        footprint.srid = DEFAULT_PROJECTION
+        return footprint.transform(4326, clone=True)
+
+    def __computeLineOfSight(self, dsm_filepath, output_filepath, status_callback=None):
+        """
+        Compute the viewshed in process, same output as gdal_viewshed with the options:
+
+        -oz {dsm height} -tz {default_cpe_height} -md {radius} -om {mode} -ov {1 or -1}
+
+        Sectors only compute the wedge around their heading, the rest is out of range
         """
+        observer = self.radio.observer.transform(DEFAULT_PROJECTION, clone=True)
+        max_distance = self.__calculateRadiusViewshed()
+        dsm, row, col, transform, crs = readViewshedDSM(
+            dsm_filepath, observer.x, observer.y, max_distance
+        )
+        beamwidth = self.__sectorBeamwidth()
+        out_of_range_value = 1
+        if self.mode != Viewshed.CoverageStatus.NORMAL:
+            out_of_range_value = -1
+        viewshed = computeViewshed(
+            dsm,
+            row,
+            col,
+            self.translate_dtm_height_to_dsm_height(),
+            self.radio.default_cpe_height,
+            resolution=(transform.a, transform.e),
+            max_distance=max_distance,
+            mode=self.mode,
+            heading=self.sector.heading if beamwidth is not None else None,
+            beamwidth=beamwidth,
+            out_of_range_value=out_of_range_value,
+            progress_callback=self.__lineOfSightProgressCallback(status_callback),
+        )
+        writeViewshed(output_filepath, viewshed, transform, crs)
 
-    def __createGdal2TileCommand(
-        self, viewshed_filepath, output_folderpath, processes=8, tilesize=512
-    ):
-        return f"""gdal2tiles.py --zoom={self.min_zoom}-{self.max_zoom} --tilesize={tilesize}
-            --webviewer=none --no-kml --resampling=near --exclude --processes={processes}
-            {viewshed_filepath} {output_folderpath}"""
+    def __lineOfSightProgressCallback(self, status_callback):
+        if status_callback is None:
+            return None
+        remaining_after = self.__timeRemainingViewshed(2)
+        line_of_sight = self.__timeRemainingViewshed(1) - remaining_after
+        reported = [0.0]
+
+        def progress_callback(fraction):
+            if fraction < 1.0 and fraction - reported[0] < VIEWSHED_PROGRESS_STEP:
+                return
+            reported[0] = fraction
+            status_callback(
+                f"Computing line of sight... {int(fraction * 100)}%",
+                remaining_after + line_of_sight * (1 - fraction),
+            )
+
+        return progress_callback
 
     def __calculateRadiusViewshed(self) -> float:
         # Calculate how far viewshed should extend
@@ -266,14 +333,12 @@ class Viewshed(
             (src.x - res.x) * (src.x - res.x) + (src.y - res.y) * (src.y - res.y)
         )
 
-    def __renderViewshed(self, dsm_file, status_callback=None):
+    def __renderViewshed(self, dsm_filepath, status_callback=None):
         with tempfile.NamedTemporaryFile(suffix=".tif") as output_temp:
             start = time.time()
-            raw_command = self.__createRawGDALViewshedCommand(
-                dsm_file.name, output_temp.name, DEFAULT_PROJECTION
+            self.__computeLineOfSight(
+                dsm_filepath, output_temp.name, status_callback=status_callback
             )
-            filtered_command = shlex.split(raw_command)
-            celery_task_subprocess_check_output_wrapper(filtered_command)
 
             TASK_LOGGER.info(f"compute viewshed: {time.time() - start}")
             start_tiling = time.time()
@@ -285,76 +350,82 @@ class Viewshed(
 
             self.__cropSector(output_temp)
 
-            with tempfile.NamedTemporaryFile(suffix=".tif") as colorized_temp:
-                self.__colorizeOutputViewshed(output_temp, colorized_temp)
-                TASK_LOGGER.info(f"colorizing: {time.time() - start_tiling}")
-                start = time.time()
-                self.__reprojectViewshed(output_temp)
-                TASK_LOGGER.info(f"reproject: {time.time() - start}")
-                start = time.time()
-                self.__createTileset(colorized_temp, status_callback=status_callback)
-                TASK_LOGGER.info(f"tileset: {time.time() - start}")
-            TASK_LOGGER.info(f"tiling: {time.time() - start_tiling}")
-
-    def __createTileset(self, tif_tempfile, status_callback=None):
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            if status_callback is not None:
-                status_callback("Tiling...", self.__timeRemainingViewshed(3))
-            TASK_LOGGER.info(f"tiling started")
+            alpha, transform = self.__colorizeOutputViewshed(output_temp)
+            TASK_LOGGER.info(f"colorizing: {time.time() - start_tiling}")
             start = time.time()
-            self.__convert2Tiles(tif_tempfile.name, tmp_dir)
-            TASK_LOGGER.info(f"finished tiling: {time.time() - start}")
-            size = 0
-            if status_callback is not None:
-                status_callback("Loading results...", self.__timeRemainingViewshed(4))
+            self.__reprojectViewshed(output_temp)
+            TASK_LOGGER.info(f"reproject: {time.time() - start}")
             start = time.time()
-            paths = []
-            keys = []
-            # Find all Tile Images
-            for subdir, _, files in os.walk(tmp_dir):
-                for file in files:
-                    if file.endswith(".png"):
-                        path = os.path.join(subdir, file)
-                        regexpath = path.replace(tmp_dir, "")
-                        z, y, x = re.findall("[0-9]+", regexpath)
-                        tile = ViewshedTile(viewshed=self, zoom=z, y=y, x=x)
-                        size += os.path.getsize(path)
-                        tile.save()
-                        paths.append(path)
-                        keys.append(tile.upload_to_path(""))
-            TASK_LOGGER.info(
-                f"number of tiles: {len(paths)} tiles | size of tiles: {size}B"
-            )
-            # Perform Bulk Upload of Tiles to S3 - performed in parallel is much faster
-            writeMultipleS3Objects(keys, paths, ViewshedTile.bucket_name)
-            TASK_LOGGER.info(f"finished uploading: {time.time() - start}")
+            self.__createTileset(alpha, transform, status_callback=status_callback)
+            TASK_LOGGER.info(f"tileset: {time.time() - start}")
+            TASK_LOGGER.info(f"tiling: {time.time() - start_tiling}")
 
-    def __colorizeOutputViewshed(
-        self, tif_viewshed_tempfile, output_colorized_tempfile
-    ):
+    def __createTileset(self, alpha, transform, status_callback=None):
+        if status_callback is not None:
+            status_callback("Tiling...", self.__timeRemainingViewshed(3))
+        TASK_LOGGER.info(f"tiling started")
+        start = time.time()
+        # Tiles waiting for their upload, by s3 key
+        uploading = {}
+        size = 0
+
+        def rendered_tiles():
+            nonlocal size
+            # Tiles without any obstructed pixel are not rendered
+            for tile in iterTiles(alpha, transform, self.min_zoom, self.max_zoom):
+                # Same keys as gdal2tiles, {zoom}/{tms y}/{x}.png: the tileset url is
+                # {z}/{y}/{x} with the tms scheme so the tile's x field is the tms y
+                tms_y = 2 ** tile.zoom - 1 - tile.y
+                viewshed_tile = ViewshedTile(
+                    viewshed=self, zoom=tile.zoom, y=tile.x, x=tms_y
+                )
+                key = viewshed_tile.upload_to_path("")
+                uploading[key] = viewshed_tile
+                size += len(tile.png)
+                yield key, tile.png
+
+        # Tiles are uploaded while the next ones render, the rows are only written for the
+        # uploads that completed
+        uploaded = []
+        keys = set()
+        failed = 0
+        for key, success in streamS3Objects(rendered_tiles(), ViewshedTile.bucket_name):
+            viewshed_tile = uploading.pop(key)
+            if not success:
+                failed += 1
+                continue
+            uploaded.append(viewshed_tile)
+            keys.add(key)
+
+        # The rows of the tileset are replaced in one short transaction
+        with transaction.atomic():
+            stale = self.__deleteTileRecords()
+            for i in range(0, len(uploaded), VIEWSHED_TILE_BATCH_SIZE):
+                ViewshedTile.objects.bulk_create(uploaded[i:i + VIEWSHED_TILE_BATCH_SIZE])
+            # New tiles overwrote the objects of the same keys
+            self.__deleteTileObjects(stale.difference(keys))
+        TASK_LOGGER.info(
+            f"number of tiles: {len(keys)} tiles | size of tiles: {size}B | failed uploads: {failed}"
+        )
+        TASK_LOGGER.info(f"finished tiling and uploading: {time.time() - start}")
+
+    def __colorizeOutputViewshed(self, tif_viewshed_tempfile):
+        """
+        Returns the alpha band of the viewshed tiles and its transform, obstructed cells are
+        half transparent black and the others fully transparent
+        """
         with rasterio.open(tif_viewshed_tempfile.name) as src:
-            if self.mode == Viewshed.CoverageStatus.NORMAL:
-                meta = src.meta.copy()
-                meta.update({"count": 4})
-                with rasterio.open(output_colorized_tempfile.name, "w", **meta) as dst:
-                    layer = src.read(1)
-                    for i in range(1, 5):
-                        new_layer = np.zeros(layer.shape, dtype=np.uint8)
-                        # Set alpha layer to transparent
-                        if i == 4:
-                            new_layer[layer == 0] = 128
-                        dst.write(new_layer, indexes=i)
-            if self.mode == Viewshed.CoverageStatus.GROUND:
-                meta = src.meta.copy()
-                meta.update({"count": 4, "dtype": rasterio.uint8})
-                with rasterio.open(output_colorized_tempfile.name, "w", **meta) as dst:
-                    layer = src.read(1)
-                    for i in range(1, 5):
-                        new_layer = np.zeros(layer.shape, dtype=np.uint8)
-                        # Set Alpha Layer to Transparent
-                        if i == 4:
-                            new_layer[layer >= self.radio.default_cpe_height] = 128
-                        dst.write(new_layer, indexes=i)
+            layer = src.read(1)
+            transform = src.transform
+        if self.mode == Viewshed.CoverageStatus.NORMAL:
+            obstructed = layer == 0
+        elif self.mode == Viewshed.CoverageStatus.GROUND:
+            obstructed = layer >= self.radio.default_cpe_height
+        else:
+            raise ValueError(f"cannot colorize {self.mode} viewsheds")
+        alpha = np.zeros(layer.shape, dtype=np.uint8)
+        alpha[obstructed] = 128
+        return alpha, transform
 
     def __cropSector(self, viewshed_image):
         if self.ap is None and self.sector is not None:
@@ -425,13 +496,31 @@ class Viewshed(
                 self.write_object(temp_transform, tif=True)
                 TASK_LOGGER.info(f"reprojected: {time.time() - start}")
 
-    def __convert2Tiles(self, tif_filepath, outputfolder):
-        raw_command = self.__createGdal2TileCommand(tif_filepath, outputfolder)
-        filtered_command = shlex.split(raw_command)
-        subprocess.check_output(filtered_command, encoding="UTF-8")
-
     def delete_tiles(self):
-        ViewshedTile.objects.filter(viewshed=self).delete()
+        """
+        Delete the tiles with one query, and their s3 objects in batches once committed
+        """
+        self.__deleteTileObjects(self.__deleteTileRecords())
+
+    def __deleteTileRecords(self) -> set:
+        """
+        Delete the tile rows of the viewshed, returns their s3 keys
+        """
+        tiles = ViewshedTile.objects.filter(viewshed=self)
+        keys = {
+            ViewshedTile(viewshed=self, zoom=zoom, x=x, y=y).upload_to_path("")
+            for zoom, x, y in tiles.values_list("zoom", "x", "y")
+        }
+        # ViewshedTile has no delete signals so this is a single DELETE
+        tiles.delete()
+        return keys
+
+    def __deleteTileObjects(self, keys):
+        if keys:
+            keys = sorted(keys)
+            transaction.on_commit(
+                lambda: deleteMultipleS3Objects(keys, ViewshedTile.bucket_name)
+            )
 
 
 @receiver(post_save, sender=AccessPointSector)
@@ -503,9 +592,12 @@ class ViewshedTile(TileModel):
     )
 
 
-@receiver(post_delete, sender=ViewshedTile)
-def cleanup_tile(sender, instance, using, **kwargs):
-    instance.tile.delete(save=False)
+@receiver(pre_delete, sender=Viewshed)
+def cleanup_tiles(sender, instance, using, **kwargs):
+    """
+    Delete the tiles of deleted viewsheds, including the ones deleted by cascade
+    """
+    instance.delete_tiles()
 
 
 def convertViewshedRGBA(viewshed):
@@ -8,7 +8,7 @@ from .sector_tasks import (
     calculateSectorViewshed,
 )
 from .cpe_tasks import createSectorCPEFromLngLat
-from .ptp_tasks import calculate_serviceability
+from .ptp_tasks import calculate_serviceability, calculate_serviceability_batch
 
 import workspace.utils.import_utils
 
@@ -8,7 +8,8 @@ from workspace.models import (
 )
 from gis_data.models import MsftBuildingOutlines
 from django.contrib.gis.geos import GEOSGeometry, LineString
-from mmwave.lidar_utils.LidarEngine import LidarEngine, LidarResolution
+from mmwave.lidar_utils.LidarEngine import LidarResolution
+from mmwave.lidar_utils.BatchLidarEngine import BatchLidarEngine
 from workspace.utils.geojson_circle import createGeoJSONCircle
 from workspace.tasks.websocket_utils import updateClientAPStatus
 
@@ -76,13 +77,25 @@ def checkBuildingServiceable(access_point, building):
     Helper function, loads up lidar profile between centroid of building and accesspoint, calculates if link is feasible
 
     """
-    building = MsftBuildingOutlines.objects.filter(id=building.msftid).get()
-    building_center = building.geog.centroid
-    le = LidarEngine(
-        LineString([access_point.geojson, building_center]), LidarResolution.ULTRA, 1024
-    )
-    profile = le.getProfile()
-    return checkForObstructions(access_point, profile)
+    return checkBuildingsServiceable(access_point, [building])[0]
+
+
+def checkBuildingsServiceable(access_point, buildings):
+    """
+    Batched version of `checkBuildingServiceable`, nearby links share a single point cloud read
+
+    Returns a (serviceable, clearance) tuple per building, None if LiDAR is not available for the link
+    """
+    outlines = MsftBuildingOutlines.objects.in_bulk([b.msftid for b in buildings])
+    links = [
+        LineString([access_point.geojson, outlines[building.msftid].geog.centroid])
+        for building in buildings
+    ]
+    batch = BatchLidarEngine(links, LidarResolution.ULTRA, 1024)
+    return [
+        checkForObstructions(access_point, profile) if profile is not None else None
+        for profile in batch.getProfiles()
+    ]
 
 
 def checkForObstructions(access_point, profile):
@@ -22,6 +22,7 @@ from workspace.models.model_constants import ModelLimits
 from workspace.tasks.websocket_utils import sendMessageToChannel
 from workspace.templatetags.address_format import reverse_geocoded_address_lines
 
+import logging
 import numpy
 
 _AZIMUTH_BUFFER = 30
@@ -109,18 +110,25 @@ def createSectorCPEFromLngLat(channel_id, request, user_id):
         sector.save()
 
         cpes = []
-        links = []
         for cpe_point in cpe_points:
             lat = cpe_point.coords[1]
             lng = cpe_point.coords[0]
             name = reverse_geocoded_address_lines(lat, lng)[0]
-            cpe = CPELocation(
+            cpes.append(CPELocation(
                 owner=session.owner,
                 name=name,
                 map_session=session,
                 geojson=cpe_point,
                 sector=sector,
-            )
+            ))
+        # One grouped read of the DSM tiles instead of one per CPE when they are saved
+        try:
+            CPELocation.prefetch_dsm_heights(cpes)
+        except Exception as e:
+            logging.error(f"Exception when prefetching dsm heights: {e}")
+
+        links = []
+        for cpe in cpes:
             cpe.save()
 
             link = APToCPELink(
@@ -132,9 +140,16 @@ def createSectorCPEFromLngLat(channel_id, request, user_id):
             )
             link.save()
 
-            cpes.append(cpe)
             links.append(link)
 
+        # Read the point clouds once for all the new links, before the client asks for each profile
+        link_coords = [[list(link.geojson[0]), list(link.geojson[1])] for link in links]
+        transaction.on_commit(
+            lambda: app.send_task(
+                "mmwave.tasks.link_tasks.prefetchLiDARProfiles", (link_coords,)
+            )
+        )
+
         new_features = geojson_utils.merge_feature_collections(
             AccessPointSerializer.get_features_for_session(session, [tower]),
             AccessPointSectorSerializer.get_features_for_session(session, [sector]),
@@ -11,3 +11,12 @@ def calculate_serviceability(pk: str):
     TASK_LOGGER.info(f"Calculating serviceability for link '{pk}' ")
     link = workspace_models.PointToPointServiceability.objects.get(pk=pk)
     link.calculate_serviceability()
+
+
+@app.task
+def calculate_serviceability_batch(pks):
+    TASK_LOGGER.info(f"Calculating serviceability for {len(pks)} links")
+    links = workspace_models.PointToPointServiceability.objects.filter(
+        pk__in=pks
+    ).select_related("ptp")
+    workspace_models.PointToPointServiceability.calculate_serviceability_batch(list(links))
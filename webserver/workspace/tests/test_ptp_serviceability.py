@@ -0,0 +1,56 @@
+# (c) Meta Platforms, Inc. and affiliates. Copyright
+import types
+import unittest.mock as mock
+
+from .test_geomodels import WorkspaceBaseTestCase
+from workspace.api.models import PointToPointServiceability
+from workspace.models import PointToPointLink
+
+TEST_PROFILE = [1.0, 2.0, 3.0]
+
+
+class PointToPointServiceabilityBatchTestCase(WorkspaceBaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.serviceabilities = []
+        for _ in range(4):
+            ptp = PointToPointLink(
+                owner=self.testuser,
+                map_session=self.test_session,
+                geojson=self.test_ptp_link.geojson,
+            )
+            ptp.save()
+            serviceability = PointToPointServiceability(owner=self.testuser, ptp=ptp)
+            serviceability.save()
+            self.serviceabilities.append(serviceability)
+
+    def test_failed_links_do_not_stop_the_batch(self):
+        """
+        A link without LiDAR and a link that raises are recorded as UNKNOWN, the others are computed
+        """
+        no_lidar, failing = self.serviceabilities[1], self.serviceabilities[2]
+        for serviceability in (no_lidar, failing):
+            serviceability.serviceable = PointToPointServiceability.Serviceability.UNSERVICEABLE
+            serviceability.number_of_obstructions = 3
+            serviceability.save()
+
+        def gis_data(ptp, lidar=None):
+            if ptp.pk == failing.ptp.pk:
+                raise ValueError('elevation lookup failed')
+            return types.SimpleNamespace(lidar=lidar)
+
+        with mock.patch.object(
+            PointToPointLink, 'calculate_lidar_batch', return_value=[TEST_PROFILE, None, TEST_PROFILE, TEST_PROFILE]
+        ), mock.patch.object(PointToPointLink, 'gis_data', autospec=True, side_effect=gis_data), \
+                mock.patch.object(PointToPointLink, 'calculate_obstructions', return_value=0), \
+                mock.patch('workspace.api.models.ptp_results_models.redis'):
+            PointToPointServiceability.calculate_serviceability_batch(self.serviceabilities)
+
+        for serviceability in self.serviceabilities:
+            serviceability.refresh_from_db()
+        for serviceability in (no_lidar, failing):
+            self.assertEqual(serviceability.serviceable, PointToPointServiceability.Serviceability.UNKNOWN)
+            self.assertIsNone(serviceability.number_of_obstructions)
+        for serviceability in (self.serviceabilities[0], self.serviceabilities[3]):
+            self.assertEqual(serviceability.serviceable, PointToPointServiceability.Serviceability.SERVICEABLE)
+            self.assertEqual(serviceability.number_of_obstructions, 0)
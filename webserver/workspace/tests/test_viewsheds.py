@@ -1,8 +1,9 @@
 # (c) Meta Platforms, Inc. and affiliates. Copyright
 from django.contrib.gis.geos.geometry import GEOSGeometry
 from django.contrib.gis.geos.point import Point
+import unittest.mock as mock
 from .test_geomodels import WorkspaceBaseTestCase
-from workspace.models import Viewshed
+from workspace.models import Viewshed, ViewshedTile
 from mmwave.models import EPTLidarPointCloud
 
 
@@ -58,3 +59,30 @@ class ViewshedTestCase(WorkspaceBaseTestCase):
         self.viewshed.save()
         self.viewshed.calculateViewshed()
         self.assertTrue(len(self.viewshed.createJWT()) > 0)
+
+    def test_delete_tiles(self):
+        """
+        Tiles are deleted with one query and their s3 objects in one batch
+        """
+        viewshed = Viewshed(ap=self.test_ap)
+        viewshed.save()
+        ViewshedTile.objects.bulk_create(
+            [ViewshedTile(viewshed=viewshed, zoom=17, x=x, y=y) for x in range(30) for y in range(30)]
+        )
+        with mock.patch('workspace.models.viewshed_models.transaction.on_commit', lambda callback: callback()), \
+                mock.patch('workspace.models.viewshed_models.deleteMultipleS3Objects') as delete_objects:
+            # Select the keys, delete the rows
+            with self.assertNumQueries(2):
+                viewshed.delete_tiles()
+            self.assertFalse(ViewshedTile.objects.filter(viewshed=viewshed).exists())
+            keys, bucket_name = delete_objects.call_args[0]
+            self.assertEqual(len(keys), 900)
+            self.assertIn(ViewshedTile(viewshed=viewshed, zoom=17, x=3, y=4).upload_to_path(""), keys)
+            self.assertEqual(bucket_name, ViewshedTile.bucket_name)
+
+            # Deleted viewsheds take their tiles along
+            ViewshedTile.objects.create(viewshed=viewshed, zoom=12, x=1, y=2)
+            delete_objects.reset_mock()
+            self.test_ap.delete()
+            self.assertFalse(ViewshedTile.objects.exists())
+            self.assertEqual(len(delete_objects.call_args[0][0]), 1)